@@ -0,0 +1,268 @@
+""" Performance benchmarks for the TileStache tile pipeline.
+
+The tests directory checks that TileStache does the right thing, while this
+package measures how quickly it does it. Each benchmark scenario builds a
+synthetic configuration in a temporary directory, then requests a sequence
+of tiles end to end through TileStache.getTile() or TileStache.WSGITileServer,
+timing every request. See TileStache.Benchmark.scenarios for the scenarios.
+
+Benchmarks are usually run with the tilestache-bench.py script:
+
+    tilestache-bench.py --requests 500 --output before.json
+    tilestache-bench.py --requests 500 --output after.json --compare before.json
+
+With --startup, the script also measures import and configuration parsing
+time in a new process, see TileStache.Benchmark.startup. With --encoders, it
+measures encoding time and tile size for each encoder profile, see
+TileStache.Benchmark.encoders.
+
+Results for each scenario include throughput in tiles per second and mean,
+50th, 95th, and 99th percentile and maximum latency in milliseconds. Saved
+results are JSON files that also record the TileStache version, git commit,
+and Python version, so that runs from different commits can be compared.
+"""
+import sys
+import platform
+from math import ceil
+
+from os.path import dirname
+from subprocess import Popen, PIPE
+from threading import Thread, Lock
+from datetime import datetime
+from tempfile import mkdtemp
+from shutil import rmtree
+from time import time
+
+try:
+    from json import dump as json_dump, load as json_load
+except ImportError:
+    from simplejson import dump as json_dump, load as json_load
+
+from wsgiref.util import setup_testing_defaults
+
+import TileStache
+
+def percentile(values, fraction):
+    """ Return a percentile of a list of numbers, e.g. 0.95 for the 95th.
+
+        Uses the nearest-rank method on a sorted copy of the values.
+    """
+    values = sorted(values)
+
+    if not values:
+        return None
+
+    index = int(ceil(fraction * len(values))) - 1
+    return values[min(max(index, 0), len(values) - 1)]
+
+def summarize(latencies, elapsed):
+    """ Summarize a list of request latencies in seconds and a total elapsed time.
+    """
+    count = len(latencies)
+    ms = lambda seconds: round(seconds * 1000, 3)
+
+    return dict(
+        requests = count,
+        seconds = round(elapsed, 3),
+        throughput = round(count / elapsed, 1) if elapsed else None,
+        mean_ms = ms(sum(latencies) / count) if count else None,
+        p50_ms = ms(percentile(latencies, .50)) if count else None,
+        p95_ms = ms(percentile(latencies, .95)) if count else None,
+        p99_ms = ms(percentile(latencies, .99)) if count else None,
+        max_ms = ms(max(latencies)) if count else None
+        )
+
+def getTileRequester(config, layername):
+    """ Return a function that gets a tile by calling TileStache.getTile().
+    """
+    layer = config.layers[layername]
+
+    def request(coord, extension):
+        mime, body = TileStache.getTile(layer, coord, extension)
+        return body
+
+    return request
+
+def wsgiRequester(config, layername):
+    """ Return a function that gets a tile from a TileStache.WSGITileServer.
+    """
+    app = TileStache.WSGITileServer(config)
+
+    def request(coord, extension):
+        path_info = TileStache.mergePathInfo(layername, coord, extension)
+        environ = {'PATH_INFO': path_info}
+        setup_testing_defaults(environ)
+
+        def start_response(status, headers):
+            if not status.startswith('200'):
+                raise Exception('%s returned %s' % (path_info, status))
+
+        return ''.join(app(environ, start_response))
+
+    return request
+
+requesters = {'gettile': getTileRequester, 'wsgi': wsgiRequester}
+
+def timeRequests(request, coords, extension, threads=1):
+    """ Request each coordinate and return a list of latencies and elapsed time.
+
+        Coordinates are shared among the given number of threads.
+    """
+    coords, latencies, lock = list(coords), [], Lock()
+
+    def work():
+        while True:
+            with lock:
+                if not coords:
+                    return
+                coord = coords.pop(0)
+
+            start = time()
+            request(coord, extension)
+            latency = time() - start
+
+            with lock:
+                latencies.append(latency)
+
+    start = time()
+    workers = [Thread(target=work) for i in range(threads)]
+
+    for worker in workers:
+        worker.start()
+
+    for worker in workers:
+        worker.join()
+
+    return latencies, time() - start
+
+def runScenario(scenario, options):
+    """ Run one scenario and return a dictionary of results.
+
+        Options is a dictionary with "requests", "via", and "threads" keys
+        and any scenario-specific keys, such as "memcache" or "redis" servers.
+    """
+    dirpath = mkdtemp(prefix='tilestache-bench-')
+
+    try:
+        config = TileStache.parseConfig(scenario.build(dirpath, options))
+        request = requesters[options.get('via', 'gettile')](config, scenario.layer)
+
+        coords = scenario.coords(options.get('requests', 100))
+
+        if scenario.warm:
+            # cache scenarios measure reads, so fill the cache first.
+            timeRequests(request, coords, scenario.extension)
+
+        latencies, elapsed = timeRequests(request, coords, scenario.extension, options.get('threads', 1))
+
+    finally:
+        rmtree(dirpath)
+        scenario.cleanup()
+
+    return summarize(latencies, elapsed)
+
+def runScenarios(scenarios, options, out=sys.stdout):
+    """ Run a list of scenarios and return a complete dictionary of results.
+
+        Scenarios that can't be run in this environment are skipped with a note.
+    """
+    results = dict(
+        tilestache = TileStache.__version__,
+        commit = gitCommit(),
+        python = platform.python_version(),
+        platform = platform.platform(),
+        time = datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
+        options = options,
+        scenarios = {}, skipped = {}
+        )
+
+    for scenario in scenarios:
+        reason = scenario.unavailable(options)
+
+        if reason:
+            print >> out, '%-16s skipped: %s' % (scenario.name, reason)
+            results['skipped'][scenario.name] = reason
+            continue
+
+        result = runScenario(scenario, options)
+        results['scenarios'][scenario.name] = result
+
+        print >> out, '%(name)-16s %(throughput)8.1f/s  p50 %(p50_ms)8.3fms  p95 %(p95_ms)8.3fms  p99 %(p99_ms)8.3fms' \
+                      % dict(result, name=scenario.name)
+
+    return results
+
+def printStartup(startup, out=sys.stdout):
+    """ Print startup measurements from TileStache.Benchmark.startup.
+    """
+    print >> out, 'startup          import %(import_ms).1fms  parse %(parse_ms).1fms for %(layers)d layers  first tile %(first_tile_ms).1fms' % startup
+    print >> out, '                 %d modules, heavy modules: %s' % (startup['modules'], ', '.join(startup['heavy_modules']) or 'none')
+
+def printEncoders(encoders, out=sys.stdout):
+    """ Print encoder measurements from TileStache.Benchmark.encoders.
+    """
+    for name in sorted(encoders['profiles']):
+        profile = encoders['profiles'][name]
+        print >> out, '%-16s encode %7.2fms  %7d bytes' % (name, profile['encode_ms'], profile['bytes'])
+
+    for name in sorted(encoders['skipped']):
+        print >> out, '%-16s skipped: %s' % (name, encoders['skipped'][name])
+
+def gitCommit():
+    """ Return the current git commit of the TileStache checkout, if there is one.
+    """
+    try:
+        git = Popen(('git', 'rev-parse', 'HEAD'), stdout=PIPE, stderr=PIPE, cwd=dirname(__file__))
+        commit, error = git.communicate()
+    except OSError:
+        return None
+
+    return (git.returncode == 0) and commit.strip() or None
+
+def saveResults(results, filename):
+    """ Write results to a JSON file.
+    """
+    with open(filename, 'w') as file:
+        json_dump(results, file, indent=2, sort_keys=True)
+
+def loadResults(filename):
+    """ Read results from a JSON file.
+    """
+    with open(filename) as file:
+        return json_load(file)
+
+def compareResults(before, after, out=sys.stdout):
+    """ Print percentage changes in throughput and latency between two sets of results.
+    """
+    print >> out, 'Compared to %s:' % (before.get('commit') or 'previous results')
+
+    for name in sorted(after['scenarios']):
+        if name not in before['scenarios']:
+            continue
+
+        old, new = before['scenarios'][name], after['scenarios'][name]
+        changes = []
+
+        for key in ('throughput', 'p50_ms', 'p95_ms', 'p99_ms'):
+            if old.get(key) and new.get(key) is not None:
+                changes.append('%s %+.1f%%' % (key, 100. * (new[key] - old[key]) / old[key]))
+
+        print >> out, '%-16s %s' % (name, '  '.join(changes))
+
+    if 'startup' in before and 'startup' in after:
+        old, new = before['startup'], after['startup']
+        changes = ['%s %+.1f%%' % (key, 100. * (new[key] - old[key]) / old[key])
+                   for key in ('import_ms', 'parse_ms', 'first_tile_ms', 'modules') if old.get(key)]
+
+        print >> out, '%-16s %s' % ('startup', '  '.join(changes))
+
+    if 'encoders' in before and 'encoders' in after:
+        for name in sorted(after['encoders']['profiles']):
+            if name not in before['encoders']['profiles']:
+                continue
+
+            old, new = before['encoders']['profiles'][name], after['encoders']['profiles'][name]
+            changes = ['%s %+.1f%%' % (key, 100. * (new[key] - old[key]) / old[key])
+                       for key in ('encode_ms', 'bytes') if old.get(key)]
+
+            print >> out, '%-16s %s' % (name, '  '.join(changes))
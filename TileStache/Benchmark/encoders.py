@@ -0,0 +1,94 @@
+""" Measure how long each encoder profile takes, and how big its tiles are.
+
+Encoding is often most of the work for a tile that's already rendered, and
+its size is most of the bandwidth. Each profile from TileStache.Encoders
+encodes the same images several times and reports:
+
+- encode_ms: median time to encode one tile.
+- bytes: average size of an encoded tile.
+
+The tiles come from an image file, cut up into 256 pixel squares, or from
+a synthetic map-like image of flat areas and anti-aliased lines. Profiles
+whose formats this PIL can't write are reported as skipped.
+
+Encoders are measured by tilestache-bench.py with the --encoders option.
+"""
+from StringIO import StringIO
+from random import Random
+from time import time
+
+try:
+    from PIL import Image, ImageDraw
+except ImportError:
+    # On some systems, PIL.Image is known as Image.
+    import Image, ImageDraw
+
+from TileStache import Encoders
+from TileStache.Benchmark import percentile
+
+def mapImage(size=1024, seed=0):
+    """ Return an RGB image that compresses roughly like a rendered map.
+    """
+    random = Random(seed)
+    image = Image.new('RGB', (size * 2, size * 2), (0xF2, 0xEF, 0xE9))
+    draw = ImageDraw.Draw(image)
+
+    fills = [(0xAA, 0xD3, 0xDF), (0xC8, 0xFA, 0xCC), (0xD9, 0xD0, 0xC9), (0xE0, 0xDF, 0xDF), (0xAD, 0xD1, 0x9E)]
+    strokes = [(0xFF, 0xFF, 0xFF), (0xF7, 0xFA, 0xBF), (0xFC, 0xD6, 0xA4), (0xE8, 0x92, 0xA2)]
+
+    for i in range(size / 16):
+        x, y = random.randint(0, size * 2), random.randint(0, size * 2)
+        points = [(x + random.randint(-size / 8, size / 8), y + random.randint(-size / 8, size / 8)) for j in range(5)]
+        draw.polygon(points, fill=random.choice(fills))
+
+    for i in range(size / 16):
+        points = [(random.randint(0, size * 2), random.randint(0, size * 2)) for j in range(3)]
+        draw.line(points, fill=random.choice(strokes), width=random.randint(2, 12))
+
+    # drawn at double size and shrunk, for anti-aliased edges.
+    return image.resize((size, size), Image.ANTIALIAS)
+
+def tiles(image, dim=256):
+    """ Return a list of tile-sized images cut from a larger image.
+    """
+    width, height = image.size
+
+    return [image.crop((x, y, x + dim, y + dim))
+            for y in range(0, height - dim + 1, dim)
+            for x in range(0, width - dim + 1, dim)]
+
+def measureEncoders(image=None, runs=5, names=None):
+    """ Return measurements by profile name, and skipped profiles with reasons.
+
+        Image is an optional PIL image or filename, defaults to mapImage().
+    """
+    if image is None:
+        image = mapImage()
+    elif not hasattr(image, 'crop'):
+        image = Image.open(image)
+
+    images = tiles(image.convert('RGBA' if 'A' in image.mode else 'RGB'))
+    results, skipped = {}, {}
+
+    for name in sorted(names or Encoders.all):
+        encoder = Encoders.all[name]()
+        times, sizes = [], []
+
+        try:
+            for run in range(runs):
+                for tile in images:
+                    out = StringIO()
+                    start = time()
+                    encoder.encode(tile, out)
+                    times.append(time() - start)
+                    sizes.append(len(out.getvalue()))
+
+        except (IOError, KeyError), e:
+            # e.g. a PIL without libwebp.
+            skipped[name] = str(e) or e.__class__.__name__
+            continue
+
+        results[name] = dict(encode_ms=round(percentile(times, .5) * 1000, 2),
+                             bytes=int(sum(sizes) / len(sizes)))
+
+    return results, skipped
@@ -0,0 +1,254 @@
+""" Replay a tile access log against an in-process TileStache server.
+
+Benchmark scenarios use synthetic data, while replay uses a real configuration
+and real traffic to check changes to metatile sizes, cache tiers, and so on
+before they're deployed. Logs have one tile request per line, a Unix timestamp
+and a path in the form used by TileStache.splitPathInfo(), in either order:
+
+    1356998400.25 /osm/12/656/1582.png
+    1356998400.31 /osm/12/657/1582.png
+
+Lines without a timestamp are also accepted, but can only be replayed as fast
+as possible. Requests are made to a TileStache.WSGITileServer in this process
+by a pool of threads, at the speed they were recorded or a multiple of it.
+
+Replay reports request latencies as in TileStache.Benchmark, along with:
+
+- Response counts by HTTP status.
+- Tile counts and ratios by source, e.g. "cache" or "layer.render()", from
+  the tilestache_tiles_total measurement in TileStache.Metrics.
+- Cache hit ratio, counting every source but "layer.render()" as a hit.
+- Lock counts, and the number of locks that had to wait for another thread.
+- Peak memory use of the process, in megabytes.
+
+Replays are usually run with the tilestache-replay.py script.
+"""
+import sys
+
+from threading import Thread, Lock
+from time import time, sleep
+
+try:
+    import resource
+except ImportError:
+    # no peak memory on Windows
+    resource = None
+
+from wsgiref.util import setup_testing_defaults
+
+import TileStache
+from TileStache import Metrics
+from TileStache.Benchmark import summarize
+
+def parseLine(line):
+    """ Return a timestamp and path for one log line, or None for a blank line.
+
+        Timestamp may be None for lines without one.
+    """
+    timestamp, path = None, None
+
+    for part in line.split():
+        if '/' in part:
+            path = '/' + part.lstrip('/')
+        else:
+            timestamp = float(part)
+
+    if path is None:
+        if timestamp is None:
+            return None
+
+        raise ValueError('Missing tile path in log line: %s' % repr(line))
+
+    return timestamp, path
+
+def readLog(file):
+    """ Return a list of (timestamp, path) tuples from a file of log lines.
+    """
+    entries = [parseLine(line) for line in file if not line.startswith('#')]
+    return [entry for entry in entries if entry is not None]
+
+class LockCounter:
+    """ Cache wrapper that counts tile locks and contention between threads.
+
+        A lock is counted as contended when another thread in this process
+        holds the same lock at the moment it's asked for.
+    """
+    def __init__(self, cache):
+        self.cache = cache
+        self.held = {}
+        self.counter_lock = Lock()
+        self.locks, self.contended = 0, 0
+
+    def _key(self, layer, coord, format):
+        return layer.name(), coord.zoom, coord.column, coord.row, format
+
+    def lock(self, layer, coord, format):
+        key = self._key(layer, coord, format)
+
+        with self.counter_lock:
+            self.locks += 1
+
+            if self.held.get(key):
+                self.contended += 1
+
+        self.cache.lock(layer, coord, format)
+
+        with self.counter_lock:
+            self.held[key] = self.held.get(key, 0) + 1
+
+    def unlock(self, layer, coord, format):
+        key = self._key(layer, coord, format)
+
+        with self.counter_lock:
+            self.held[key] -= 1
+
+            if not self.held[key]:
+                del self.held[key]
+
+        self.cache.unlock(layer, coord, format)
+
+    def remove(self, layer, coord, format):
+        return self.cache.remove(layer, coord, format)
+
+    def read(self, layer, coord, format):
+        return self.cache.read(layer, coord, format)
+
+    def save(self, body, layer, coord, format):
+        return self.cache.save(body, layer, coord, format)
+
+def peakMemory():
+    """ Return the peak memory use of this process in megabytes, if known.
+    """
+    if resource is None:
+        return None
+
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # kilobytes on Linux, bytes on Mac OS X
+    if sys.platform == 'darwin':
+        maxrss /= 1024.
+
+    return round(maxrss / 1024., 1)
+
+def tileSources():
+    """ Return a dictionary of tile counts by source from TileStache.Metrics.
+    """
+    sources = {}
+
+    for ((name, labels), count) in Metrics.registry.counters.items():
+        if name == 'tilestache_tiles_total':
+            source = dict(labels)['source']
+            sources[source] = sources.get(source, 0) + count
+
+    return sources
+
+def replay(config, entries, threads=1, speed=None):
+    """ Replay a list of (timestamp, path) log entries and return results.
+
+        Config is a TileStache configuration object or file path. Speed is
+        a multiple of the recorded request rate, or None to replay requests
+        as fast as possible.
+
+        Tile measurements in TileStache.Metrics are cleared before replay.
+    """
+    if type(config) in (str, unicode):
+        config = TileStache.parseConfig(config)
+
+    counter = LockCounter(config.cache)
+    config.cache = counter
+
+    app = TileStache.WSGITileServer(config)
+
+    if speed and None in [timestamp for (timestamp, path) in entries]:
+        raise ValueError('Every log line needs a timestamp to replay at recorded speed.')
+
+    queue, latencies, statuses, lags = list(entries), [], {}, []
+    first = entries and entries[0][0]
+    results_lock = Lock()
+
+    def request(path_info):
+        environ = {'PATH_INFO': path_info}
+        setup_testing_defaults(environ)
+        status = []
+
+        def start_response(_status, headers):
+            status.append(_status.split()[0])
+
+        ''.join(app(environ, start_response))
+        return status[0]
+
+    def work():
+        while True:
+            with results_lock:
+                if not queue:
+                    return
+                timestamp, path_info = queue.pop(0)
+
+            if speed:
+                # wait until the request is due, and note if we're late.
+                due = start + (timestamp - first) / speed
+                sleep(max(due - time(), 0))
+                lag = time() - due
+
+            begin = time()
+            status = request(path_info)
+            latency = time() - begin
+
+            with results_lock:
+                latencies.append(latency)
+                statuses[status] = statuses.get(status, 0) + 1
+
+                if speed:
+                    lags.append(lag)
+
+    Metrics.registry.clear()
+
+    start = time()
+    workers = [Thread(target=work) for i in range(threads)]
+
+    for worker in workers:
+        worker.start()
+
+    for worker in workers:
+        worker.join()
+
+    results = summarize(latencies, time() - start)
+
+    sources = tileSources()
+    tiles = sum(sources.values())
+    renders = sources.get('layer.render()', 0)
+
+    results.update(
+        statuses = statuses,
+        sources = dict([(source, dict(count=count, ratio=round(float(count) / tiles, 4)))
+                        for (source, count) in sources.items()]),
+        cache_hit_ratio = round(float(tiles - renders) / tiles, 4) if tiles else None,
+        locks = counter.locks,
+        contended_locks = counter.contended,
+        max_lag_ms = round(max(lags) * 1000, 3) if lags else None,
+        peak_memory_mb = peakMemory()
+        )
+
+    return results
+
+def printResults(results, out=sys.stdout):
+    """ Print a human-readable summary of replay results.
+    """
+    print >> out, '%(requests)d requests in %(seconds).1fs, %(throughput).1f/s' % results
+    print >> out, 'Latency: mean %(mean_ms).3fms, p50 %(p50_ms).3fms, p95 %(p95_ms).3fms, p99 %(p99_ms).3fms, max %(max_ms).3fms' % results
+
+    if results['max_lag_ms'] is not None:
+        print >> out, 'Fell behind recorded speed by up to %(max_lag_ms).3fms' % results
+
+    print >> out, 'Statuses: %s' % ', '.join(['%s: %d' % item for item in sorted(results['statuses'].items())])
+
+    for (source, tiles) in sorted(results['sources'].items()):
+        print >> out, 'Tiles from %s: %d (%.1f%%)' % (source, tiles['count'], tiles['ratio'] * 100)
+
+    if results['cache_hit_ratio'] is not None:
+        print >> out, 'Cache hit ratio: %.1f%%' % (results['cache_hit_ratio'] * 100)
+
+    print >> out, 'Locks: %(locks)d, contended: %(contended_locks)d' % results
+
+    if results['peak_memory_mb'] is not None:
+        print >> out, 'Peak memory: %(peak_memory_mb).1fMB' % results
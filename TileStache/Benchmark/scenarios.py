@@ -0,0 +1,249 @@
+""" Benchmark scenarios covering providers, compositing, and caches.
+
+Each scenario builds a complete configuration dictionary for a temporary
+directory, using only synthetic data: the raster layers use SyntheticProvider
+below, and the vector layer reads a GeoJSON file written for the run.
+
+Render scenarios use the "Test" cache so every request exercises the whole
+rendering pipeline. Cache scenarios fill their cache with one pass over the
+tiles and then measure a second pass, so they report cache read speed.
+
+Scenarios that need an optional library or an outside server are skipped
+when it's missing. Memcache and Redis scenarios only run when given server
+addresses, and the S3 scenario uses moto's local stand-in for S3:
+
+  "raster"          SyntheticProvider tiles, rendered on every request.
+  "raster-metatile" SyntheticProvider tiles, rendered in 4x4 metatiles and
+                    saved to an initially empty Disk cache.
+  "vector"          Vector provider on a local GeoJSON file; requires GDAL.
+  "sandwich"        Sandwich stack of two raster layers; requires NumPy.
+  "sandwich-stack"  Sandwich stack of eight layers with masks, adjustments,
+                    and a local image file; requires NumPy.
+  "composite"       Composite provider stack of two raster layers.
+  "disk"            Disk cache reads.
+  "bundle"          Bundle cache reads.
+  "lmdb"            LMDB cache reads; requires py-lmdb.
+  "multi"           Multi cache reads from an LMDB tier in front of a Disk tier.
+  "memcache"        Memcache cache reads; requires a server from --memcache.
+  "redis"           Redis cache reads; requires a server from --redis.
+  "s3"              S3 cache reads; requires boto and moto.
+"""
+from os.path import join as pathjoin
+from random import Random
+from binascii import unhexlify
+
+try:
+    from json import dump as json_dump
+except ImportError:
+    from simplejson import dump as json_dump
+
+from ModestMaps.Core import Coordinate
+
+try:
+    from PIL import Image, ImageChops
+except ImportError:
+    import Image, ImageChops
+
+class SyntheticProvider:
+    """ Raster provider that draws repeatable noisy images without any data.
+
+        Noise keeps the rendered images realistically expensive to encode,
+        compared to the solid or empty tiles a trivial provider would make.
+
+        Parameters:
+
+          seed:
+            Optional number to seed the noise; defaults to zero.
+    """
+    def __init__(self, layer, seed=0):
+        self.layer = layer
+        self.seed = int(seed)
+        self.noise = {}
+
+    def renderArea(self, width, height, srs, xmin, ymin, xmax, ymax, zoom):
+        """ Return a noise image, shifted differently for each area.
+        """
+        if (width, height) not in self.noise:
+            bits = Random(self.seed).getrandbits(width * height * 24)
+            bytes = unhexlify('%0*x' % (width * height * 6, bits))
+            self.noise[(width, height)] = Image.frombytes('RGB', (width, height), bytes)
+
+        shift = Random(hash((self.seed, zoom, xmin, ymin)))
+        return ImageChops.offset(self.noise[(width, height)], shift.randint(0, width), shift.randint(0, height))
+
+class Scenario:
+    """ One benchmark scenario: a configuration, a layer, and tiles to request.
+    """
+    def __init__(self, name, layer, extension, build, warm=False, requires=(), zoom=12):
+        self.name = name
+        self.layer = layer
+        self.extension = extension
+        self.warm = warm
+        self.requires = requires
+        self.zoom = zoom
+        self._build = build
+        self._cleanup = []
+
+    def unavailable(self, options):
+        """ Return a reason this scenario can't run, or None if it can.
+        """
+        for requirement in self.requires:
+            if requirement in ('memcache', 'redis'):
+                if not options.get(requirement):
+                    return 'no %s server given' % requirement
+
+            try:
+                __import__(requirement)
+            except ImportError:
+                return 'requires %s' % requirement
+            except Exception, e:
+                return 'requires working %s (%s)' % (requirement, e)
+
+        return None
+
+    def build(self, dirpath, options):
+        """ Return a configuration dictionary for a temporary directory.
+        """
+        return self._build(self, dirpath, options)
+
+    def cleanup(self):
+        """ Undo anything build() set up outside the temporary directory.
+        """
+        while self._cleanup:
+            self._cleanup.pop()()
+
+    def coords(self, count):
+        """ Return a repeatable list of tile coordinates to request.
+
+            Tiles come from a square block in the middle of the zoom level,
+            big enough that no tile is requested twice.
+        """
+        side = int(count ** .5) + 1
+        middle = 2 ** (self.zoom - 1)
+        rows = range(middle - side/2, middle - side/2 + side)
+
+        coords = [Coordinate(row, column, self.zoom) for row in rows for column in rows]
+        Random(self.zoom).shuffle(coords)
+
+        return coords[:count]
+
+def _config(cache, layers):
+    """ Return a configuration dictionary.
+    """
+    return dict(cache=cache, layers=layers)
+
+def _raster(seed=0, **kwargs):
+    """ Return a layer dictionary for SyntheticProvider.
+    """
+    provider = {'class': 'TileStache.Benchmark.scenarios:SyntheticProvider', 'kwargs': {'seed': seed}}
+    return dict(provider=provider, **kwargs)
+
+def build_raster(scenario, dirpath, options):
+    return _config({'name': 'Test'}, {'raster': _raster()})
+
+def build_metatile(scenario, dirpath, options):
+    metatile = {'rows': 4, 'columns': 4, 'buffer': 0}
+    return _config({'name': 'Disk', 'path': dirpath}, {'raster': _raster(metatile=metatile)})
+
+def build_vector(scenario, dirpath, options):
+    """ Write a GeoJSON file of random lines near the middle of the map.
+    """
+    random, features = Random(0), []
+
+    for i in range(2000):
+        lon, lat = random.uniform(-.2, .2), random.uniform(-.2, .2)
+        points = [(lon + random.uniform(-.01, .01), lat + random.uniform(-.01, .01)) for j in range(8)]
+        geometry = {'type': 'LineString', 'coordinates': points}
+        features.append({'type': 'Feature', 'geometry': geometry, 'properties': {'id': i}})
+
+    filename = pathjoin(dirpath, 'lines.geojson')
+
+    with open(filename, 'w') as file:
+        json_dump({'type': 'FeatureCollection', 'features': features}, file)
+
+    provider = {'name': 'vector', 'driver': 'GeoJSON', 'parameters': {'file': filename}}
+    return _config({'name': 'Test'}, {'vector': {'provider': provider}})
+
+def build_sandwich(scenario, dirpath, options):
+    stack = [{'color': '#ff9900'}, {'src': 'raster'}, {'src': 'noise', 'mode': 'screen', 'opacity': 0.5}]
+    layers = {'raster': _raster(), 'noise': _raster(1), 'sandwich': {'provider': {'name': 'sandwich', 'stack': stack}}}
+    return _config({'name': 'Test'}, layers)
+
+def build_sandwich_stack(scenario, dirpath, options):
+    """ Write an image file for a larger stack with masks and adjustments.
+    """
+    filename = pathjoin(dirpath, 'texture.png')
+    SyntheticProvider(None, 7).renderArea(300, 200, None, 0, 0, 0, 0, 0).save(filename)
+
+    stack = [
+        {'color': '#ff9900'},
+        {'src': 'raster'},
+        {'src': 'noise', 'mode': 'screen', 'opacity': 0.5},
+        {'src': 'raster', 'mask': 'noise', 'mode': 'hard light'},
+        {'src': filename, 'mode': 'multiply', 'opacity': 0.7},
+        {'src': 'noise', 'color': '#336699', 'mode': 'linear light', 'opacity': 0.3},
+        {'src': 'raster', 'adjustments': [['curves', [0, 181, 255]]], 'opacity': 0.6},
+        {'color': '#0f08', 'mask': 'noise', 'mode': 'add'}
+        ]
+
+    layers = {'raster': _raster(), 'noise': _raster(1), 'sandwich': {'provider': {'name': 'sandwich', 'stack': stack}}}
+    return _config({'name': 'Test'}, layers)
+
+def build_composite(scenario, dirpath, options):
+    stack = [{'color': '#ff9900'}, {'src': 'raster'}, {'src': 'noise', 'mode': 'screen', 'opacity': 0.5}]
+    provider = {'class': 'TileStache.Goodies.Providers.Composite:Provider', 'kwargs': {'stack': stack}}
+    layers = {'raster': _raster(), 'noise': _raster(1), 'composite': {'provider': provider}}
+    return _config({'name': 'Test'}, layers)
+
+def _cached(cache):
+    """ Return a build function for a raster layer with the given cache.
+    """
+    def build(scenario, dirpath, options):
+        return _config(cache(dirpath, options), {'raster': _raster()})
+
+    return build
+
+def _memcache(dirpath, options):
+    return {'name': 'Memcache', 'servers': [options['memcache']], 'key prefix': 'bench-%s' % dirpath}
+
+def _redis(dirpath, options):
+    host, port = (options['redis'].split(':') + ['6379'])[:2]
+    return {'name': 'Redis', 'host': host, 'port': int(port), 'key prefix': 'bench-%s' % dirpath}
+
+def _multi(dirpath, options):
+    tiers = [{'name': 'LMDB', 'path': pathjoin(dirpath, 'lmdb')}, {'name': 'Disk', 'path': dirpath}]
+    return {'name': 'Multi', 'tiers': tiers}
+
+def build_s3(scenario, dirpath, options):
+    """ Start a moto stand-in for S3 with an empty bucket.
+    """
+    from moto import mock_s3_deprecated
+    from boto.s3.connection import S3Connection
+
+    mock = mock_s3_deprecated()
+    mock.start()
+    scenario._cleanup.append(mock.stop)
+
+    S3Connection('access', 'secret').create_bucket('tilestache-bench')
+    cache = {'name': 'S3', 'bucket': 'tilestache-bench', 'access': 'access', 'secret': 'secret'}
+
+    return _config(cache, {'raster': _raster()})
+
+def all_scenarios():
+    """ Return a list of every benchmark scenario.
+    """
+    return [
+        Scenario('raster', 'raster', 'png', build_raster),
+        Scenario('raster-metatile', 'raster', 'png', build_metatile),
+        Scenario('vector', 'vector', 'geojson', build_vector, requires=('osgeo', )),
+        Scenario('sandwich', 'sandwich', 'png', build_sandwich, requires=('numpy', )),
+        Scenario('sandwich-stack', 'sandwich', 'png', build_sandwich_stack, requires=('numpy', )),
+        Scenario('composite', 'composite', 'png', build_composite, requires=('numpy', )),
+        Scenario('disk', 'raster', 'png', _cached(lambda d, o: {'name': 'Disk', 'path': d}), warm=True),
+        Scenario('bundle', 'raster', 'png', _cached(lambda d, o: {'name': 'Bundle', 'path': d}), warm=True),
+        Scenario('lmdb', 'raster', 'png', _cached(lambda d, o: {'name': 'LMDB', 'path': d}), warm=True, requires=('lmdb', )),
+        Scenario('multi', 'raster', 'png', _cached(_multi), warm=True, requires=('lmdb', )),
+        Scenario('memcache', 'raster', 'png', _cached(_memcache), warm=True, requires=('memcache', )),
+        Scenario('redis', 'raster', 'png', _cached(_redis), warm=True, requires=('redis', )),
+        Scenario('s3', 'raster', 'png', build_s3, warm=True, requires=('boto', 'moto'))
+        ]
@@ -0,0 +1,91 @@
+""" Measure how long TileStache takes to start up.
+
+Worker processes of a pre-forking server each import TileStache and parse a
+configuration before they can serve a tile, so startup time and memory matter
+for configurations with hundreds of layers. Each measurement runs in a fresh
+Python interpreter and reports:
+
+- import_ms: time to import TileStache.
+- parse_ms: time to parse a configuration of many synthetic layers.
+- first_tile_ms: time to then get the first tile from one layer.
+- modules: number of modules loaded after parsing the configuration.
+- heavy_modules: which of mapnik, osgeo, shapely, numpy, and boto are loaded.
+- peak_memory_mb: peak memory use of the process, where known.
+
+Startup is measured by tilestache-bench.py with the --startup option.
+"""
+import sys
+
+from os import environ, pathsep
+from subprocess import Popen, PIPE
+
+try:
+    from json import loads as json_loads
+except ImportError:
+    from simplejson import loads as json_loads
+
+# Modules that are slow to import or large in memory.
+heavy_modules = 'mapnik', 'osgeo', 'shapely', 'numpy', 'boto'
+
+_script = r'''
+import sys, json
+from time import time
+
+start = time()
+import TileStache
+imported = time()
+
+layers = {}
+
+for i in range(%(layers)d):
+    if i %% 2:
+        provider = {"name": "proxy", "url": "http://tile.example.com/{Z}/{X}/{Y}.png"}
+    else:
+        provider = {"class": "TileStache.Benchmark.scenarios:SyntheticProvider", "kwargs": {"seed": i}}
+
+    layers["layer-%%d" %% i] = {"provider": provider, "metatile": {"rows": 2, "columns": 2}}
+
+config = TileStache.parseConfig({"cache": {"name": "Test"}, "layers": layers})
+parsed = time()
+
+from ModestMaps.Core import Coordinate
+TileStache.getTile(config.layers["layer-0"], Coordinate(0, 0, 1), "png")
+tiled = time()
+
+try:
+    import resource
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (sys.platform == "darwin" and 1048576. or 1024.)
+except ImportError:
+    maxrss = None
+
+print json.dumps(dict(
+    import_ms = round((imported - start) * 1000, 1),
+    parse_ms = round((parsed - imported) * 1000, 1),
+    first_tile_ms = round((tiled - parsed) * 1000, 1),
+    modules = len(sys.modules),
+    heavy_modules = sorted([name for name in %(heavy)r if name in sys.modules]),
+    peak_memory_mb = maxrss and round(maxrss, 1)
+    ))
+'''
+
+def measureStartup(layers=500, runs=3):
+    """ Return startup measurements, the best of several runs.
+
+        Each run is a new Python interpreter, so nothing is already imported.
+    """
+    best, env = None, dict(environ, PYTHONPATH=pathsep.join(sys.path))
+
+    for run in range(runs):
+        python = Popen((sys.executable, '-c', _script % dict(layers=layers, heavy=heavy_modules)), stdout=PIPE, env=env)
+        output, error = python.communicate()
+
+        if python.returncode != 0:
+            raise Exception('Startup measurement failed with status %d' % python.returncode)
+
+        result = json_loads(output)
+
+        if best is None or result['import_ms'] + result['parse_ms'] < best['import_ms'] + best['parse_ms']:
+            best = result
+
+    best['layers'] = layers
+    return best
@@ -7,8 +7,11 @@ own and pull them into TileStache dynamically by class name.
 Built-in providers:
 - test
 - disk
+- bundle
 - multi
 - memcache
+- redis
+- lmdb
 - s3
 
 Example built-in cache, for JSON configuration file:
@@ -50,15 +53,16 @@ TODO: add stale_lock_timeout and cache_lifespan to cache API in v2.
 import os
 import sys
 import time
+import fcntl
+import struct
+import logging
 import gzip
 
+from threading import Thread, Condition
 from tempfile import mkstemp
 from os.path import isdir, exists, dirname, basename, join as pathjoin
 
-from .Core import KnownUnknown
-from . import Memcache
-from . import Redis
-from . import S3
+from .Core import KnownUnknown, TheTileLeftANote
 
 def getCacheByName(name):
     """ Retrieve a cache object by name.
@@ -71,18 +75,28 @@ def getCacheByName(name):
     elif name.lower() == 'disk':
         return Disk
 
+    elif name.lower() == 'bundle':
+        return Bundle
+
     elif name.lower() == 'multi':
         return Multi
 
     elif name.lower() == 'memcache':
+        from . import Memcache
         return Memcache.Cache
 
     elif name.lower() == 'redis':
+        from . import Redis
         return Redis.Cache
 
     elif name.lower() == 's3':
+        from . import S3
         return S3.Cache
 
+    elif name.lower() == 'lmdb':
+        from . import LMDB
+        return LMDB.Cache
+
     raise Exception('Unknown cache name: "%s"' % name)
 
 class Test:
@@ -361,6 +375,274 @@ class Disk:
 
         os.chmod(fullpath, 0666&~self.umask)
 
+class Bundle:
+    """ Caches blocks of tiles to single files on disk.
+    
+        Example configuration:
+
+            "cache": {
+              "name": "Bundle",
+              "path": "/tmp/stache",
+              "umask": "0000",
+              "size": 4
+            }
+
+        Extra parameters:
+        - path: required local directory path where files should be stored.
+        - umask: optional string representation of octal permission mask
+          for stored files. Defaults to 0022.
+        - size: optional number of tile rows and columns in each bundle.
+          Defaults to 4, ideally the same as your metatile rows and columns.
+
+        Where the Disk cache stores each tile in its own file, this cache
+        stores a square block of tiles together, cutting down on files and
+        directories at high zoom levels. Each bundle file starts with a
+        fixed-size index of tile offsets, lengths and save times, so reading
+        a tile takes one read for the index and one for the tile body.
+        Saved tiles are appended to the bundle and their index entries
+        updated in place under an exclusive lock on the bundle directory,
+        which readers share while reading the index; bundles are compacted to a temporary file and
+        renamed into place once replaced tiles take up half their size.
+
+        For an example tile 12/656/1582.png, a bundle of size 4 is stored
+        as 12/164/395.png.bundle under a directory named for the layer.
+
+        If your configuration file is loaded from a remote location, e.g.
+        "http://example.com/tilestache.cfg", the path *must* be an unambiguous
+        filesystem path, e.g. "file:///tmp/cache"
+    """
+    magic = 'TSB2'
+    header = struct.Struct('<4sI')
+    entry = struct.Struct('<QId')
+
+    def __init__(self, path, umask=0022, size=4):
+        self.cachepath = path
+        self.umask = int(umask)
+        self.size = int(size)
+        self.index_length = self.header.size + self.entry.size * self.size ** 2
+
+    def _bundlepath(self, layer, coord, format):
+        """ Return full bundle file path and tile index for a coordinate.
+        """
+        column, row = int(coord.column), int(coord.row)
+        bx, by = column // self.size, row // self.size
+        index = (row % self.size) * self.size + (column % self.size)
+
+        filename = '%d.%s.bundle' % (by, format.lower())
+        filepath = os.sep.join( (layer.name(), '%d' % coord.zoom, '%d' % bx, filename) )
+
+        return pathjoin(self.cachepath, filepath), index
+
+    def _lockpath(self, layer, coord, format):
+        """
+        """
+        bundlepath, index = self._bundlepath(layer, coord, format)
+        return '%s-%d.lock' % (bundlepath, index)
+
+    def _check_header(self, data, bundlepath):
+        """
+        """
+        magic, size = self.header.unpack(data)
+
+        if magic != self.magic or size != self.size:
+            raise KnownUnknown('Bundle file "%s" does not match this Bundle cache, with size %d' % (bundlepath, self.size))
+
+    def _read_index(self, data, bundlepath):
+        """ Return a list of (offset, length, saved) tuples from a bundle index.
+        """
+        self._check_header(data[:self.header.size], bundlepath)
+        starts = range(self.header.size, self.index_length, self.entry.size)
+
+        return [self.entry.unpack(data[start:start + self.entry.size]) for start in starts]
+
+    def _compact(self, fd, bundlepath):
+        """ Atomically replace a bundle with a copy holding only its live tiles.
+        """
+        os.lseek(fd, 0, os.SEEK_SET)
+        data = os.read(fd, os.fstat(fd).st_size)
+
+        index, bodies = [self.header.pack(self.magic, self.size)], []
+        offset = self.index_length
+
+        for (start, length, saved) in self._read_index(data, bundlepath):
+            if length:
+                index.append(self.entry.pack(offset, length, saved))
+                bodies.append(data[start:start + length])
+                offset += length
+            else:
+                index.append(self.entry.pack(0, 0, 0))
+
+        # mkstemp() files are private, so open them up before they're seen.
+        fh, tmp_path = mkstemp(dir=self.cachepath, suffix='.bundle')
+        os.write(fh, ''.join(index + bodies))
+        os.fchmod(fh, 0666&~self.umask)
+        os.close(fh)
+
+        try:
+            os.rename(tmp_path, bundlepath)
+        except OSError:
+            os.unlink(bundlepath)
+            os.rename(tmp_path, bundlepath)
+
+    def _update(self, layer, coord, format, body):
+        """ Replace one tile body in a bundle, None to remove it.
+
+            New bodies are appended to the end of the bundle before their
+            index entry is overwritten in place, so a save costs about as
+            much as the tile and readers see either the old or new tile.
+            Other tiles in the same bundle may be changed by other processes
+            at the same time, so a file lock is held throughout.
+        """
+        bundlepath, index = self._bundlepath(layer, coord, format)
+
+        try:
+            umask_old = os.umask(self.umask)
+            os.makedirs(dirname(bundlepath), 0777&~self.umask)
+        except OSError, e:
+            if e.errno != 17:
+                raise
+        finally:
+            os.umask(umask_old)
+
+        # lock the directory rather than the bundle, which gets compacted.
+        dirfd = os.open(dirname(bundlepath), os.O_RDONLY)
+
+        try:
+            fcntl.flock(dirfd, fcntl.LOCK_EX)
+            fd = os.open(bundlepath, os.O_RDWR|os.O_CREAT, 0666&~self.umask)
+
+            try:
+                if os.fstat(fd).st_size == 0:
+                    empty = self.entry.pack(0, 0, 0) * self.size ** 2
+                    os.write(fd, self.header.pack(self.magic, self.size) + empty)
+
+                if body:
+                    offset = os.lseek(fd, 0, os.SEEK_END)
+                    os.write(fd, body)
+                    entry = self.entry.pack(offset, len(body), time.time())
+                else:
+                    entry = self.entry.pack(0, 0, 0)
+
+                os.lseek(fd, self.header.size + index * self.entry.size, os.SEEK_SET)
+                os.write(fd, entry)
+
+                # replaced tiles leave dead space behind; compact the bundle
+                # once it's more than half dead, so the cost stays amortized.
+                os.lseek(fd, 0, os.SEEK_SET)
+                entries = self._read_index(os.read(fd, self.index_length), bundlepath)
+                live = self.index_length + sum([length for (o, length, s) in entries])
+
+                if os.fstat(fd).st_size > live * 2:
+                    self._compact(fd, bundlepath)
+
+            finally:
+                os.close(fd)
+
+        finally:
+            fcntl.flock(dirfd, fcntl.LOCK_UN)
+            os.close(dirfd)
+
+    def lock(self, layer, coord, format):
+        """ Acquire a cache lock for this tile.
+        
+            Returns nothing, but blocks until the lock has been acquired.
+            Lock is implemented as an empty directory next to the bundle file.
+        """
+        lockpath = self._lockpath(layer, coord, format)
+        due = time.time() + layer.stale_lock_timeout
+        
+        while True:
+            # try to acquire a directory lock, repeating if necessary.
+            try:
+                umask_old = os.umask(self.umask)
+                
+                if time.time() > due:
+                    # someone left the door locked.
+                    try:
+                        os.rmdir(lockpath)
+                    except OSError:
+                        # Oh - no they didn't.
+                        pass
+                
+                os.makedirs(lockpath, 0777&~self.umask)
+                break
+            except OSError, e:
+                if e.errno != 17:
+                    raise
+                time.sleep(.2)
+            finally:
+                os.umask(umask_old)
+    
+    def unlock(self, layer, coord, format):
+        """ Release a cache lock for this tile.
+
+            Lock is implemented as an empty directory next to the bundle file.
+        """
+        lockpath = self._lockpath(layer, coord, format)
+
+        try:
+            os.rmdir(lockpath)
+        except OSError:
+            # Ok, someone else deleted it already
+            pass
+        
+    def remove(self, layer, coord, format):
+        """ Remove a cached tile.
+        """
+        bundlepath, index = self._bundlepath(layer, coord, format)
+        
+        if exists(bundlepath):
+            self._update(layer, coord, format, None)
+        
+    def read(self, layer, coord, format):
+        """ Read a cached tile.
+        """
+        bundlepath, index = self._bundlepath(layer, coord, format)
+        
+        try:
+            file = open(bundlepath, 'rb')
+        except IOError, e:
+            # errno=2 means that the file does not exist, which is fine
+            if e.errno != 2:
+                raise
+            return None
+        
+        try:
+            # the whole index is small enough to come in one read, under a
+            # shared lock so that entries written by _update() aren't torn.
+            dirfd = os.open(dirname(bundlepath), os.O_RDONLY)
+
+            try:
+                fcntl.flock(dirfd, fcntl.LOCK_SH)
+                data = file.read(self.index_length)
+
+            finally:
+                fcntl.flock(dirfd, fcntl.LOCK_UN)
+                os.close(dirfd)
+
+            self._check_header(data[:self.header.size], bundlepath)
+            
+            start = self.header.size + index * self.entry.size
+            offset, length, saved = self.entry.unpack(data[start:start + self.entry.size])
+            
+            if not length:
+                return None
+            
+            # each tile keeps its own save time, since neighbors touch the file.
+            if layer.cache_lifespan and time.time() - saved > layer.cache_lifespan:
+                return None
+            
+            file.seek(offset)
+            return file.read(length)
+        
+        finally:
+            file.close()
+    
+    def save(self, body, layer, coord, format):
+        """ Save a cached tile.
+        """
+        self._update(layer, coord, format, body)
+
 class Multi:
     """ Caches tiles to multiple, ordered caches.
         
@@ -383,7 +665,8 @@ class Multi:
                      "name": "Disk",
                      "path": "/tmp/stache"
                   }
-              ]
+              ],
+              "hedge delay": 0.05
             }
 
         Multi cache parameters:
@@ -394,9 +677,21 @@ class Multi:
             most remote cache should be at the end. Memcache and S3 together
             make a great pair.
 
+          hedge delay
+            Optional number of seconds to wait on a tier before also starting
+            a read from the next one, in a separate thread. The first tile
+            found in tier order is returned, and a tier after the first that
+            is still busy after its delay is passed over if a later tier has
+            the tile. Results from tiers that finish too late are ignored.
+            The first tier is always waited for, so hedging helps between the
+            later tiers, e.g. a disk and S3 behind Memcache. Use 0 to start
+            reading from all later tiers while the first is read. Omit for
+            plain sequential reads.
+
     """
-    def __init__(self, tiers):
+    def __init__(self, tiers, hedge_delay=None):
         self.tiers = tiers
+        self.hedge_delay = hedge_delay
 
     def lock(self, layer, coord, format):
         """ Acquire a cache lock for this tile in the first tier.
@@ -423,6 +718,9 @@ class Multi:
             is found. When found, save it back to the earlier tiers for faster
             access on future requests.
         """
+        if self.hedge_delay is not None:
+            return self._hedged_read(layer, coord, format)
+
         for (index, cache) in enumerate(self.tiers):
             body = cache.read(layer, coord, format)
             
@@ -435,6 +733,98 @@ class Multi:
         
         return None
     
+    def _hedged_read(self, layer, coord, format):
+        """ Read a cached tile from overlapping tiers, see "hedge delay" above.
+        
+            The first tier, usually the fastest, is read in this thread and
+            later tiers each in their own. Tiers that came up empty get a copy
+            of the body, while tiers that are still busy are left alone because
+            they are probably the slow ones. A tier that raises an error is
+            logged and treated as empty, but a tile that left a note is raised
+            here in tier order, just like read() does.
+            
+            Python 2 waits on a condition with a timeout by polling, sleeping
+            up to 50ms at a time, so a hedge may start that much after its delay.
+        """
+        count = len(self.tiers)
+        cond = Condition()
+        started, finished = [None] * count, [False] * count
+        bodies, notes = [None] * count, [None] * count
+        
+        def read_tier(index):
+            body, note = None, None
+            
+            try:
+                body = self.tiers[index].read(layer, coord, format)
+            except TheTileLeftANote, e:
+                note = e
+            except Exception:
+                # a broken tier is treated as an empty one
+                logging.exception('TileStache.Caches.Multi._hedged_read() tier %d failed', index)
+            
+            with cond:
+                finished[index], bodies[index], notes[index] = True, body, note
+                cond.notify()
+        
+        def start_tier(index):
+            if index < count and started[index] is None:
+                started[index] = time.time()
+                thread = Thread(target=read_tier, args=(index, ))
+                thread.setDaemon(True)
+                thread.start()
+        
+        if self.hedge_delay <= 0:
+            # with no delay, later tiers start right away.
+            for index in range(1, count):
+                start_tier(index)
+        
+        started[0] = time.time()
+        read_tier(0)
+        
+        with cond:
+            while True:
+                found, wake_at = None, None
+                
+                for index in range(count):
+                    if finished[index] and (bodies[index] or notes[index]):
+                        found = index
+                        break
+                    
+                    elif finished[index]:
+                        # empty tier, so the next one is needed
+                        start_tier(index + 1)
+                        continue
+                    
+                    due = started[index] + self.hedge_delay
+                    
+                    if time.time() < due:
+                        # this tier still has time to respond
+                        wake_at = due
+                        break
+                    
+                    # this tier is slow, hedge with the next one
+                    start_tier(index + 1)
+                
+                if found is not None:
+                    break
+                
+                if False not in finished:
+                    return None
+                
+                cond.wait(wake_at and max(wake_at - time.time(), 0))
+            
+            if notes[found] is not None:
+                raise notes[found]
+            
+            body = bodies[found]
+            empties = [self.tiers[i] for i in range(found) if finished[i]]
+        
+        # save the body in earlier empty tiers for speedier access
+        for cache in empties:
+            cache.save(body, layer, coord, format)
+        
+        return body
+    
     def save(self, body, layer, coord, format):
         """ Save a cached tile.
         
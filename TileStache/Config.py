@@ -80,6 +80,7 @@ import Caches
 import Providers
 import Geography
 import PixelEffects
+import Encoders
 
 class Configuration:
     """ A complete site configuration, with a collection of Layer objects.
@@ -196,26 +197,64 @@ class BoundsList:
         # Nothing worked.
         return True
 
-def buildConfiguration(config_dict, dirpath='.'):
+def buildConfiguration(config_dict, dirpath='.', previous=None):
     """ Build a configuration dictionary into a Configuration object.
 
         The second argument is an optional dirpath that specifies where in the
         local filesystem the parsed dictionary originated, to make it possible
         to resolve relative paths. It might be a path or more likely a full
         URL including the "file://" prefix.
+
+        Optional previous argument is a (Configuration, dictionary) pair from
+        an earlier call, used to reload a changed configuration cheaply: the
+        cache is reused if its definition is unchanged, and so are layers with
+        unchanged definitions, keeping their providers. Reused layers are moved
+        to the new configuration, while the previous configuration keeps any
+        layers that were rebuilt for requests that are still using them.
+        Layers are only reused along with the cache, so requests in flight
+        never find their layer switched to a different cache.
     """
     scheme, h, path, p, q, f = urlparse(dirpath)
 
-    if scheme in ('', 'file'):
+    if scheme in ('', 'file') and path not in sys.path:
         sys.path.insert(0, path)
 
+    old_config, old_dict = previous or (None, {})
+
+    if old_config is not None and old_config.dirpath != dirpath:
+        # relative paths may mean something else now.
+        old_config, old_dict = None, {}
+
     cache_dict = config_dict.get('cache', {})
-    cache = _parseConfigCache(cache_dict, dirpath)
+
+    if old_config is not None and old_dict.get('cache', {}) == cache_dict:
+        cache = old_config.cache
+    else:
+        cache = _parseConfigCache(cache_dict, dirpath)
+        old_config, old_dict = None, {}
 
     config = Configuration(cache, dirpath)
+    old_layers = old_dict.get('layers', {})
 
     for (name, layer_dict) in config_dict.get('layers', {}).items():
-        config.layers[name] = _parseConfigLayer(layer_dict, config, dirpath)
+        if name in old_layers and old_layers[name] == layer_dict:
+            layer = old_config.layers[name]
+            layer.config = config
+        else:
+            layer = _parseConfigLayer(layer_dict, config, dirpath)
+
+        config.layers[name] = layer
+        layer.setName(name)
+
+        if 'half resolution layer' in layer_dict:
+            half_name = layer_dict['half resolution layer']
+
+            if half_name in config_dict['layers']:
+                raise Core.KnownUnknown('Layer "%s" is already the half resolution layer of "%s".' % (half_name, name))
+
+            layer.half_layer.config = config
+            config.layers[half_name] = layer.half_layer
+            layer.half_layer.setName(half_name)
 
     if 'index' in config_dict:
         index_href = urljoin(dirpath, config_dict['index'])
@@ -271,6 +310,7 @@ def _parseConfigCache(cache_dict, dirpath):
     """
     if 'name' in cache_dict:
         _class = Caches.getCacheByName(cache_dict['name'])
+        _module = _class.__module__
         kwargs = {}
 
         def add_kwargs(*keys):
@@ -292,23 +332,40 @@ def _parseConfigCache(cache_dict, dirpath):
 
             add_kwargs('dirs', 'gzip')
 
+        elif _class is Caches.Bundle:
+            kwargs['path'] = enforcedLocalPath(cache_dict['path'], dirpath, 'Bundle cache path')
+
+            if 'umask' in cache_dict:
+                kwargs['umask'] = int(cache_dict['umask'], 8)
+
+            add_kwargs('size')
+
         elif _class is Caches.Multi:
             kwargs['tiers'] = [_parseConfigCache(tier_dict, dirpath)
                                for tier_dict in cache_dict['tiers']]
 
-        elif _class is Caches.Memcache.Cache:
+            if 'hedge delay' in cache_dict:
+                kwargs['hedge_delay'] = float(cache_dict['hedge delay'])
+
+        elif _module == 'TileStache.Memcache':
             if 'key prefix' in cache_dict:
                 kwargs['key_prefix'] = cache_dict['key prefix']
 
             add_kwargs('servers', 'lifespan', 'revision')
 
-        elif _class is Caches.Redis.Cache:
+        elif _module == 'TileStache.Redis':
             if 'key prefix' in cache_dict:
                 kwargs['key_prefix'] = cache_dict['key prefix']
 
             add_kwargs('host', 'port', 'db')
 
-        elif _class is Caches.S3.Cache:
+        elif _module == 'TileStache.LMDB':
+            kwargs['path'] = enforcedLocalPath(cache_dict['path'], dirpath, 'LMDB cache path')
+
+            if 'map size' in cache_dict:
+                kwargs['map_size'] = int(cache_dict['map size'])
+
+        elif _module == 'TileStache.S3':
             add_kwargs('bucket', 'access', 'secret', 'use_locks', 'path', 'reduced_redundancy', 'policy')
 
         else:
@@ -374,6 +431,12 @@ def _parseConfigLayer(layer_dict, config, dirpath):
     if 'tile height' in layer_dict:
         layer_kwargs['tile_height'] = int(layer_dict['tile height'])
 
+    if 'server timing' in layer_dict:
+        layer_kwargs['server_timing'] = bool(layer_dict['server timing'])
+
+    if 'recent objects lifespan' in layer_dict:
+        layer_kwargs['recent_objects_lifespan'] = int(layer_dict['recent objects lifespan'])
+
     if 'preview' in layer_dict:
         preview_dict = layer_dict['preview']
 
@@ -403,7 +466,7 @@ def _parseConfigLayer(layer_dict, config, dirpath):
     meta_dict = layer_dict.get('metatile', {})
     metatile_kwargs = {}
 
-    for k in ('buffer', 'rows', 'columns'):
+    for k in ('buffer', 'rows', 'columns', 'threads'):
         if k in meta_dict:
             metatile_kwargs[k] = int(meta_dict[k])
 
@@ -438,22 +501,37 @@ def _parseConfigLayer(layer_dict, config, dirpath):
                     pixel_effect_kwargs[str(k)] = float(v)
             PixelEffectClass = PixelEffects.all[pixel_effect_name]
             pixel_effect = PixelEffectClass(**pixel_effect_kwargs)
+
     #
-    # Do the provider
+    # Do encoder profiles
     #
 
-    provider_dict = layer_dict['provider']
+    encoders = {}
 
-    if 'name' in provider_dict:
-        _class = Providers.getProviderByName(provider_dict['name'])
-        provider_kwargs = _class.prepareKeywordArgs(provider_dict)
+    for encoder_dict in layer_dict.get('encoders', []):
+        if type(encoder_dict) is not dict:
+            encoder_dict = {'name': encoder_dict}
 
-    elif 'class' in provider_dict:
-        _class = loadClassPath(provider_dict['class'])
-        provider_kwargs = provider_dict.get('kwargs', {})
-        provider_kwargs = dict( [(str(k), v) for (k, v) in provider_kwargs.items()] )
+        encoder_name = encoder_dict.get('name')
 
-    else:
+        if encoder_name not in Encoders.all:
+            raise Core.KnownUnknown('Unknown encoder profile "%s", try one of %s.' % (encoder_name, ', '.join(sorted(Encoders.all))))
+
+        encoder_kwargs = dict([(str(k), v) for (k, v) in encoder_dict.items() if k != 'name'])
+        encoder = Encoders.all[encoder_name](**encoder_kwargs)
+
+        if encoder.format in encoders:
+            raise Core.KnownUnknown('Only one encoder profile can be used for each format, not two for %s.' % encoder.format)
+
+        encoders[encoder.format] = encoder
+
+    #
+    # Do the provider
+    #
+
+    provider_dict = layer_dict['provider']
+
+    if 'name' not in provider_dict and 'class' not in provider_dict:
         raise Exception('Missing required provider name or class: %s' % json_dumps(provider_dict))
 
     #
@@ -461,13 +539,58 @@ def _parseConfigLayer(layer_dict, config, dirpath):
     #
 
     layer = Core.Layer(config, projection, metatile, **layer_kwargs)
-    layer.provider = _class(layer, **provider_kwargs)
+    layer.setProviderFactory(lambda layer: _buildLayerProvider(layer, provider_dict))
     layer.setSaveOptionsJPEG(**jpeg_kwargs)
     layer.setSaveOptionsPNG(**png_kwargs)
     layer.pixel_effect = pixel_effect
+    layer.encoders = encoders
+
+    if 'half resolution layer' in layer_dict:
+        layer.half_layer = _parseHalfLayer(layer_dict, layer, config, dirpath)
 
     return layer
 
+def _parseHalfLayer(layer_dict, layer, config, dirpath):
+    """ Used by _parseConfigLayer() to build a layer's half resolution layer.
+
+        The half layer has the same options with half the tile height and
+        metatile buffer, and renders through the full resolution layer.
+    """
+    meta_dict = dict(layer_dict.get('metatile', {}))
+    buffer = int(meta_dict.get('buffer', 0))
+
+    if layer.dim % 2 or buffer % 2:
+        raise Core.KnownUnknown('Layers with a half resolution layer need an even tile height and metatile buffer, not %d and %d.' % (layer.dim, buffer))
+
+    meta_dict['buffer'] = buffer / 2
+
+    half_dict = dict(layer_dict)
+    half_dict.update({'tile height': layer.dim / 2, 'metatile': meta_dict})
+    del half_dict['half resolution layer']
+
+    half_layer = _parseConfigLayer(half_dict, config, dirpath)
+    half_layer.setProviderFactory(lambda half_layer: layer.provider)
+    half_layer.double_layer = layer
+
+    return half_layer
+
+def _buildLayerProvider(layer, provider_dict):
+    """ Used by layers parsed in _parseConfigLayer() to build their providers.
+
+        Called on first use of each layer's provider, so that provider
+        modules are imported and providers built only when they're needed.
+    """
+    if 'name' in provider_dict:
+        _class = Providers.getProviderByName(provider_dict['name'])
+        provider_kwargs = _class.prepareKeywordArgs(provider_dict)
+
+    else:
+        _class = loadClassPath(provider_dict['class'])
+        provider_kwargs = provider_dict.get('kwargs', {})
+        provider_kwargs = dict( [(str(k), v) for (k, v) in provider_kwargs.items()] )
+
+    return _class(layer, **provider_kwargs)
+
 def loadClassPath(classpath):
     """ Load external class based on a path.
 
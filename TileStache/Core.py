@@ -25,8 +25,13 @@ configuration file as a dictionary:
           "maximum cache age": ...,
           "redirects": ...,
           "tile height": ...,
+          "half resolution layer": ...,
           "jpeg options": ...,
-          "png options": ...
+          "png options": ...,
+          "pixel effect": ...,
+          "encoders": ...,
+          "server timing": ...,
+          "recent objects lifespan": ...
         }
       }
     }
@@ -51,7 +56,8 @@ configuration file as a dictionary:
   altogether. This is defined on a per-layer basis. Defaults to true if omitted.
 - "bounds" is an optional dictionary of six tile boundaries to limit the
   rendered area: low (lowest zoom level), high (highest zoom level), north,
-  west, south, and east (all in degrees).
+  west, south, and east (all in degrees). Tiles outside the bounds get an
+  empty 404 response without touching the cache.
 - "allowed origin" is an optional string that shows up in the response HTTP
   header Access-Control-Allow-Origin, useful for when you need to provide
   javascript direct access to response data such as GeoJSON or pixel values.
@@ -69,13 +75,36 @@ configuration file as a dictionary:
 - "tile height" gives the height of the image tile in pixels. You almost always
   want to leave this at the default value of 256, but you can use a value of 512
   to create double-size, double-resolution tiles for high-density phone screens.
+- "half resolution layer" optionally names another layer with the same tiles
+  at half the height, e.g. "example-name" for a layer "example-name@2x" with
+  a tile height of 512 and a Mapnik "scale factor" of 2. Each render is
+  downsampled to make tiles for both layers, and both are saved, so
+  high-density tiles cost one render instead of two. The tile height and any
+  metatile buffer must be even.
 - "jpeg options" is an optional dictionary of JPEG creation options, passed
   through to PIL: http://effbot.org/imagingbook/format-jpeg.htm.
 - "png options" is an optional dictionary of PNG creation options, passed
-  through to PIL: http://effbot.org/imagingbook/format-png.htm.
+  through to PIL: http://effbot.org/imagingbook/format-png.htm. Its
+  "palette256" option can be true for a generated palette in each tile,
+  "metatile" for one palette shared by all the tiles of a metatile, or
+  "zoom" to reuse the first metatile's palette at each zoom level. A "zoom"
+  palette is kept for the life of the process, so it won't pick up changed
+  colors in the layer's data or style until the server is restarted.
 - "pixel effect" is an optional dictionary that defines an effect to be applied
    for all tiles of this layer. Pixel effect can be any of these: blackwhite,
   greyscale, desaturate, pixelate, halftone, or blur.
+- "encoders" is an optional list of named encoder profiles that trade encoding
+  time against tile size, and add WebP output. Profiles can be any of these:
+  png-fast, png-small, png-quantized, webp-lossy, or webp-lossless. See
+  TileStache.Encoders for details.
+- "server timing" is an optional boolean value to add a Server-Timing HTTP
+  response header with the time taken by each stage of producing a tile, for
+  diagnosing slow tiles from browser developer tools or CDN logs. Defaults to
+  false if omitted.
+- "recent objects lifespan" is an optional number of seconds that tiles used
+  by compositing providers are kept in memory, see Layer.getTileObject().
+  Removed or expired cache entries aren't noticed until then, and no longer
+  than the cache lifespan. Defaults to 300, or 0 to turn it off.
 
 The public-facing URL of a single tile for this layer might look like this:
 
@@ -128,6 +157,11 @@ represented in the configuration file as a dictionary:
   bit extra around the edges to ensure that text is not cut off. This example
   metatile has a buffer of 64 pixels, so the resulting metatile will be 1152
   pixels square: 4 rows x 256 pixels + 2 x 64 pixel buffer.
+- "threads" is an optional number of threads used to crop and encode the
+  tiles of a metatile once it's been rendered, default 1. Encoding with PIL
+  happens outside Python's global lock, so large metatiles are sliced much
+  faster with more threads on multi-core machines, though each request
+  then uses several cores.
 
 The preview can be accessed through a URL like /<layer name>/preview.html:
 
@@ -147,9 +181,19 @@ import logging
 from wsgiref.headers import Headers
 from StringIO import StringIO
 from urlparse import urljoin
+from threading import RLock, Lock, Thread
+from collections import OrderedDict
+from Queue import Queue
+import sys
 from time import time
 
+try:
+    from json import loads as json_loads
+except ImportError:
+    from simplejson import loads as json_loads
+
 from Pixels import load_palette, apply_palette, apply_palette256
+import Metrics
 
 try:
     from PIL import Image
@@ -160,6 +204,37 @@ from ModestMaps.Core import Coordinate
 
 _recent_tiles = dict(hash={}, list=[])
 
+# recent tiles before encoding or after decoding, see Layer.getTileObject().
+_recent_objects, _recent_objects_lock = OrderedDict(), Lock()
+_recent_objects_size = 64
+
+# formats where a decoded tile is the same as the one that was encoded.
+_object_formats = 'PNG', 'JSON'
+
+# encoded tiles of a single color kept by each layer, see _encodeTile().
+_solid_tiles_size = 256
+_solid_modes = 'RGB', 'RGBA', 'L', 'LA'
+
+# seconds before a provider factory that failed is tried again, see Layer.
+_provider_retry = 30
+
+# stages of getting a tile, in order, for Server-Timing headers.
+_timing_stages = 'read', 'lock', 'provider', 'effects', 'slice', 'render', 'encode', 'save'
+
+def _addTiming(timings, stage, start_time):
+    """ Add time elapsed since start_time to a stage in a dictionary of timings.
+    """
+    if timings is not None:
+        timings[stage] = timings.get(stage, 0) + time() - start_time
+
+def serverTiming(timings):
+    """ Return a Server-Timing HTTP header value for a dictionary of timings.
+
+        Durations are given in milliseconds, see http://www.w3.org/TR/server-timing/
+    """
+    stages = [stage for stage in _timing_stages if stage in timings]
+    return ', '.join(['%s;dur=%.1f' % (stage, timings[stage] * 1000) for stage in stages])
+
 def _addRecentTile(layer, coord, format, body, age=300):
     """ Add the body of a tile to _recent_tiles with a timeout.
     """
@@ -210,6 +285,297 @@ def _getRecentTile(layer, coord, format):
 
     return None
 
+def _tileObject(tile, format, save_kwargs, encoder=None):
+    """ Return an object from render() as Layer.getTileObject() would decode it.
+
+        Returns None if the encoded tile might decode to something different.
+    """
+    if encoder is not None and not encoder.lossless:
+        # e.g. quantized by the encoder profile.
+        return None
+
+    if format == 'PNG' and isinstance(tile, Image.Image):
+        # a PNG transparency index is only known once the tile is encoded.
+        if 'transparency' not in save_kwargs:
+            return tile
+
+    elif format == 'JSON' and type(getattr(tile, 'content', None)) is dict:
+        # grid responses like TileStache.Mapnik.SaveableResponse.
+        return tile.content
+
+    return None
+
+def _decodeObject(body, format):
+    """ Decode the body of a tile to an object, for Layer.getTileObject().
+    """
+    if format == 'JSON':
+        return json_loads(body)
+
+    image = Image.open(StringIO(body))
+    image.load()
+
+    return image
+
+def _addRecentObject(layer, coord, format, tile):
+    """ Add a tile object to _recent_objects with the layer's timeout.
+
+        A tile of None removes any older object for the same tile. Objects
+        are kept no longer than cached tiles, for layers with a cache lifespan.
+    """
+    if format not in _object_formats:
+        return
+
+    key = (layer, coord, format)
+    age = layer.recent_objects_lifespan
+
+    if layer.cache_lifespan:
+        age = min(age, layer.cache_lifespan)
+
+    with _recent_objects_lock:
+        _recent_objects.pop(key, None)
+
+        if tile is None or not age:
+            return
+
+        _recent_objects[key] = tile, time() + age
+
+        while len(_recent_objects) > _recent_objects_size:
+            _recent_objects.popitem(last=False)
+
+def _getRecentObject(layer, coord, format):
+    """ Return a recent tile object, or None if it's not there.
+    """
+    key = (layer, coord, format)
+
+    with _recent_objects_lock:
+        tile, use_by = _recent_objects.pop(key, (None, 0))
+
+        # new enough? then it's the most recently used one.
+        if tile is not None and time() < use_by:
+            _recent_objects[key] = tile, use_by
+            return tile
+
+    return None
+
+def _solidColor(tile):
+    """ Return the color of a rendered tile with only one color, or None.
+
+        Asking PIL for at most one color stops at the second color it finds,
+        so most tiles with more than one are rejected quickly.
+    """
+    if not isinstance(tile, Image.Image) or tile.mode not in _solid_modes:
+        return None
+
+    colors = tile.getcolors(1)
+
+    return colors[0][1] if colors else None
+
+def _encodeTile(layer, tile, format, save_kwargs, encoder=None):
+    """ Encode a rendered tile and return its body.
+
+        Tiles of a single color, like water or empty overlays, are encoded
+        just once for each layer, format, color, and set of encoding options,
+        and kept in the layer.
+    """
+    color, key = _solidColor(tile), None
+
+    if color is not None:
+        profile = encoder and (encoder.__class__.__name__, tuple(sorted(encoder.save_kwargs.items())))
+        key = (format, tile.mode, tile.size, color, profile, tuple(sorted(save_kwargs.items())))
+
+        try:
+            hash(key)
+        except TypeError:
+            # e.g. a list in the save options, so don't keep this one.
+            key = None
+
+    if key in layer._solid_tiles:
+        return layer._solid_tiles[key]
+
+    buff = StringIO()
+
+    if encoder:
+        encoder.encode(tile, buff, save_kwargs)
+    else:
+        tile.save(buff, format, **save_kwargs)
+
+    body = buff.getvalue()
+
+    if key is not None and len(layer._solid_tiles) < _solid_tiles_size:
+        layer._solid_tiles[key] = body
+
+    return body
+
+def _saveOptions(layer, format):
+    """ Return a layer's PIL save options for a format.
+    """
+    if format.lower() == 'jpeg':
+        return layer.jpeg_options
+    elif format.lower() == 'png':
+        return layer.png_options
+    else:
+        return {}
+
+def _sliceSubtiles(layer, surtile, subtiles, format, palette256, threads, encoder=None):
+    """ Crop and encode tiles from a rendered metatile, several at a time.
+
+        Generates (coord, subtile, body) tuples in the order they finish.
+        Errors from any thread are raised here, in the calling thread.
+        Tiles are encoded by an optional profile from TileStache.Encoders.
+    """
+    def encode(other, x, y):
+        bbox = (x, y, x + layer.dim, y + layer.dim)
+        subtile = surtile.crop(bbox)
+        if palette256:
+            # this is where we have PIL optimally palette our image
+            subtile = apply_palette256(subtile)
+
+        return other, subtile, _encodeTile(layer, subtile, format, {}, encoder)
+
+    if threads <= 1 or len(subtiles) <= 1:
+        for (other, x, y) in subtiles:
+            yield encode(other, x, y)
+        return
+
+    if hasattr(surtile, 'load'):
+        # don't let threads race to load a lazy image.
+        surtile.load()
+
+    jobs, results = list(reversed(subtiles)), Queue()
+
+    def work():
+        while True:
+            try:
+                other, x, y = jobs.pop()
+            except IndexError:
+                # All done.
+                break
+
+            try:
+                results.put((encode(other, x, y), None))
+            except:
+                results.put((None, sys.exc_info()))
+
+    for i in range(min(threads, len(subtiles))):
+        thread = Thread(target=work)
+        thread.setDaemon(True)
+        thread.start()
+
+    try:
+        for i in range(len(subtiles)):
+            result, exc_info = results.get()
+
+            if exc_info is not None:
+                raise exc_info[0], exc_info[1], exc_info[2]
+
+            yield result
+
+    finally:
+        # stop the remaining threads early, after an error or when
+        # the caller stops asking for tiles.
+        del jobs[:]
+
+def _saveTile(layer, coord, format, tile):
+    """ Save a finished tile that Layer.render() made along with the one requested.
+
+        Tiles sliced from a metatile are already saved by _finishTile().
+    """
+    if layer.doMetatile():
+        return
+
+    save_kwargs, encoder = _saveOptions(layer, format), layer.encoders.get(format)
+    body = _encodeTile(layer, tile, format, save_kwargs, encoder)
+
+    if layer.write_cache:
+        layer.config.cache.save(body, layer, coord, format)
+
+    _addRecentTile(layer, coord, format, body)
+    _addRecentObject(layer, coord, format, _tileObject(tile, format, save_kwargs, encoder))
+
+def _combinedFormat(tiles, format):
+    """ Return the key for a format in tiles rendered together, see Layer.render().
+
+        An image stands in for other image formats, e.g. a "PNG" tile is used
+        to make JPEG tiles.
+    """
+    if format in tiles or format == 'JSON':
+        return format
+
+    return 'PNG'
+
+def _finishTile(layer, coord, format, tile, subtiles, pass_through, timings):
+    """ Apply palettes and effects to a rendered tile, and slice it if needed.
+
+        Returns the tile for coord. Tiles sliced from a metatile are saved
+        to the cache and kept in memory as they're finished.
+    """
+    effects_time = time()
+
+    if layer.bitmap_palette:
+        # this is where we apply the palette if there is one
+
+        if pass_through:
+            raise KnownUnknown('Cannot apply palette in pass_through mode')
+
+        if format.lower() == 'png':
+            t_index = layer.png_options.get('transparency', None)
+            tile = apply_palette(tile, layer.bitmap_palette, t_index)
+
+    if layer.pixel_effect:
+        # this is where we apply the pixel effect if there is one
+
+        if pass_through:
+            raise KnownUnknown(
+                'Cannot apply pixel effect in pass_through mode'
+            )
+
+        # if tile is an image
+        if format.lower() in ('png', 'jpeg', 'tiff', 'bmp', 'gif'):
+            tile = layer.pixel_effect.apply(tile)
+
+    palette256 = format.lower() == 'png' and layer.palette256
+
+    if layer.doMetatile() and palette256 in ('metatile', 'zoom'):
+        # palette the whole metatile once, so its tiles all share colors.
+        palette = layer._palettes256.get(coord.zoom) if palette256 == 'zoom' else None
+        tile = apply_palette256(tile, palette)
+
+        if palette256 == 'zoom' and palette is None:
+            # a single pixel keeps the palette for later metatiles,
+            # for as long as this process lives; see "png options".
+            layer._palettes256.setdefault(coord.zoom, tile.crop((0, 0, 1, 1)))
+
+    _addTiming(timings, 'effects', effects_time)
+
+    if layer.doMetatile():
+        slice_time, save_elapsed = time(), 0
+
+        # tile will be set again later
+        tile, surtile = None, tile
+
+        encoder = layer.encoders.get(format)
+        sliced = _sliceSubtiles(layer, surtile, subtiles, format, palette256 is True, layer.metatile.threads, encoder)
+
+        for (other, subtile, body) in sliced:
+            # cache writes stay in this thread, as each tile is finished.
+            if layer.write_cache:
+                save_time = time()
+                layer.config.cache.save(body, layer, other, format)
+                _addTiming(timings, 'save', save_time)
+                save_elapsed += time() - save_time
+
+            if other == coord:
+                # the one that actually gets returned
+                tile = subtile
+
+            _addRecentTile(layer, other, format, body)
+            _addRecentObject(layer, other, format, _tileObject(subtile, format, {}, encoder))
+
+        # saves are timed on their own, leaving cropping and encoding.
+        _addTiming(timings, 'slice', slice_time + save_elapsed)
+
+    return tile
+
 class Metatile:
     """ Some basic characteristics of a metatile.
 
@@ -217,15 +583,18 @@ class Metatile:
         - rows: number of tile rows this metatile covers vertically.
         - columns: number of tile columns this metatile covers horizontally.
         - buffer: pixel width of outer edge.
+        - threads: number of threads to slice and encode tiles with.
     """
-    def __init__(self, buffer=0, rows=1, columns=1):
+    def __init__(self, buffer=0, rows=1, columns=1, threads=1):
         assert rows >= 1
         assert columns >= 1
         assert buffer >= 0
+        assert threads >= 1
 
         self.rows = rows
         self.columns = columns
         self.buffer = buffer
+        self.threads = threads
 
     def isForReal(self):
         """ Return True if this is really a metatile with a buffer or multiple tiles.
@@ -267,7 +636,9 @@ class Layer:
         Required attributes:
 
           provider:
-            Render provider, see Providers module.
+            Render provider, see Providers module. Configuration files
+            give each layer a provider factory instead, so the provider
+            is only built when it's first used; see setProviderFactory().
 
           config:
             Configuration instance, see Config module.
@@ -317,9 +688,15 @@ class Layer:
             Height of tile in pixels, as a single integer. Tiles are generally
             assumed to be square, and Layer.render() will respond with an error
             if the rendered image is not this height.
+
+          server_timing:
+            Add a Server-Timing HTTP response header with per-stage timings, default false.
+
+          recent_objects_lifespan:
+            Number of seconds that tile objects are kept for getTileObject(), default 300.
     """
-    def __init__(self, config, projection, metatile, stale_lock_timeout=15, cache_lifespan=None, write_cache=True, allowed_origin=None, max_cache_age=None, redirects=None, preview_lat=37.80, preview_lon=-122.26, preview_zoom=10, preview_ext='png', bounds=None, tile_height=256):
-        self.provider = None
+    def __init__(self, config, projection, metatile, stale_lock_timeout=15, cache_lifespan=None, write_cache=True, allowed_origin=None, max_cache_age=None, redirects=None, preview_lat=37.80, preview_lon=-122.26, preview_zoom=10, preview_ext='png', bounds=None, tile_height=256, server_timing=False, recent_objects_lifespan=300):
+        self._provider_factory = None
         self.config = config
         self.projection = projection
         self.metatile = metatile
@@ -330,6 +707,8 @@ class Layer:
         self.allowed_origin = allowed_origin
         self.max_cache_age = max_cache_age
         self.redirects = redirects or dict()
+        self.server_timing = server_timing
+        self.recent_objects_lifespan = recent_objects_lifespan
 
         self.preview_lat = preview_lat
         self.preview_lon = preview_lon
@@ -340,35 +719,116 @@ class Layer:
         self.dim = tile_height
 
         self.bitmap_palette = None
+        self.palette256 = None
         self.jpeg_options = {}
         self.png_options = {}
         self.pixel_effect = None
 
+        # encoder profiles by format, see TileStache.Encoders.
+        self.encoders = {}
+
+        # encoded tiles of a single color, see _encodeTile().
+        self._solid_tiles = {}
+
+        # encoded empty tiles for requests outside the bounds, by format and size.
+        self._empty_tiles = {}
+
+        # generated palettes by zoom level, for palette256 "zoom".
+        self._palettes256 = {}
+
+        # layers with tiles at half and double this resolution, see render().
+        self.half_layer = None
+        self.double_layer = None
+
+        # held while the provider is built, and the error if building it failed.
+        self._provider_lock = RLock()
+        self._provider_error, self._provider_failed = None, 0
+
+        # name given by the configuration that built this layer, see setName().
+        self._name = None
+
+    def __getattr__(self, name):
+        """ Build the provider from its factory on first use of layer.provider.
+
+            Called only for attributes that aren't already set, so this
+            costs nothing once the provider exists or has been assigned.
+            A factory that fails, e.g. with a database briefly down, is
+            tried again after _provider_retry seconds; until then its error
+            is raised again for each use without calling the factory.
+        """
+        if name != 'provider':
+            raise AttributeError(name)
+
+        with self._provider_lock:
+            if self._provider_error is not None:
+                if time() < self._provider_failed + _provider_retry:
+                    raise self._provider_error
+
+                self._provider_error = None
+
+            if 'provider' not in self.__dict__:
+                factory = self._provider_factory
+
+                try:
+                    self.provider = factory and factory(self)
+                except Exception, e:
+                    logging.error('TileStache.Core.Layer failed to build a provider, trying again in %d seconds: %s', _provider_retry, e)
+                    self._provider_error, self._provider_failed = e, time()
+                    raise
+
+        return self.__dict__['provider']
+
+    def setProviderFactory(self, factory):
+        """ Set a function that returns a provider given this layer.
+
+            Providers can be slow to build, loading stylesheets and fonts or
+            importing large libraries, so configurations with many layers
+            use this to build each one only when its layer is first used.
+        """
+        self._provider_factory = factory
+
+    def setName(self, name):
+        """ Remember the name this layer has in its configuration.
+
+            Called when configurations are built, so that name() can skip
+            searching config.layers on each tile request.
+        """
+        self._name = name
+
     def name(self):
         """ Figure out what I'm called, return a name if there is one.
 
-            Layer names are stored in the Configuration object, so
-            config.layers must be inspected to find a matching name.
+            Layer names are stored in the Configuration object, so unless
+            setName() was called config.layers must be inspected to find
+            a matching name.
         """
+        if self._name is not None:
+            return self._name
+
         for (name, layer) in self.config.layers.items():
             if layer is self:
                 return name
 
         return None
 
-    def getTileResponse(self, coord, extension, ignore_cached=False):
+    def getTileResponse(self, coord, extension, ignore_cached=False, timings=None):
         """ Get status code, headers, and a tile binary for a given request layer tile.
 
             Arguments:
             - coord: one ModestMaps.Core.Coordinate corresponding to a single tile.
             - extension: filename extension to choose response type, e.g. "png" or "jpg".
             - ignore_cached: always re-render the tile, whether it's in the cache or not.
+            - timings: optional dictionary to fill with seconds taken by each stage,
+              e.g. "read", "lock", "render", "encode", or "save".
 
             This is the main entry point, after site configuration has been loaded
             and individual tiles need to be rendered.
         """
         start_time = time()
 
+        if timings is None:
+            timings = {}
+
         mimetype, format = self.getTypeByExtension(extension)
 
         # default response values
@@ -377,9 +837,25 @@ class Layer:
         body = None
 
         cache = self.config.cache
+        save_kwargs = _saveOptions(self, format)
+        encoder = self.encoders.get(format)
+
+        if self.bounds and self.bounds.excludes(coord):
+            # Outside the bounds, there's no need for the cache or a lock.
+            body = self._empty_tiles.get((format, self.dim))
 
-        if not ignore_cached:
+            if body is None:
+                empty = Image.new('RGBA', (self.dim, self.dim), (0, 0, 0, 0))
+                body = _encodeTile(self, empty, format, save_kwargs, encoder)
+                self._empty_tiles[(format, self.dim)] = body
+
+            status_code = 404
+            tile_from = 'out of bounds'
+
+        elif not ignore_cached:
             # Start by checking for a tile in the cache.
+            read_time = time()
+
             try:
                 body = cache.read(self, coord, format)
             except TheTileLeftANote, e:
@@ -390,6 +866,7 @@ class Layer:
                 if e.emit_content_type:
                     headers.setdefault('Content-Type', mimetype)
 
+            _addTiming(timings, 'read', read_time)
             tile_from = 'cache'
 
         else:
@@ -407,41 +884,48 @@ class Layer:
                     lockCoord = self.metatile.firstCoord(coord)
 
                     # We may need to write a new tile, so acquire a lock.
+                    lock_time = time()
                     cache.lock(self, lockCoord, format)
+                    _addTiming(timings, 'lock', lock_time)
 
                 if not ignore_cached:
                     # There's a chance that some other process has
                     # written the tile while the lock was being acquired.
+                    read_time = time()
                     body = cache.read(self, coord, format)
+                    _addTiming(timings, 'read', read_time)
                     tile_from = 'cache after all'
 
                 if body is None:
                     # No one else wrote the tile, do it here.
-                    buff = StringIO()
+                    render_time = time()
 
                     try:
-                        tile = self.render(coord, format)
+                        tile = self.render(coord, format, timings)
                         save = True
                     except NoTileLeftBehind, e:
                         tile = e.tile
                         save = False
                         status_code = 404
 
+                    _addTiming(timings, 'render', render_time)
+
                     if not self.write_cache:
                         save = False
 
-                    if format.lower() == 'jpeg':
-                        save_kwargs = self.jpeg_options
-                    elif format.lower() == 'png':
-                        save_kwargs = self.png_options
-                    else:
-                        save_kwargs = {}
+                    encode_time = time()
+                    body = _encodeTile(self, tile, format, save_kwargs, encoder)
+                    _addTiming(timings, 'encode', encode_time)
 
-                    tile.save(buff, format, **save_kwargs)
-                    body = buff.getvalue()
+                    if status_code == 200:
+                        _addRecentObject(self, coord, format, _tileObject(tile, format, save_kwargs, encoder))
+                    else:
+                        _addRecentObject(self, coord, format, None)
 
                     if save:
+                        save_time = time()
                         cache.save(body, self, coord, format)
+                        _addTiming(timings, 'save', save_time)
 
                     tile_from = 'layer.render()'
 
@@ -459,16 +943,51 @@ class Layer:
                     cache.unlock(self, lockCoord, format)
 
         _addRecentTile(self, coord, format, body)
-        logging.info('TileStache.Core.Layer.getTileResponse() %s/%d/%d/%d.%s via %s in %.3f', self.name(), coord.zoom, coord.column, coord.row, extension, tile_from, time() - start_time)
+        elapsed = time() - start_time
+
+        Metrics.recordTile(self, coord, format, tile_from, timings, elapsed, body)
+        logging.info('TileStache.Core.Layer.getTileResponse() %s/%d/%d/%d.%s via %s in %.3f', self.name(), coord.zoom, coord.column, coord.row, extension, tile_from, elapsed)
 
         return status_code, headers, body
 
+    def getTileObject(self, coord, extension):
+        """ Get a tile for a coordinate as an object instead of a binary.
+
+            For compositing providers, which use other layers' tiles and would
+            otherwise decode them right away. PNG tiles are PIL Image objects
+            and JSON tiles are parsed JSON. Tiles that were rendered or used
+            recently in this process are returned straight from memory, without
+            encoding and decoding, for up to the layer's recent objects lifespan.
+            Others come from getTileResponse() and are decoded once.
+
+            Returned objects are shared, so they must not be modified.
+        """
+        mimetype, format = self.getTypeByExtension(extension)
+        start_time = time()
+
+        tile = _getRecentObject(self, coord, format)
+
+        if tile is not None:
+            Metrics.recordTile(self, coord, format, 'recent objects', {}, time() - start_time, None)
+            return tile
+
+        status_code, headers, body = self.getTileResponse(coord, extension)
+        tile = _getRecentObject(self, coord, format)
+
+        if tile is None:
+            tile = _decodeObject(body, format)
+
+            if status_code == 200:
+                _addRecentObject(self, coord, format, tile)
+
+        return tile
+
     def doMetatile(self):
         """ Return True if we have a real metatile and the provider is OK with it.
         """
         return self.metatile.isForReal() and hasattr(self.provider, 'renderArea')
 
-    def render(self, coord, format):
+    def render(self, coord, format, timings=None):
         """ Render a tile for a coordinate, return PIL Image-like object.
 
             Perform metatile slicing here as well, if required, writing the
@@ -476,6 +995,38 @@ class Layer:
 
             Note that metatiling and pass-through mode of a Provider
             are mutually exclusive options
+
+            Optional timings dictionary is filled with seconds taken by the
+            "provider", "effects" (palette and pixel effect), "slice"
+            (metatile cropping and encoding) and "save" (metatile tiles
+            saved to the cache) stages.
+
+            Providers can render several formats at once by returning an
+            object with a "formats" dictionary of tiles, e.g. {"PNG": image,
+            "JSON": grid}. The tile for the requested format is returned,
+            and the others are saved to the cache alongside it.
+
+            A layer with a half_layer also downsamples each render to make
+            that layer's tiles, and saves them too. The half layer's own
+            tiles are rendered by its double_layer, so one render at double
+            size makes the tiles of both.
+        """
+        if self.double_layer is not None:
+            tile, half_tile = self.double_layer._render(coord, format, timings)
+
+            if half_tile is None:
+                raise KnownUnknown('Only images can be made at half resolution, not %s.' % format)
+
+            _saveTile(self.double_layer, coord, format, tile)
+            return half_tile
+
+        tile, half_tile = self._render(coord, format, timings)
+        return tile
+
+    def _render(self, coord, format, timings):
+        """ Render a tile for a coordinate, and its half_layer tile if there is one.
+
+            Returns a tuple of two tiles, the second one None without a half_layer.
         """
         if self.bounds and self.bounds.excludes(coord):
             raise NoTileLeftBehind(Image.new('RGBA', (self.dim, self.dim), (0, 0, 0, 0)))
@@ -485,7 +1036,7 @@ class Layer:
         width, height = self.dim, self.dim
 
         provider = self.provider
-        metatile = self.metatile
+        subtiles = None
         pass_through = provider.pass_through if hasattr(provider, 'pass_through') else False
 
 
@@ -500,6 +1051,8 @@ class Layer:
 
             subtiles = self.metaSubtiles(coord)
 
+        provider_time = time()
+
         if self.doMetatile() or hasattr(provider, 'renderArea'):
             # draw an area, defined in projected coordinates
             tile = provider.renderArea(width, height, srs, xmin, ymin, xmax, ymax, coord.zoom)
@@ -512,59 +1065,46 @@ class Layer:
         else:
             raise KnownUnknown('Your provider lacks renderTile and renderArea methods.')
 
+        _addTiming(timings, 'provider', provider_time)
+
+        if hasattr(tile, 'formats'):
+            # several formats from one render, e.g. an image and its UTF Grid.
+            others = dict(tile.formats)
+            tile = others.pop(_combinedFormat(others, format), None)
+
+            if tile is None:
+                raise KnownUnknown('Your provider rendered %s tiles, but not %s.' % (', '.join(sorted(others)), format))
+        else:
+            others = {}
+
         if not hasattr(tile, 'save'):
             raise KnownUnknown('Return value of provider.renderArea() must act like an image; e.g. have a "save" method.')
 
         if hasattr(tile, 'size') and tile.size[1] != height:
             raise KnownUnknown('Your provider returned the wrong image size: %s instead of %d pixels tall.' % (repr(tile.size), self.dim))
 
-        if self.bitmap_palette:
-            # this is where we apply the palette if there is one
-
-            if pass_through:
-                raise KnownUnknown('Cannot apply palette in pass_through mode')
-
-            if format.lower() == 'png':
-                t_index = self.png_options.get('transparency', None)
-                tile = apply_palette(tile, self.bitmap_palette, t_index)
-
-        if self.pixel_effect:
-            # this is where we apply the pixel effect if there is one
+        half_tile = None
 
-            if pass_through:
-                raise KnownUnknown(
-                    'Cannot apply pixel effect in pass_through mode'
-                )
-
-            # if tile is an image
-            if format.lower() in ('png', 'jpeg', 'tiff', 'bmp', 'gif'):
-                tile = self.pixel_effect.apply(tile)
-
-        if self.doMetatile():
-            # tile will be set again later
-            tile, surtile = None, tile
+        if self.half_layer is not None and isinstance(tile, Image.Image):
+            # one resize of the whole render, before effects and slicing.
+            half_size = self.half_layer.metaSize(coord) if self.half_layer.doMetatile() else (self.half_layer.dim, self.half_layer.dim)
+            half_tile = tile.resize(half_size, Image.ANTIALIAS)
 
-            for (other, x, y) in subtiles:
-                buff = StringIO()
-                bbox = (x, y, x + self.dim, y + self.dim)
-                subtile = surtile.crop(bbox)
-                if self.palette256:
-                    # this is where we have PIL optimally palette our image
-                    subtile = apply_palette256(subtile)
+        tile = _finishTile(self, coord, format, tile, subtiles, pass_through, timings)
 
-                subtile.save(buff, format)
-                body = buff.getvalue()
+        for (other_format, other_tile) in others.items():
+            # the other formats are saved too, so their requests find them ready.
+            other_tile = _finishTile(self, coord, other_format, other_tile, subtiles, pass_through, timings)
+            _saveTile(self, coord, other_format, other_tile)
 
-                if self.write_cache:
-                    self.config.cache.save(body, self, other, format)
+        if half_tile is not None:
+            half_layer = self.half_layer
+            half_subtiles = half_layer.metaSubtiles(coord) if half_layer.doMetatile() else None
 
-                if other == coord:
-                    # the one that actually gets returned
-                    tile = subtile
+            half_tile = _finishTile(half_layer, coord, format, half_tile, half_subtiles, pass_through, timings)
+            _saveTile(half_layer, coord, format, half_tile)
 
-                _addRecentTile(self, other, format, body)
-
-        return tile
+        return tile, half_tile
 
     def envelope(self, coord):
         """ Projected rendering envelope (xmin, ymin, xmax, ymax) for a Coordinate.
@@ -627,6 +1167,10 @@ class Layer:
     def getTypeByExtension(self, extension):
         """ Get mime-type and PIL format by file extension.
         """
+        for encoder in self.encoders.values():
+            if extension.lower() == encoder.extension:
+                return encoder.mimetype, encoder.format
+
         if hasattr(self.provider, 'getTypeByExtension'):
             return self.provider.getTypeByExtension(extension)
 
@@ -639,6 +1183,24 @@ class Layer:
         else:
             raise KnownUnknown('Unknown extension in configuration: "%s"' % extension)
 
+    def negotiateExtension(self, extension, accept):
+        """ Choose an extension for a client's HTTP Accept header.
+
+            PNG and JPEG tiles are served as WebP to clients that accept it,
+            if this layer has a WebP encoder profile. Returns an extension and
+            a boolean for whether the response depends on the Accept header.
+        """
+        if extension.lower() not in ('png', 'jpg') or 'WEBP' not in self.encoders:
+            return extension, False
+
+        for media_range in (accept or '').split(','):
+            parts = [part.strip() for part in media_range.split(';')]
+
+            if parts[0] == 'image/webp' and 'q=0' not in parts and 'q=0.0' not in parts:
+                return self.encoders['WEBP'].extension, True
+
+        return extension, True
+
     def setSaveOptionsJPEG(self, quality=None, optimize=None, progressive=None):
         """ Optional arguments are added to self.jpeg_options for pickup when saving.
 
@@ -660,6 +1222,11 @@ class Layer:
             Palette argument is a URL relative to the configuration file,
             and it implies bits and optional transparency options.
 
+            Palette256 argument is true to generate a palette for each tile,
+            "metatile" to generate one for each whole metatile, or "zoom"
+            to generate one for the first metatile at each zoom level and
+            reuse it for the rest.
+
             More information about options:
                 http://effbot.org/imagingbook/format-png.htm
         """
@@ -675,10 +1242,14 @@ class Layer:
             if t_index is not None:
                 self.png_options['transparency'] = t_index
 
-        if palette256 is not None:
+        if palette256 is None:
+            self.palette256 = None
+        elif palette256 in ('metatile', 'zoom'):
+            self.palette256 = str(palette256)
+        elif palette256 == 'tile' or not isinstance(palette256, basestring):
             self.palette256 = bool(palette256)
         else:
-            self.palette256 = None
+            raise KnownUnknown('Unknown palette256 value "%s", try true, "metatile", or "zoom".' % palette256)
 
 class KnownUnknown(Exception):
     """ There are known unknowns. That is to say, there are things that we now know we don't know.
@@ -0,0 +1,128 @@
+""" Named encoder profiles that trade encoding time against tile size.
+
+Image tiles are normally saved by PIL with a layer's "png options" or "jpeg
+options". A layer can instead list encoder profiles, at most one for each
+format, which also adds formats such as WebP:
+
+    "encoders": ["png-fast", {"name": "webp-lossy", "quality": 70}]
+
+Profiles are given by name, or as a dictionary with a name and options
+that override the profile's own. Options are:
+
+- png-fast:
+  PNG with the quickest zlib compression, for layers where encoding time
+  matters more than size. Has an optional "compress_level" from 0 to 9,
+  default 1.
+
+- png-small:
+  PNG with the slowest, smallest zlib compression. Has an optional
+  "compress_level", default 9.
+
+- png-quantized:
+  PNG reduced to an optimized palette of 256 colors, much smaller for
+  most maps. Has an optional "compress_level", default 6.
+
+- webp-lossy:
+  WebP with lossy compression, like JPEG but with transparency. Has
+  optional "quality" from 0 to 100, default 80, and "method" from 0 (fast)
+  to 6 (small), default 4.
+
+- webp-lossless:
+  WebP with lossless compression. Has optional "quality" from 0 (fast) to
+  100 (small), default 50, and "method", default 4.
+
+WebP profiles are served for tiles ending in ".webp", and for ".png" and
+".jpg" tiles to clients whose Accept header includes "image/webp", see
+Layer.negotiateExtension() in TileStache.Core. WebP needs a PIL built with
+libwebp.
+
+Encoding time and size of each profile can be compared with the --encoders
+option to tilestache-bench.py.
+"""
+try:
+    from PIL import Image
+except ImportError:
+    # On some systems, PIL.Image is known as Image.
+    import Image
+
+from Pixels import apply_palette256
+
+class Encoder:
+    """ Base class for all encoder profiles.
+
+        Subclasses set format, mimetype and extension, and default options
+        in save_kwargs. Lossless profiles save pixels exactly as they are.
+    """
+    format, mimetype, extension = None, None, None
+    lossless = True
+    save_kwargs = {}
+
+    def __init__(self, **kwargs):
+        self.save_kwargs = dict(self.save_kwargs)
+        self.save_kwargs.update([(str(k), int(v)) for (k, v) in kwargs.items()])
+
+    def prepare(self, image):
+        """ Return an image ready to save, e.g. with fewer colors.
+        """
+        return image
+
+    def encode(self, tile, out, save_kwargs={}):
+        """ Save a tile to a file-like object.
+
+            Save_kwargs are a layer's options for the format, which the
+            profile's own options override.
+        """
+        if isinstance(tile, Image.Image):
+            tile = self.prepare(tile)
+
+        kwargs = dict(save_kwargs)
+        kwargs.update(self.save_kwargs)
+
+        tile.save(out, self.format, **kwargs)
+
+class PNGFast(Encoder):
+    """ PNG with the fastest zlib compression.
+    """
+    format, mimetype, extension = 'PNG', 'image/png', 'png'
+    save_kwargs = dict(compress_level=1)
+
+class PNGSmall(Encoder):
+    """ PNG with the smallest zlib compression.
+    """
+    format, mimetype, extension = 'PNG', 'image/png', 'png'
+    save_kwargs = dict(compress_level=9)
+
+class PNGQuantized(Encoder):
+    """ PNG with an optimized 256 color palette.
+    """
+    format, mimetype, extension = 'PNG', 'image/png', 'png'
+    save_kwargs = dict(compress_level=6)
+    lossless = False
+
+    def prepare(self, image):
+        if image.mode == 'P':
+            # already paletted, e.g. by a "palette" or "palette256" option.
+            return image
+
+        return apply_palette256(image)
+
+class WebPLossy(Encoder):
+    """ WebP with lossy compression.
+    """
+    format, mimetype, extension = 'WEBP', 'image/webp', 'webp'
+    save_kwargs = dict(quality=80, method=4)
+    lossless = False
+
+class WebPLossless(Encoder):
+    """ WebP with lossless compression.
+    """
+    format, mimetype, extension = 'WEBP', 'image/webp', 'webp'
+    save_kwargs = dict(lossless=1, quality=50, method=4)
+
+all = {
+    'png-fast': PNGFast,
+    'png-small': PNGSmall,
+    'png-quantized': PNGQuantized,
+    'webp-lossy': WebPLossy,
+    'webp-lossless': WebPLossless,
+}
@@ -4,9 +4,31 @@
     Example usage, with gunicorn (http://gunicorn.org):
 
       gunicorn --bind localhost:8888 "TileStache.Goodies.ExternalConfigServer:WSGIServer(url)"
+
+    The configuration server is expected to answer these requests:
+
+      url + "/cache"
+        JSON cache configuration, fetched once at startup.
+
+      url + "/layer/" + name
+        JSON layer configuration, or a non-200 response for unknown layers.
+
+      url + "/layers"
+        Optional JSON object with every layer configuration keyed by name,
+        used to fill the layer cache at startup when prefetch is true.
+
+    With cache_responses, layer configurations are kept for ttl seconds and
+    lookups of unknown layers for negative_ttl seconds. Once a layer is older
+    than ttl it's still used while a background thread fetches it again, so
+    tile requests never wait for the configuration server after a layer's
+    first request. Threads asking at once for a layer that isn't cached yet
+    wait on a single fetch. Layers whose configurations haven't changed are
+    kept as they are, along with their providers.
 """
 
 from urllib import urlopen
+from threading import Thread, Lock, local
+from time import time
 import logging
 
 try:
@@ -18,92 +40,189 @@ import TileStache
 
 class DynamicLayers:
 
-	def __init__(self, config, url_root, cache_responses, dirpath):
+	def __init__(self, config, url_root, cache_responses, dirpath, ttl=300, negative_ttl=60):
 		self.config = config
 		self.url_root = url_root
 		self.dirpath = dirpath
 		self.cache_responses = cache_responses;
-		self.seen_layers = {}
-		self.lookup_failures = set()
+		self.ttl = ttl
+		self.negative_ttl = negative_ttl
+
+		# (layer, layer_dict, expires) by name; layer is None for lookup failures.
+		self.entries = {}
+		self.refreshing = set()
+		self.lock = Lock()
+
+		# locks held by threads fetching layers that aren't cached yet, by name.
+		self.fetching = {}
+
+		# each thread's last __contains__ lookup when not caching, picked up
+		# by the __getitem__ that usually follows it in the same request.
+		self.local = local()
 
 	def keys(self):
-		return self.seen_layers.keys()
+		return [key for (key, layer) in self.items()]
 
 	def items(self):
-		return self.seen_layers.items()
+		if not self.cache_responses:
+			# layers are only known while a request uses them.
+			return []
 
-	def parse_layer(self, layer_json):
-		layer_dict = json_load(layer_json)
-		return TileStache.Config._parseConfigLayer(layer_dict, self.config, self.dirpath)
+		with self.lock:
+			return [(key, layer) for (key, (layer, layer_dict, expires)) in self.entries.items() if layer is not None]
 
-	def __contains__(self, key):
-		# If caching is enabled and we've seen a request for this layer before, return True unless
-		# the prior lookup failed to find this layer.
-		if self.cache_responses:
-			if key in self.seen_layers:
-				return True
-			elif key in self.lookup_failures:
-				return False
+	def parse_layer(self, key, layer_dict):
+		layer = TileStache.Config._parseConfigLayer(layer_dict, self.config, self.dirpath)
+		layer.setName(key)
+		return layer
 
+	def fetch(self, key):
+		""" Request one layer from the config server, return its dictionary or None.
+		"""
+		logging.debug("Requesting layer %s", self.url_root + "/layer/" + key)
 		res = urlopen(self.url_root + "/layer/" + key)
 
-		if self.cache_responses:
-			if res.getcode() != 200:
-				# Cache a failed lookup
-				self.lookup_failures.add(key)
-			else :
-				# If lookup succeeded and we are caching, parse the layer now so that a subsequent
-				# call to __getitem__ doesn't require a call to the config server.  If we aren't
-				# caching, we skip this step to avoid an unnecessary json parse.
-				try:
-					self.seen_layers[key] = self.parse_layer(res)
-				except ValueError:
-					# The JSON received by the config server was invalid.  Treat this layer as a
-					# failure.  We don't want to raise ValueError from here because other parts
-					# of TileStache are just expecting a boolean response from __contains__
-					logging.error("Invalid JSON response seen for %s", key)
-					self.lookup_failures.add(key)
-					return False
-
 		if res.getcode() != 200:
 			logging.info("Config response code %s for %s", res.getcode(), key)
-		return res.getcode() == 200
+			return None
 
-	def __getitem__(self, key):
-		if self.cache_responses:
-			if key in self.seen_layers:
-				return self.seen_layers[key]
-			elif key in self.lookup_failures:
-				# If we are caching, raise KnownUnknown if we have previously failed to find this layer
-				raise TileStache.KnownUnknown("Layer %s previously not found", key)
-
-		logging.debug("Requesting layer %s", self.url_root + "/layer/" + key)
-		res = urlopen(self.url_root + "/layer/" + key)
-		if (res.getcode() != 200) :
-			logging.info("Config response code %s for %s", res.getcode(), key)
-			if (self.cache_responses) :
-				self.lookup_failures.add(key)
-			raise TileStache.KnownUnknown("Layer %s not found", key)
-
-		try :
-			layer = self.parse_layer(res)
-			self.seen_layers[key] = layer
-			return layer
+		try:
+			return json_load(res)
 		except ValueError:
+			# The JSON received by the config server was invalid. Treat this layer as a failure.
 			logging.error("Invalid JSON response seen for %s", key)
-			if (self.cache_responses) :
-				# If caching responses, cache this failure
-				self.lookup_failures.add(key)
-			# KnownUnknown seems like the appropriate thing to raise here since this is akin
-			# to a missing configuration.
-			raise TileStache.KnownUnknown("Failed to parse JSON configuration for %s", key)
+			return None
+
+	def store(self, key, layer_dict):
+		""" Cache a fetched layer dictionary, return a layer or None.
+
+			An existing layer is kept if its configuration hasn't changed.
+		"""
+		with self.lock:
+			old_layer, old_dict, expires = self.entries.get(key, (None, None, None))
+
+		if layer_dict is None:
+			layer, expires = None, time() + self.negative_ttl
+		elif layer_dict == old_dict:
+			layer, expires = old_layer, time() + self.ttl
+		else:
+			layer, expires = self.parse_layer(key, layer_dict), time() + self.ttl
+
+		with self.lock:
+			self.entries[key] = layer, layer_dict, expires
+			self.refreshing.discard(key)
+
+		return layer
+
+	def refresh(self, key):
+		""" Fetch a stale layer again, in a background thread.
+		"""
+		try:
+			self.store(key, self.fetch(key))
+
+		except Exception, e:
+			# keep using the stale layer, and try again after negative_ttl.
+			logging.error("Failed to refresh layer %s: %s", key, e)
+
+			with self.lock:
+				layer, layer_dict, expires = self.entries[key]
+				self.entries[key] = layer, layer_dict, time() + self.negative_ttl
+				self.refreshing.discard(key)
+
+	def prefetch(self):
+		""" Fill the layer cache from the config server's "/layers" list.
+		"""
+		res = urlopen(self.url_root + "/layers")
+
+		if res.getcode() != 200:
+			logging.info("Config response code %s for all layers", res.getcode())
+			return
+
+		for (key, layer_dict) in json_load(res).items():
+			self.store(key, layer_dict)
+
+	def lookup(self, key):
+		""" Return a layer or None if there's no such layer.
+		"""
+		if not self.cache_responses:
+			found, self.local.found = getattr(self.local, 'found', None), None
+
+			if found is not None and found[0] == key:
+				return found[1]
+
+			layer_dict = self.fetch(key)
+			return layer_dict and self.parse_layer(key, layer_dict)
+
+		with self.lock:
+			entry = self.entries.get(key)
+
+			if entry is not None:
+				layer, layer_dict, expires = entry
+
+				if time() < expires:
+					return layer
+
+				if layer is not None:
+					# stale while revalidating.
+					if key not in self.refreshing:
+						self.refreshing.add(key)
+						thread = Thread(target=self.refresh, args=(key, ))
+						thread.setDaemon(True)
+						thread.start()
+
+					return layer
+
+			# another thread may already be fetching this layer.
+			waiting = self.fetching.get(key)
+
+			if waiting is None:
+				fetching = self.fetching[key] = Lock()
+				fetching.acquire()
+
+		if waiting is not None:
+			# wait for the other fetch, then look again in case it failed.
+			with waiting:
+				pass
+
+			return self.lookup(key)
+
+		try:
+			return self.store(key, self.fetch(key))
+
+		finally:
+			with self.lock:
+				del self.fetching[key]
+
+			fetching.release()
+
+	def forget(self):
+		""" Drop the lookup remembered by this thread, at the end of a request.
+		"""
+		self.local.found = None
+
+	def __contains__(self, key):
+		layer = self.lookup(key)
+
+		if not self.cache_responses:
+			self.local.found = key, layer
+
+		# Other parts of TileStache just expect a boolean response from __contains__.
+		return layer is not None
+
+	def __getitem__(self, key):
+		layer = self.lookup(key)
+
+		if layer is None:
+			raise TileStache.Core.KnownUnknown("Layer %s not found" % key)
+
+		return layer
 
 class ExternalConfiguration:
 
-	def __init__(self, url_root, cache_dict, cache_responses, dirpath):
+	def __init__(self, url_root, cache_dict, cache_responses, dirpath, ttl=300, negative_ttl=60):
 		self.cache = TileStache.Config._parseConfigCache(cache_dict, dirpath)
 		self.dirpath = dirpath
-		self.layers = DynamicLayers(self, url_root, cache_responses, dirpath)
+		self.layers = DynamicLayers(self, url_root, cache_responses, dirpath, ttl, negative_ttl)
 
 class WSGIServer (TileStache.WSGITileServer):
 
@@ -116,11 +235,13 @@ class WSGIServer (TileStache.WSGITileServer):
 		and path that must prefix the API calls on our local server.  Any valid http
 		or https urls should work.
 
-		The cache_responses parameter tells TileStache to cache all responses from
-		the configuration server.
+		The cache_responses parameter tells TileStache to cache responses from
+		the configuration server, layers for ttl seconds and unknown layers for
+		negative_ttl seconds. The prefetch parameter fills the cache at startup
+		from the configuration server's list of all layers.
 	"""
 
-	def __init__(self, url_root, cache_responses=True, debug_level="DEBUG"):
+	def __init__(self, url_root, cache_responses=True, debug_level="DEBUG", ttl=300, negative_ttl=60, prefetch=False):
 		logging.basicConfig(level=debug_level)
 
 		# Call API server at url to grab cache_dict
@@ -128,10 +249,16 @@ class WSGIServer (TileStache.WSGITileServer):
 
 		dirpath = '/tmp/stache'
 
-		config = ExternalConfiguration(url_root, cache_dict, cache_responses, dirpath)
+		config = ExternalConfiguration(url_root, cache_dict, cache_responses, dirpath, ttl, negative_ttl)
+
+		if prefetch and cache_responses:
+			config.layers.prefetch()
 
 		TileStache.WSGITileServer.__init__(self, config, False)
 
 	def __call__(self, environ, start_response):
-		response = TileStache.WSGITileServer.__call__(self, environ, start_response)
-		return response
+		try:
+			return TileStache.WSGITileServer.__call__(self, environ, start_response)
+		finally:
+			# a layer fetched for this request is not used by the next one.
+			self.config.layers.forget()
@@ -9,9 +9,12 @@ More information on Cascadenik:
 Requires Cascadenik 2.x+.
 '''
 from tempfile import gettempdir
+import logging
+
+from ...Mapnik import ImageProvider, global_mapnik_lock
 
 try:
-    from ...Mapnik import ImageProvider, mapnik
+    from ...Mapnik import mapnik
     from cascadenik import load_map
 except ImportError:
     # can still build documentation
@@ -39,11 +42,33 @@ class Provider (ImageProvider):
 
         ImageProvider.__init__(self, layer, mapfile, fonts)
 
-    def renderArea(self, width, height, srs, xmin, ymin, xmax, ymax, zoom):
-        """ Mostly hand off functionality to Mapnik.ImageProvider.renderArea()
+    def prewarm(self):
+        """ Compile and load the map ahead of the first request.
+        """
+        global_mapnik_lock.acquire()
+
+        try:
+            self.getMap()
+
+        except Exception, e:
+            logging.error('TileStache.Goodies.Providers.Cascadenik.prewarm() failed to load %s: %s', self.mapfile, e)
+
+        finally:
+            global_mapnik_lock.release()
+
+    def getMap(self):
+        """ Compile and load the map on first use, for Mapnik.ImageProvider.renderArea().
+
+            Compiled maps aren't shared with other providers.
         """
         if self.mapnik is None:
             self.mapnik = mapnik.Map(0, 0)
             load_map(self.mapnik, str(self.mapfile), self.workdir, cache_dir=self.workdir)
-        
-        return ImageProvider.renderArea(self, width, height, srs, xmin, ymin, xmax, ymax, zoom)
+
+        return self.mapnik
+
+    def forgetMap(self, mmap):
+        """ Drop a compiled map that failed to render, so it's compiled again.
+        """
+        if mmap is self.mapnik:
+            self.mapnik = None
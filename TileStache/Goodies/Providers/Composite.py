@@ -54,6 +54,10 @@ Available adjustments:
   "curves" - apply_curves_adjustment()
   "curves2" - apply_curves2_adjustment()
 
+Before anything is blended, every layer that a stack refers to at the requested
+zoom level is found and its tile fetched, several at a time. The optional
+"threads" parameter limits how many are fetched at once, and defaults to 4.
+
 Finally, the stacking feature allows layers to combined in more complex ways.
 This example stack combines a background color and foreground layer:
 
@@ -152,9 +156,9 @@ import re
 
 from urllib import urlopen
 from urlparse import urljoin
+from threading import Thread
 from os.path import join as pathjoin
 from xml.dom.minidom import parse as parseXML
-from StringIO import StringIO
 
 try:
     from json import loads as jsonload
@@ -183,7 +187,7 @@ class Provider:
         the output of other configured tile layers as layers or masks to create
         a combined output.
     """
-    def __init__(self, layer, stack=None, stackfile=None):
+    def __init__(self, layer, stack=None, stackfile=None, threads=4):
         """ Make a new Composite.Provider.
 
             Arguments:
@@ -197,8 +201,12 @@ class Provider:
 
               stackfile:
                 *Deprecated* filename for an XML representation of the image stack.
+
+              threads:
+                Optional number of layer tiles to fetch at once, default 4.
         """
         self.layer = layer
+        self.threads = int(threads)
 
         if type(stack) in (str, unicode):
             stack = jsonload(urlopen(urljoin(layer.config.dirpath, stack)).read())
@@ -225,7 +233,10 @@ class Provider:
 
         rgba = [numpy.zeros((width, height), float) for chan in range(4)]
 
-        rgba = self.stack.render(self.layer.config, rgba, coord)
+        config = self.layer.config
+        tiles = fetch_tiles(config, self.stack.sources(coord.zoom), coord, self.threads)
+
+        rgba = self.stack.render(config, rgba, coord, tiles)
 
         return _rgba2img(rgba)
 
@@ -302,28 +313,35 @@ class Layer:
         """
         return self.min_zoom <= zoom and zoom <= self.max_zoom
 
-    def render(self, config, input_rgba, coord):
+    def sources(self, zoom):
+        """ Return names of the layers needed to render at a zoom level.
+        """
+        if not self.in_zoom(zoom):
+            return []
+
+        return [name for name in (self.layername, self.maskname) if name]
+
+    def render(self, config, input_rgba, coord, tiles=None):
         """ Render this image layer.
 
             Given a configuration object, starting image, and coordinate,
             return an output image with the contents of this image layer.
+
+            Optional tiles dictionary comes from fetch_tiles(), and layers
+            missing from it are requested here.
         """
         has_layer, has_color, has_mask = False, False, False
 
         output_rgba = [chan.copy() for chan in input_rgba]
 
         if self.layername:
-            layer = config.layers[self.layername]
-            mime, body = TileStache.getTile(layer, coord, 'png')
-            layer_img = Image.open(StringIO(body)).convert('RGBA')
+            layer_img = get_tile(config, self.layername, coord, tiles).convert('RGBA')
             layer_rgba = _img2rgba(layer_img)
 
             has_layer = True
 
         if self.maskname:
-            layer = config.layers[self.maskname]
-            mime, body = TileStache.getTile(layer, coord, 'png')
-            mask_img = Image.open(StringIO(body)).convert('L')
+            mask_img = get_tile(config, self.maskname, coord, tiles).convert('L')
             mask_chan = _img2arr(mask_img).astype(numpy.float32) / 255.
 
             has_mask = True
@@ -388,19 +406,33 @@ class Stack:
         """
         return True
 
-    def render(self, config, input_rgba, coord):
+    def sources(self, zoom):
+        """ Return names of the layers needed to render at a zoom level, in order.
+        """
+        names = []
+
+        for layer in self.layers:
+            for name in layer.sources(zoom):
+                if name not in names:
+                    names.append(name)
+
+        return names
+
+    def render(self, config, input_rgba, coord, tiles=None):
         """ Render this image stack.
 
             Given a configuration object, starting image, and coordinate,
             return an output image with the results of all the layers in
             this stack pasted on in turn.
+
+            Optional tiles dictionary comes from fetch_tiles().
         """
         stack_rgba = [numpy.zeros(chan.shape, chan.dtype) for chan in input_rgba]
 
         for layer in self.layers:
             try:
                 if layer.in_zoom(coord.zoom):
-                    stack_rgba = layer.render(config, stack_rgba, coord)
+                    stack_rgba = layer.render(config, stack_rgba, coord, tiles)
 
             except IOError:
                 # Be permissive of I/O errors getting sub-layers, for example if a
@@ -410,6 +442,57 @@ class Stack:
 
         return blend_images(input_rgba, stack_rgba[:3], stack_rgba[3], 1, None)
 
+def fetch_tiles(config, names, coord, threads):
+    """ Fetch PNG tile images for a list of layer names, several at a time.
+
+        Returns a dictionary of (image, exc_info) tuples by layer name,
+        where exc_info is None unless fetching the tile raised an error.
+        Errors are raised later by get_tile(), so they're handled in the
+        usual place as each layer is rendered.
+    """
+    tiles, names = {}, list(reversed(names))
+
+    def fetch():
+        while True:
+            try:
+                name = names.pop()
+            except IndexError:
+                # All done.
+                break
+
+            try:
+                tiles[name] = config.layers[name].getTileObject(coord, 'png'), None
+            except:
+                tiles[name] = None, sys.exc_info()
+
+    if threads > 1 and len(names) > 1:
+        workers = [Thread(target=fetch) for i in range(min(threads, len(names)))]
+
+        for worker in workers:
+            worker.start()
+
+        for worker in workers:
+            worker.join()
+    else:
+        fetch()
+
+    return tiles
+
+def get_tile(config, name, coord, tiles=None):
+    """ Return a PNG tile image for a layer name, from fetch_tiles() if possible.
+
+        Uses Layer.getTileObject(), so the image must not be modified.
+    """
+    if tiles is None or name not in tiles:
+        return config.layers[name].getTileObject(coord, 'png')
+
+    image, exc_info = tiles[name]
+
+    if exc_info is not None:
+        raise exc_info[0], exc_info[1], exc_info[2]
+
+    return image
+
 def make_color(color):
     """ Convert colors expressed as HTML-style RGB(A) strings to tuples.
 
@@ -779,6 +862,7 @@ def makeStack(element):
 if __name__ == '__main__':
 
     import unittest
+    import time
 
     import TileStache.Core
     import TileStache.Caches
@@ -804,6 +888,21 @@ if __name__ == '__main__':
         def renderTile(self, *args, **kwargs):
             return SizelessImage(self.img)
 
+    class SlowBitmap(TinyBitmap):
+        """ A TinyBitmap that takes its time, or fails with an IOError.
+        """
+        def __init__(self, string, delay):
+            TinyBitmap.__init__(self, string)
+            self.delay = delay
+
+        def renderTile(self, *args, **kwargs):
+            time.sleep(self.delay)
+
+            if self.img.getpixel((0, 0))[3] == 0:
+                raise IOError('Nothing here')
+
+            return TinyBitmap.renderTile(self, *args, **kwargs)
+
     def tinybitmap_layer(config, string):
         """ Gin up a fake layer with a TinyBitmap provider.
         """
@@ -1188,4 +1287,52 @@ if __name__ == '__main__':
             assert img.getpixel((1, 2)) == (0xFF, 0xFF, 0xFF, 0xFF), 'bottom center pixel'
             assert img.getpixel((2, 2)) == (0xFF, 0xFF, 0xFF, 0xFF), 'bottom right pixel'
 
+    class FetchTests(unittest.TestCase):
+        """
+        """
+        def setUp(self):
+
+            cache = TileStache.Caches.Test()
+            self.config = TileStache.Config.Configuration(cache, '.')
+
+            _fff8, _0008, _0000 = '\xFF\xFF\xFF\x80', '\x00\x00\x00\x80', '\x00\x00\x00\x00'
+
+            self.config.layers = dict([(name, tinybitmap_layer(self.config, _0000 * 9)) for name in ('white', 'black', 'broken', 'mask')])
+
+            self.config.layers['white'].provider = SlowBitmap(_fff8 * 9, .2)
+            self.config.layers['black'].provider = SlowBitmap(_0008 * 9, .2)
+            self.config.layers['broken'].provider = SlowBitmap(_0000 * 9, .2)
+            self.config.layers['mask'].provider = SlowBitmap(_fff8 * 9, .2)
+
+            self.stack = \
+                [
+                    {"src": "white"},
+                    {"src": "broken"},
+                    [
+                        {"src": "black", "mask": "mask"},
+                        {"src": "white", "zoom": "1"}
+                    ]
+                ]
+
+        def test0(self):
+
+            layer = minimal_stack_layer(self.config, self.stack)
+
+            start = time.time()
+            img = layer.provider.renderTile(3, 3, None, ModestMaps.Core.Coordinate(0, 0, 0))
+
+            assert time.time() - start < .6, 'four layers fetched at once'
+            assert img.getpixel((1, 1)) == (0x55, 0x55, 0x55, 0xC0), 'middle pixel'
+
+            layer.provider.threads = 1
+
+            # forget the tile images kept by Layer.getTileObject()
+            TileStache.Core._recent_objects.clear()
+
+            start = time.time()
+            img = layer.provider.renderTile(3, 3, None, ModestMaps.Core.Coordinate(0, 0, 0))
+
+            assert time.time() - start > .8, 'four layers fetched in turn'
+            assert img.getpixel((1, 1)) == (0x55, 0x55, 0x55, 0xC0), 'middle pixel again'
+
     unittest.main()
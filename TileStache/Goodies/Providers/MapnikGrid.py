@@ -31,13 +31,10 @@ scale: What to divide the tile pixel size by to get the resulting grid size. Usu
 buffer: buffer around the queried features, in px, default 0. Use this to prevent problems on tile boundaries.
 """
 import json
-from os.path import exists
 from TileStache.Core import KnownUnknown
 from TileStache.Geography import getProjectionByName
+from TileStache.Mapnik import global_mapnik_lock, get_sharedMap, prewarm_sharedMap, rebuild_sharedMap
 from urlparse import urlparse, urljoin
-from tempfile import mkstemp
-from urllib import urlopen
-import os
 
 try:
     import mapnik
@@ -49,7 +46,6 @@ class Provider:
     def __init__(self, layer, mapfile, fields, layer_index=0, wrapper=None, scale=4, buffer=0):
         """
         """
-        self.mapnik = None
         self.layer = layer
 
         maphref = urljoin(layer.config.dirpath, mapfile)
@@ -69,12 +65,14 @@ class Provider:
 
         self.mercator = getProjectionByName('spherical mercator')
 
+    def prewarm(self):
+        """ Load the shared map for this provider's mapfile.
+        """
+        prewarm_sharedMap(self.mapfile)
+
     def renderTile(self, width, height, srs, coord):
         """
         """
-        if self.mapnik is None:
-            self.mapnik = get_mapnikMap(self.mapfile)
-
         # buffer as fraction of tile size
         buffer = float(self.buffer) / 256
 
@@ -83,14 +81,28 @@ class Provider:
         ul = self.mercator.locationProj(nw)
         lr = self.mercator.locationProj(se)
 
-        self.mapnik.width = width + 2 * self.buffer
-        self.mapnik.height = height + 2 * self.buffer
-        self.mapnik.zoom_to_box(mapnik.Box2d(ul.x, ul.y, lr.x, lr.y))
-
         # create grid as same size as map/image
         grid = mapnik.Grid(width + 2 * self.buffer, height + 2 * self.buffer)
-        # render a layer to that grid array
-        mapnik.render_layer(self.mapnik, grid, layer=self.layer_index, fields=self.fields)
+        mmap = None
+
+        # the map is shared with other Mapnik providers.
+        global_mapnik_lock.acquire()
+
+        try:
+            mmap = get_sharedMap(self.mapfile)
+
+            mmap.width = width + 2 * self.buffer
+            mmap.height = height + 2 * self.buffer
+            mmap.zoom_to_box(mapnik.Box2d(ul.x, ul.y, lr.x, lr.y))
+
+            # render a layer to that grid array
+            mapnik.render_layer(mmap, grid, layer=self.layer_index, fields=self.fields)
+        except:
+            rebuild_sharedMap(self.mapfile, mmap)
+            raise
+        finally:
+            global_mapnik_lock.release()
+
         # extract a gridview excluding the buffer
         grid_view = grid.view(self.buffer, self.buffer, width, height)
         # then encode the grid array as utf, resample to 1/scale the size, and dump features
@@ -124,21 +136,3 @@ class SaveableResponse:
             raise KnownUnknown('MapnikGrid only saves .json tiles, not "%s"' % format)
 
         out.write(self.content)
-
-def get_mapnikMap(mapfile):
-    """ Get a new mapnik.Map instance for a mapfile
-    """
-    mmap = mapnik.Map(0, 0)
-
-    if exists(mapfile):
-        mapnik.load_map(mmap, str(mapfile))
-
-    else:
-        handle, filename = mkstemp()
-        os.write(handle, urlopen(mapfile).read())
-        os.close(handle)
-
-        mapnik.load_map(mmap, filename)
-        os.unlink(filename)
-
-    return mmap
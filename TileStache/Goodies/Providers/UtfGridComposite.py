@@ -29,11 +29,21 @@ layer_id: the key for the layer_id attribute that is added to each data object:
 wrapper: wrapper to add to the resulting utfgrid "WRAPPER({...})". Usually "grid"
 
 if layer_id is not set in the layer or the provider config then it will not be set on data objects
+
+Requires NumPy.
 """
 
 import json
+
+try:
+	import numpy
+except ImportError:
+	# can still build documentation
+	pass
+
 import TileStache
 from TileStache.Core import KnownUnknown
+from TileStache.Mapnik import grid_ids, grid_rows
 
 class Provider:
 	
@@ -48,12 +58,13 @@ class Provider:
 	
 	def renderTile(self, width, height, srs, coord):
 
-		resultGrid = []
+		resultGrid = None
 		gridKeys = []
+		gridIndex = {}
 		gridData = {}
 		
 		for l in self.stack:
-			self.addLayer(resultGrid, gridKeys, gridData, l, coord)
+			resultGrid = self.addLayer(resultGrid, gridKeys, gridIndex, gridData, l, coord)
 		return SaveableResponse(self.writeResult(resultGrid, gridKeys, gridData))
 
 	def getTypeByExtension(self, extension):
@@ -65,137 +76,91 @@ class Provider:
 		
 		return 'text/json', 'JSON'
 
-	def addLayer( self, resultGrid, gridKeys, gridData, layerDef, coord ):
+	def addLayer( self, resultGrid, gridKeys, gridIndex, gridData, layerDef, coord ):
+		""" Add one layer over resultGrid, an array of indexes into gridKeys.
+		
+			Returns the new resultGrid, with -1 for transparent pixels.
+			GridIndex maps each of gridKeys to its index.
+		"""
+		source = self.layer.config.layers[layerDef['src']]
 		
-		mime, layer = TileStache.getTile(self.layer.config.layers[layerDef['src']], coord, 'JSON')
-#		raise KnownUnknown(layer)
 		if layerDef['wrapper'] == None:
-			layer = json.loads(layer)
+			# shared with other users of this tile, so it's copied below before changing.
+			layer = source.getTileObject(coord, 'JSON')
 		else:
+			mime, layer = TileStache.getTile(source, coord, 'JSON')
 			layer = json.loads(layer[(len(layerDef['wrapper'])+1):-1]) #Strip "Wrapper(...)"
 		
-		gridSize = len(layer['grid'])
+		ids = grid_ids(layer['grid'])
 
 		#init resultGrid based on given layers (if required)
-		if len(resultGrid) == 0:
-			for i in xrange(gridSize):
-				resultGrid.append([])
-				for j in xrange(gridSize):
-					resultGrid[i].append(-1)
+		if resultGrid is None:
+			resultGrid = numpy.empty(ids.shape, dtype=numpy.int32)
+			resultGrid.fill(-1)
 	
 		keys = layer['keys']
 		
 		keyRemap = {}
 		for k in keys:
-			if k in gridKeys:
+			if k in gridIndex:
 				for ext in xrange(ord('a'), ord('z')+1):
-					if not k+chr(ext) in gridKeys:
+					if not k+chr(ext) in gridIndex:
 						keyRemap[k] = (k+chr(ext))
 						break
 				if not k in keyRemap:
-					raise Error("Couldn't remap")
-		
-		addedKeys = [] #FIXME: HashSet<string>?
-		
-		for y in xrange(gridSize):
-			line = layer['grid'][y]
-			for x in xrange(gridSize):
-				idNo = self.decodeId(line[x])
-				
-				if keys[idNo] == "":
-					continue
-				
-				key = keys[idNo]
-				if keys[idNo] in keyRemap:
-					key = keyRemap[keys[idNo]]
-				
-				if not key in addedKeys:
-					gridKeys.append(key)
-					addedKeys.append(key)
-					if layerDef['layer_id'] != None and self.layer_id != None: #Add layer name attribute
-						layer['data'][keys[idNo]][self.layer_id] = layerDef['layer_id']
-					gridData[key] = layer['data'][keys[idNo]]
-						
-						
-				newId = gridKeys.index(key)
-				
-				resultGrid[x][y] = newId
+					raise KnownUnknown("Couldn't remap key %s from layer %s" % (k, layerDef['src']))
+		
+		# keys are added in the order they're first seen, row by row.
+		present, first = numpy.unique(ids, return_index=True)
+		
+		newIds = numpy.empty(len(keys), dtype=numpy.int32)
+		newIds.fill(-1)
+		
+		for idNo in present[numpy.argsort(first)]:
+			if keys[idNo] == "":
+				continue
+			
+			key = keyRemap.get(keys[idNo], keys[idNo])
+			
+			if not key in gridIndex:
+				gridIndex[key] = len(gridKeys)
+				gridKeys.append(key)
+				data = layer['data'][keys[idNo]]
+				if layerDef['layer_id'] != None and self.layer_id != None: #Add layer name attribute
+					data = dict(data)
+					data[self.layer_id] = layerDef['layer_id']
+				gridData[key] = data
+			
+			newIds[idNo] = gridIndex[key]
+		
+		layerGrid = newIds[ids]
+		
+		return numpy.where(layerGrid == -1, resultGrid, layerGrid)
 
 	def writeResult( self, resultGrid, gridKeys, gridData ):
-		gridSize = len(resultGrid)
-	
-		finalKeys = []
-		finalData = {}
-		finalGrid = []
-		for i in xrange(gridSize):
-			finalGrid.append("")
-		
-		finalIdCounter = 0
-		idToFinalId = {}
-		
-		for y in xrange(gridSize):
-			for x in xrange(gridSize):
-				id = resultGrid[x][y]
-				
-				if not id in idToFinalId:
-					idToFinalId[id] = finalIdCounter
-					finalIdCounter = finalIdCounter + 1
-					
-					if id == -1:
-						finalKeys.append("")
-					else:
-						finalKeys.append(gridKeys[id])
-						finalData[gridKeys[id]] = gridData[gridKeys[id]]
-				
-				finalId = idToFinalId[id]
-				finalGrid[y] = finalGrid[y] + self.encodeId(finalId)
-	
-		result = "{\"keys\": ["
-		for i in xrange(len(finalKeys)):
-			if i > 0:
-				result += ","
-			result += "\"" + finalKeys[i] + "\""
-	
-		result += "], \"data\": { "
+		""" Encode the composited grid as JSON, numbering keys as they're first seen.
+		"""
+		if resultGrid is None:
+			# no layers in the stack.
+			resultGrid = numpy.empty((0, 0), dtype=numpy.int32)
+		
+		present, first = numpy.unique(resultGrid, return_index=True)
+		order = present[numpy.argsort(first)]
 		
-		first = True
-		for entry in gridData:
-			if not first:
-				result += ","
-			first = False
-			result += "\"" + entry + "\": " + json.dumps(gridData[entry]) + ""
+		# gridKeys indexes, offset by one for transparent pixels.
+		finalIds = numpy.zeros(len(gridKeys) + 1, dtype=numpy.int32)
+		finalIds[order + 1] = numpy.arange(len(order))
 		
-		result += "}, \"grid\": ["
+		finalKeys = ["" if id == -1 else gridKeys[id] for id in order]
+		finalData = dict([(key, gridData[key]) for key in finalKeys if key != ""])
+		finalGrid = grid_rows(finalIds[resultGrid + 1])
 		
-		for i in xrange(gridSize):
-			line = finalGrid[i]
-			result += json.dumps(line)
-			if i < gridSize - 1:
-				result += ","
+		result = '{"keys": %s, "data": %s, "grid": %s}' % (json.dumps(finalKeys), json.dumps(finalData), json.dumps(finalGrid))
 		
 		if self.wrapper == None:
-			return result + "]}"
+			return result
 		else:
-			return self.wrapper + "(" + result + "]})"
-
-	def encodeId ( self, id ):
-		id += 32
-		if id >= 34:
-			id = id + 1
-		if id >= 92:
-			id = id + 1
-		if id > 127:
-			return unichr(id)
-		return chr(id)
-
-	def decodeId( self, id ):
-		id = ord(id)
-		
-		if id >= 93:
-			id = id - 1
-		if id >= 35:
-			id = id - 1
-		return id - 32
+			return self.wrapper + "(" + result + ")"
 
 
 class SaveableResponse:
@@ -1,25 +1,42 @@
+""" Composite Provider for overlapping UTFGrid layers
+https://github.com/mapbox/utfgrid-spec/blob/master/1.2/utfgrid.md
+
+Like UtfGridComposite, but features from every layer are kept: the data for
+each key is a list of the data objects under it, in stack order. Pixels with
+the same features under them share a key. Configuration is the same as for
+UtfGridComposite, with class "TileStache.Goodies.Providers.UtfGridCompositeOverlap:Provider".
+
+Requires NumPy.
+"""
 import json
+
+try:
+  import numpy
+except ImportError:
+  # can still build documentation
+  pass
+
 import TileStache
 from TileStache.Core import KnownUnknown
+from TileStache.Mapnik import grid_ids, grid_rows
 
 class Provider:
-  
+
   def __init__(self, layer, stack, layer_id=None, wrapper=None):
-    #Set up result storage
-    self.resultGrid = []
-    self.gridKeys = []
-    self.gridData = {}
-    
     self.layer = layer
     self.stack = stack
     self.layer_id = layer_id
     self.wrapper = wrapper
-    self.curId = 0
 
   def renderTile(self, width, height, srs, coord):
+    # Each pixel of resultGrid is an index into stacks, lists of data for
+    # the features under it; stack zero is empty, for transparent pixels.
+    resultGrid = None
+    stacks = [[]]
+
     for l in self.stack:
-      self.addLayer(l, coord)
-    return SaveableResponse(self.writeResult())
+      resultGrid = self.addLayer(resultGrid, stacks, l, coord)
+    return SaveableResponse(self.writeResult(resultGrid, stacks))
 
   def getTypeByExtension(self, extension):
     """ Get mime-type and format by file extension.
@@ -27,119 +44,83 @@ class Provider:
     """
     if extension.lower() != 'json':
       raise KnownUnknown('UtfGridComposite only makes .json tiles, not "%s"' % extension)
-    
+
     return 'text/json', 'JSON'
 
-  def addLayer( self, layerDef, coord ):
-    layer = TileStache.getTile(self.layer.config.layers[layerDef['src']], coord, 'JSON')[1]
+  def addLayer( self, resultGrid, stacks, layerDef, coord ):
+    """ Add one layer's features to the stacks under each pixel.
+
+      Returns the new resultGrid. Pixels with the same stack before this
+      layer and the same feature in it share one new stack.
+    """
+    source = self.layer.config.layers[layerDef['src']]
 
     if layerDef['wrapper'] == None:
-      layer = json.loads(layer)
+      # shared with other users of this tile, so it's copied below before changing.
+      layer = source.getTileObject(coord, 'JSON')
     else:
       # Strip "Wrapper(...)"
+      mime, layer = TileStache.getTile(source, coord, 'JSON')
       layer = json.loads(layer[(len(layerDef['wrapper'])+1):-1])
 
-    grid_size = len(layer['grid'])
+    ids = grid_ids(layer['grid'])
 
     # Init resultGrid based on given layers (if required)
-    if len(self.resultGrid) == 0:
-      for i in xrange(grid_size):
-        self.resultGrid.append([])
-        for j in xrange(grid_size):
-          self.resultGrid[i].append(-1)
+    if resultGrid is None:
+      resultGrid = numpy.zeros(ids.shape, dtype=numpy.int32)
 
     layer_keys = layer['keys']
+    opaque = numpy.array([key != "" for key in layer_keys], dtype=bool)[ids]
+
+    # (stack, feature) pairs under each opaque pixel.
+    pairs = resultGrid[opaque].astype(numpy.int64) * len(layer_keys) + ids[opaque]
+    pairs, inverse = numpy.unique(pairs, return_inverse=True)
+
+    new_ids = numpy.empty(len(pairs), dtype=numpy.int32)
+
+    for (index, pair) in enumerate(pairs):
+      stack_id, src_id = divmod(int(pair), len(layer_keys))
+      data = layer['data'][layer_keys[src_id]]
 
-    for y in xrange(grid_size):
-      line = layer['grid'][y]
-      for x in xrange(grid_size):
-        src_id = self.decodeId(line[x])
-        
-        if layer_keys[src_id] == "":
-          continue
-
-        src_key = layer_keys[src_id]
-
-        # Add layer name attribute
-        if layerDef['layer_id'] != None and self.layer_id != None:
-          layer['data'][src_key][self.layer_id] = layerDef['layer_id']
-
-        if self.resultGrid[x][y] == -1:
-          cur_id = self.curId
-          self.curId += 1
-          cur_key = json.dumps(cur_id)
-
-          # Set key for current point.
-          self.resultGrid[x][y] = self.encodeId(cur_id)
-          self.gridKeys.insert(cur_id + 1, cur_key)
-
-          # Initialize data bucket.
-          self.gridData[cur_key] = []
-
-        else:
-          cur_id = self.decodeId(self.resultGrid[x][y])
-          cur_key = json.dumps(cur_id)
-
-        self.gridData[cur_key].append(layer['data'][src_key])
-
-  def writeResult( self ):
-    result = "{\"keys\": ["
-    for i in xrange(len(self.gridKeys)):
-      if i > 0:
-        result += ","
-      result += "\"" + self.gridKeys[i] + "\""
-  
-    result += "], \"data\": { "
-    
-    first = True
-    for key in self.gridData:
-      if not first:
-        result += ","
-      first = False
-      result += "\"" + key + "\": " + json.dumps(self.gridData[key]) + ""
-    
-    result += "}, \"grid\": ["
-    
-    grid_size = len(self.resultGrid)
-    first = True
-    for y in xrange(grid_size):
-      line = ""
-
-      for x in xrange(grid_size):
-        if self.resultGrid[x][y] == -1:
-          self.resultGrid[x][y] = ' '
-
-        line = line + self.resultGrid[x][y]
-
-      if not first:
-        result += ","
-      first = False
-
-      result += json.dumps(line)
+      # Add layer name attribute
+      if layerDef['layer_id'] != None and self.layer_id != None:
+        data = dict(data)
+        data[self.layer_id] = layerDef['layer_id']
+
+      new_ids[index] = len(stacks)
+      stacks.append(stacks[stack_id] + [data])
+
+    resultGrid = resultGrid.copy()
+    resultGrid[opaque] = new_ids[inverse]
+
+    return resultGrid
+
+  def writeResult( self, resultGrid, stacks ):
+    """ Encode the grid as JSON, numbering keys as they're first seen.
+    """
+    if resultGrid is None:
+      # no layers in the stack.
+      resultGrid = numpy.zeros((0, 0), dtype=numpy.int32)
+
+    present, first = numpy.unique(resultGrid, return_index=True)
+    order = present[numpy.argsort(first)]
+
+    # transparent pixels are always first, with an empty key.
+    order = [0] + [stack_id for stack_id in order if stack_id != 0]
+
+    final_ids = numpy.zeros(len(stacks), dtype=numpy.int32)
+    final_ids[order] = numpy.arange(len(order))
+
+    keys = [""] + [json.dumps(i) for i in range(1, len(order))]
+    data = dict([(keys[i], stacks[order[i]]) for i in range(1, len(order))])
+    grid = grid_rows(final_ids[resultGrid])
+
+    result = '{"keys": %s, "data": %s, "grid": %s}' % (json.dumps(keys), json.dumps(data), json.dumps(grid))
 
     if self.wrapper == None:
-      return result + "]}"
+      return result
     else:
-      return self.wrapper + "(" + result + "]})"
-
-  def encodeId ( self, id ):
-    id += 32
-    if id >= 34:
-      id = id + 1
-    if id >= 92:
-      id = id + 1
-    if id > 127:
-      return unichr(id)
-    return chr(id)
-
-  def decodeId( self, id ):
-    id = ord(id)
-    
-    if id >= 93:
-      id = id - 1
-    if id >= 35:
-      id = id - 1
-    return id - 32
+      return self.wrapper + "(" + result + ")"
 
 
 class SaveableResponse:
@@ -152,4 +133,3 @@ class SaveableResponse:
     if format != 'JSON':
       raise KnownUnknown('UtfGridCompositeOverlap only saves .json tiles, not "%s"' % format)
     out.write(self.content)
-
@@ -9,6 +9,10 @@
     
       gunicorn --bind localhost:8888 "TileStache.Goodies.StatusServer:WSGIServer('tilestache.cfg')"
 
+    Messages are buffered in each process and sent to Redis in batches by a
+    background thread about once a second, so tile requests don't wait for
+    Redis. See Reporter for details.
+
     Example output, showing vertical alignment based on process ID:
 
       13235 Attempted cache lock, 2 minutes ago
@@ -31,9 +35,14 @@
                          13233 Attempted cache lock, 2 minutes ago
                          13233 Started /osm/15/5255/12661.png, 2 minutes ago
 """
+import logging
+
 from os import getpid
-from time import time
+from time import time, sleep
 from hashlib import md5
+from atexit import register as atexit_register
+from collections import deque
+from threading import Thread, Lock
 
 try:
     from redis import StrictRedis
@@ -62,23 +71,143 @@ except ImportError:
             # old Redis expire can't be repeatedly updated.
             pass
 
+        def pipeline(self, transaction=True):
+            # old Redis may not pipeline, so commands go straight through.
+            return self
+
+        def execute(self):
+            pass
+
 import TileStache
 
 _keep = 20
 
+class Reporter:
+    """ Buffers status messages and sends them to Redis in batches.
+    
+        Messages are kept in a fixed-size ring buffer, and a background
+        thread sends them about once a second in a single pipelined round trip.
+        Reporting never blocks tile requests: when Redis is slow or down,
+        the oldest buffered messages are dropped, counted, and reported in
+        a warning at the next flush.
+        
+        Keyword args are passed directly to redis.StrictRedis().
+    """
+    def __init__(self, interval=1.0, size=1000, **redis_kwargs):
+        self.interval = interval
+        self.redis_kwargs = redis_kwargs
+        self.redis_kwargs.setdefault('socket_timeout', 5)
+        self.events = deque(maxlen=size)
+        self.dropped = 0
+        self.start_lock = Lock()
+        self.pid = None
+        
+        atexit_register(self.flush)
+    
+    def _start(self):
+        """ Start a flushing thread for this process, if there isn't one.
+        
+            Threads don't survive a fork, so a new one is started in each new
+            process, such as a pre-forked gunicorn worker. Messages copied
+            from the parent process are left for the parent to send.
+            
+            Locks copied from the parent might be held by one of its threads,
+            so new ones are made before the process ID is published.
+        """
+        with self.start_lock:
+            if self.pid == getpid():
+                return
+            
+            self.events.clear()
+            self.dropped = 0
+            self.events_lock = Lock()
+            self.flush_lock = Lock()
+            self.red = None
+            self.pid = getpid()
+            
+            thread = Thread(target=self._run)
+            thread.setDaemon(True)
+            thread.start()
+    
+    def _run(self):
+        while True:
+            sleep(self.interval)
+            self.flush()
+    
+    def update(self, msg):
+        """ Buffer a message, prefixed with the current timestamp.
+        """
+        if self.pid != getpid():
+            self._start()
+        
+        with self.events_lock:
+            if len(self.events) == self.events.maxlen:
+                self.dropped += 1
+            
+            self.events.append('%.6f %s' % (time(), msg))
+    
+    def flush(self):
+        """ Send buffered messages to Redis, oldest first.
+        """
+        if self.pid != getpid():
+            return
+        
+        with self.flush_lock:
+            with self.events_lock:
+                msgs, dropped = list(self.events), self.dropped
+                self.events.clear()
+                self.dropped = 0
+            
+            if dropped:
+                logging.warning('TileStache.Goodies.StatusServer dropped %d messages from a full buffer', dropped)
+            
+            if not msgs:
+                return
+            
+            key = 'pid-%d-statuses' % self.pid
+            
+            try:
+                if self.red is None:
+                    self.red = StrictRedis(**self.redis_kwargs)
+                
+                pipe = self.red.pipeline(transaction=False)
+                
+                for msg in msgs:
+                    pipe.lpush(key, msg)
+    
+                pipe.expire(key, 60 * 60)
+                pipe.ltrim(key, 0, _keep)
+                pipe.execute()
+            
+            except Exception, e:
+                logging.warning('TileStache.Goodies.StatusServer dropped %d messages: %s', len(msgs), e)
+
+# Reporters for each set of Redis arguments in this process.
+_reporters = {}
+_reporters_lock = Lock()
+
+def get_reporter(interval=1.0, size=1000, **redis_kwargs):
+    """ Return a shared Reporter for a set of Redis arguments.
+    
+        Interval and size are used only when the Reporter is first created.
+    """
+    key = tuple(sorted(redis_kwargs.items()))
+    
+    with _reporters_lock:
+        if key not in _reporters:
+            _reporters[key] = Reporter(interval, size, **redis_kwargs)
+        
+        return _reporters[key]
+
 def update_status(msg, **redis_kwargs):
     """ Updated Redis with a message, prefix it with the current timestamp.
     
+        Messages are buffered and sent in batches by a Reporter, so they
+        may take a second or so to appear.
+    
         Keyword args are passed directly to redis.StrictRedis().
     """
-    pid = getpid()
-    red = StrictRedis(**redis_kwargs)
-    key = 'pid-%d-statuses' % pid
-    msg = '%.6f %s' % (time(), msg)
-    
-    red.lpush(key, msg)
-    red.expire(key, 60 * 60)
-    red.ltrim(key, 0, _keep)
+    get_reporter(**redis_kwargs).update(msg)
 
 def delete_statuses(pid, **redis_kwargs):
     """
@@ -186,13 +315,18 @@ class WSGIServer (TileStache.WSGITileServer):
         constructor from TileStache WSGI, which just loads a TileStache
         configuration file into self.config.
     """
-    def __init__(self, config, redis_host='localhost', redis_port=6379):
+    def __init__(self, config, redis_host='localhost', redis_port=6379, flush_interval=1.0, buffer_size=1000):
         """
+            Optional flush_interval is the number of seconds between batches
+            of messages sent to Redis, and buffer_size is the largest number
+            of messages kept waiting for the next batch.
         """
         TileStache.WSGITileServer.__init__(self, config)
 
         self.redis_kwargs = dict(host=redis_host, port=redis_port)
         self.config.cache = CacheWrap(self.config.cache, self.redis_kwargs)
+        
+        get_reporter(flush_interval, buffer_size, **self.redis_kwargs)
 
         update_status('Created', **self.redis_kwargs)
         
@@ -224,6 +358,7 @@ class WSGIServer (TileStache.WSGITileServer):
         """
         """
         update_status('Destroyed', **self.redis_kwargs)
+        get_reporter(**self.redis_kwargs).flush()
 
 class CacheWrap:
     """ Wraps up a TileStache cache object and reports events to Redis.
@@ -0,0 +1,215 @@
+""" Caches tiles to an LMDB memory-mapped database.
+
+Requires py-lmdb:
+  https://pypi.python.org/pypi/lmdb
+  http://www.lmdb.tech/doc/
+
+  pip install lmdb
+
+LMDB keeps every tile in one memory-mapped file, avoiding the per-file
+filesystem overhead of the Disk cache on single servers with very large
+numbers of tiles. Many processes can read and write one cache at a time,
+so it's safe to use with pre-forking servers such as Gunicorn.
+
+Example configuration:
+
+  "cache": {
+    "name": "LMDB",
+    "path": "/tmp/stache",
+    "map size": 1099511627776
+  }
+
+LMDB cache parameters:
+
+  path
+    Required local directory path where the database should be stored.
+
+  map size
+    Optional maximum size of the database in bytes. The map is sparse, so
+    the file only takes up as much disk space as the tiles stored in it.
+    Defaults to 1TB.
+
+Tiles saved while a tile lock is held, such as the tiles of a metatile, are
+written together in a single transaction when the lock is released. Locks are
+stored in a separate table in the same database, so they are shared by every
+process using the cache. Each lock holds its owner's process ID and a random
+token, and is only deleted by the owner, so a slow renderer whose stale lock
+was forced can't release somebody else's lock.
+
+If your configuration file is loaded from a remote location, e.g.
+"http://example.com/tilestache.cfg", the path *must* be an unambiguous
+filesystem path, e.g. "file:///tmp/cache"
+"""
+from __future__ import absolute_import
+from time import time as _time, sleep as _sleep
+from threading import local as _local, Lock as _Lock
+from struct import Struct
+from uuid import uuid4 as _uuid4
+from os import getpid
+
+# We enabled absolute_import because case insensitive filesystems
+# cause this file to be loaded twice (the name of this file
+# conflicts with the name of the module we want to import).
+# Forcing absolute imports fixes the issue.
+
+try:
+    import lmdb
+except ImportError:
+    # at least we can build the documentation
+    pass
+
+# zoom, column and row of a tile key, after the layer name; columns and
+# rows are signed, for projections with tiles on both sides of the origin.
+_coord = Struct('>Bii')
+
+# time of a save or lock, before the tile body or the lock owner's token.
+_stamp = Struct('>d')
+
+def tile_key(layer, coord, format):
+    """ Return a compact binary tile key string.
+    """
+    name = layer.name()
+
+    if type(name) is unicode:
+        name = name.encode('utf8')
+
+    xyz = _coord.pack(coord.zoom, coord.column, coord.row)
+    return name + '\0' + xyz + str(format.lower())
+
+class Cache:
+    """
+    """
+    def __init__(self, path, map_size=1<<40):
+        self.path = path
+        self.map_size = int(map_size)
+        self.env, self.pid = None, None
+        self.local = _local()
+        self.env_lock = _Lock()
+
+    def _environment(self):
+        """ Return an open LMDB environment and its tiles and locks tables.
+
+            Environments must not be used across a fork, so a new one
+            is opened for every new process, by just one of its threads.
+        """
+        if self.pid != getpid():
+            with self.env_lock:
+                if self.pid != getpid():
+                    self.env = lmdb.open(self.path, map_size=self.map_size, max_dbs=2)
+                    self.tiles = self.env.open_db('tiles')
+                    self.locks = self.env.open_db('locks')
+                    self.pid = getpid()
+
+        return self.env
+
+    def _pending(self):
+        """ Return this thread's list of saved tiles waiting for unlock().
+        """
+        if not hasattr(self.local, 'pending'):
+            self.local.pending, self.local.locks, self.local.tokens = [], 0, {}
+
+        return self.local.pending
+
+    def _write(self, txn, pending):
+        """ Write a list of (key, time, body) tiles in a transaction.
+        """
+        for (key, saved, body) in pending:
+            txn.put(key, _stamp.pack(saved) + body, db=self.tiles)
+
+    def lock(self, layer, coord, format):
+        """ Acquire a cache lock for this tile.
+
+            Returns nothing, but blocks until the lock has been acquired.
+            Lock is implemented as a row in the locks table, and LMDB only
+            allows one write transaction at a time so taking it is atomic.
+        """
+        env, key = self._environment(), tile_key(layer, coord, format)
+        token = '%d-%s' % (getpid(), _uuid4().hex)
+        due = _time() + layer.stale_lock_timeout
+
+        while True:
+            with env.begin(write=True) as txn:
+                value = txn.get(key, db=self.locks)
+                locked = value and _stamp.unpack_from(value)[0] or 0
+
+                # someone may have left the door locked.
+                stale = _time() - locked > layer.stale_lock_timeout
+
+                if value is None or stale or _time() > due:
+                    txn.put(key, _stamp.pack(_time()) + token, db=self.locks)
+                    break
+
+            _sleep(.2)
+
+        self._pending()
+        self.local.locks += 1
+        self.local.tokens[key] = token
+
+    def unlock(self, layer, coord, format):
+        """ Release a cache lock for this tile.
+
+            Tiles saved while the lock was held are written at the same time.
+            The lock is left alone if it was forced by someone else.
+        """
+        env, key = self._environment(), tile_key(layer, coord, format)
+        pending = self._pending()
+        token = self.local.tokens.pop(key, None)
+        self.local.locks = max(self.local.locks - 1, 0)
+
+        with env.begin(write=True) as txn:
+            if self.local.locks == 0:
+                self._write(txn, pending)
+                del pending[:]
+
+            value = txn.get(key, db=self.locks)
+
+            if value is not None and value[_stamp.size:] == token:
+                txn.delete(key, db=self.locks)
+
+    def remove(self, layer, coord, format):
+        """ Remove a cached tile.
+        """
+        env, key = self._environment(), tile_key(layer, coord, format)
+
+        with env.begin(write=True) as txn:
+            txn.delete(key, db=self.tiles)
+
+    def read(self, layer, coord, format):
+        """ Read a cached tile.
+
+            The tile is copied out of the memory map just once; buffers
+            from LMDB are only good until the transaction is over.
+        """
+        env, key = self._environment(), tile_key(layer, coord, format)
+
+        for (_key, saved, body) in self._pending():
+            if _key == key:
+                return body
+
+        with env.begin(buffers=True) as txn:
+            value = txn.get(key, db=self.tiles)
+
+            if value is None:
+                return None
+
+            saved = _stamp.unpack_from(value)[0]
+
+            if layer.cache_lifespan and _time() - saved > layer.cache_lifespan:
+                return None
+
+            return str(value[_stamp.size:])
+
+    def save(self, body, layer, coord, format):
+        """ Save a cached tile.
+
+            Tiles are held until unlock() when this thread has a lock.
+        """
+        env, key = self._environment(), tile_key(layer, coord, format)
+        pending = self._pending()
+
+        if self.local.locks:
+            pending.append((key, _time(), str(body)))
+            return
+
+        with env.begin(write=True) as txn:
+            self._write(txn, [(key, _time(), str(body))])
@@ -2,12 +2,17 @@
 
 ImageProvider is known as "mapnik" in TileStache config, GridProvider is
 known as "mapnik grid". Both require Mapnik to be installed; Grid requires
-Mapnik 2.0.0 and above.
+Mapnik 2.0.0 and above, and NumPy.
+
+Maps are loaded once per process and shared by every provider using the same
+mapfile, see get_sharedMap(). Providers have a prewarm() method to load their
+map before the first request, e.g. when a server worker starts.
 """
 from __future__ import absolute_import
 from time import time
 from os.path import exists
 from thread import allocate_lock
+from threading import Thread, Event
 from urlparse import urlparse, urljoin
 from itertools import count
 from glob import glob
@@ -29,6 +34,12 @@ except ImportError:
     # can still build documentation
     pass
 
+try:
+    import numpy
+except ImportError:
+    # only needed for grids
+    pass
+
 from TileStache.Core import KnownUnknown
 from TileStache.Geography import getProjectionByName
 
@@ -48,6 +59,12 @@ if 'mapnik' in locals():
 
 global_mapnik_lock = allocate_lock()
 
+# Loaded maps and the stamps of their mapfiles, by mapfile.
+_shared_maps = {}
+
+# Events set when maps being rebuilt after an error are ready, by mapfile.
+_pending_maps = {}
+
 class ImageProvider:
     """ Built-in Mapnik provider. Renders map images from Mapnik XML files.
 
@@ -68,13 +85,22 @@ class ImageProvider:
             For more information about the scale factor, see:
             https://github.com/mapnik/mapnik/wiki/Scale-factor
 
+        - grid (optional)
+            Dictionary of "mapnik grid" provider options: fields, layers,
+            layer_index, scale, and layer_id_key. The layer then also makes
+            UTF Grid tiles with the "json" extension, rendered in the same
+            pass as the image. Both are saved to the cache on each render,
+            so a request for one finds the other ready.
+
         More information on Mapnik and Mapnik XML:
         - http://mapnik.org
         - http://trac.mapnik.org/wiki/XMLGettingStarted
         - http://trac.mapnik.org/wiki/XMLConfigReference
     """
 
-    def __init__(self, layer, mapfile, fonts=None, scale_factor=None):
+    grid_layers = None
+
+    def __init__(self, layer, mapfile, fonts=None, scale_factor=None, grid=None):
         """ Initialize Mapnik provider with layer and mapfile.
 
             XML mapfile keyword arg comes from TileStache config,
@@ -89,7 +115,6 @@ class ImageProvider:
             self.mapfile = maphref
 
         self.layer = layer
-        self.mapnik = None
 
         engine = mapnik.FontEngine.instance()
 
@@ -105,6 +130,12 @@ class ImageProvider:
 
         self.scale_factor = scale_factor
 
+        if grid is not None:
+            fields, layer_index = grid.get('fields'), grid.get('layer_index')
+            self.grid_layers = grid.get('layers') or [[layer_index or 0, fields]]
+            self.grid_scale = grid.get('scale', 4)
+            self.grid_layer_id_key = grid.get('layer_id_key')
+
     @staticmethod
     def prepareKeywordArgs(config_dict):
         """ Convert configured parameters to keyword args for __init__().
@@ -117,35 +148,56 @@ class ImageProvider:
         if 'scale factor' in config_dict:
             kwargs['scale_factor'] = int(config_dict['scale factor'])
 
+        if 'grid' in config_dict:
+            kwargs['grid'] = config_dict['grid']
+
         return kwargs
 
+    def prewarm(self):
+        """ Load the shared map for this provider's mapfile.
+        """
+        prewarm_sharedMap(self.mapfile)
+
+    def getMap(self):
+        """ Return the mapnik.Map to render, with global_mapnik_lock held.
+        """
+        return get_sharedMap(self.mapfile)
+
+    def forgetMap(self, mmap):
+        """ Drop a map that failed to render, with global_mapnik_lock held.
+        """
+        rebuild_sharedMap(self.mapfile, mmap)
+
     def renderArea(self, width, height, srs, xmin, ymin, xmax, ymax, zoom):
         """
         """
         start_time = time()
+        mmap = None
 
         #
         # Mapnik can behave strangely when run in threads, so place a lock on the instance.
         #
         if global_mapnik_lock.acquire():
             try:
-                if self.mapnik is None:
-                    self.mapnik = get_mapnikMap(self.mapfile)
-                    logging.debug('TileStache.Mapnik.ImageProvider.renderArea() %.3f to load %s', time() - start_time, self.mapfile)
+                mmap = self.getMap()
 
-                self.mapnik.width = width
-                self.mapnik.height = height
-                self.mapnik.zoom_to_box(Box2d(xmin, ymin, xmax, ymax))
+                mmap.width = width
+                mmap.height = height
+                mmap.zoom_to_box(Box2d(xmin, ymin, xmax, ymax))
 
                 img = mapnik.Image(width, height)
                 # Don't even call render with scale factor if it's not
                 # defined. Plays safe with older versions.
                 if self.scale_factor is None:
-                    mapnik.render(self.mapnik, img)
+                    mapnik.render(mmap, img)
                 else:
-                    mapnik.render(self.mapnik, img, self.scale_factor)
+                    mapnik.render(mmap, img, self.scale_factor)
+
+                if self.grid_layers is not None:
+                    # same zoom, same lock, no second request for the grid.
+                    grid = _renderGrid(mmap, width, height, self.grid_layers, self.grid_scale, self.grid_layer_id_key)
             except:
-                self.mapnik = None
+                self.forgetMap(mmap)
                 raise
             finally:
                 # always release the lock
@@ -160,8 +212,28 @@ class ImageProvider:
         
         logging.debug('TileStache.Mapnik.ImageProvider.renderArea() %dx%d in %.3f from %s', width, height, time() - start_time, self.mapfile)
 
+        if self.grid_layers is not None:
+            return ImageGridResponse(img, grid)
+
         return img
 
+    def getTypeByExtension(self, extension):
+        """ Get mime-type and format by file extension.
+
+            This accepts "png" and "jpg", and "json" with a grid option.
+        """
+        if extension.lower() == 'png':
+            return 'image/png', 'PNG'
+
+        elif extension.lower() == 'jpg':
+            return 'image/jpeg', 'JPEG'
+
+        elif extension.lower() == 'json' and self.grid_layers is not None:
+            return 'application/json; charset=utf-8', 'JSON'
+
+        else:
+            raise KnownUnknown('Mapnik only makes .png and .jpg tiles, or .json with a grid, not "%s"' % extension)
+
 class GridProvider:
     """ Built-in UTF Grid provider. Renders JSON raster objects from Mapnik.
 
@@ -230,7 +302,6 @@ class GridProvider:
             XML mapfile keyword arg comes from TileStache config,
             and is an absolute path by the time it gets here.
         """
-        self.mapnik = None
         self.layer = layer
 
         maphref = urljoin(layer.config.dirpath, mapfile)
@@ -261,61 +332,38 @@ class GridProvider:
 
         return kwargs
 
+    def prewarm(self):
+        """ Load the shared map for this provider's mapfile.
+        """
+        prewarm_sharedMap(self.mapfile)
+
     def renderArea(self, width, height, srs, xmin, ymin, xmax, ymax, zoom):
         """
         """
         start_time = time()
+        mmap = None
 
         #
         # Mapnik can behave strangely when run in threads, so place a lock on the instance.
         #
         if global_mapnik_lock.acquire():
             try:
-                if self.mapnik is None:
-                    self.mapnik = get_mapnikMap(self.mapfile)
-                    logging.debug('TileStache.Mapnik.GridProvider.renderArea() %.3f to load %s', time() - start_time, self.mapfile)
-
-                self.mapnik.width = width
-                self.mapnik.height = height
-                self.mapnik.zoom_to_box(Box2d(xmin, ymin, xmax, ymax))
-
-                if self.layer_id_key is not None:
-                    grids = []
-
-                    for (index, fields) in self.layers:
-                        datasource = self.mapnik.layers[index].datasource
-                        fields = (type(fields) is list) and map(str, fields) or datasource.fields()
-
-                        grid = mapnik.render_grid(self.mapnik, index, resolution=self.scale, fields=fields)
-
-                        for key in grid['data']:
-                            grid['data'][key][self.layer_id_key] = self.mapnik.layers[index].name
+                mmap = get_sharedMap(self.mapfile)
 
-                        grids.append(grid)
+                mmap.width = width
+                mmap.height = height
+                mmap.zoom_to_box(Box2d(xmin, ymin, xmax, ymax))
 
-                    # global_mapnik_lock.release()
-                    outgrid = reduce(merge_grids, grids)
-
-                else:
-                    grid = mapnik.Grid(width, height)
-
-                    for (index, fields) in self.layers:
-                        datasource = self.mapnik.layers[index].datasource
-                        fields = (type(fields) is list) and map(str, fields) or datasource.fields()
-
-                        mapnik.render_layer(self.mapnik, grid, layer=index, fields=fields)
-
-                    # global_mapnik_lock.release()
-                    outgrid = grid.encode('utf', resolution=self.scale, features=True)
+                outgrid = _renderGrid(mmap, width, height, self.layers, self.scale, self.layer_id_key)
             except:
-                self.mapnik = None
+                rebuild_sharedMap(self.mapfile, mmap)
                 raise
             finally:
                 global_mapnik_lock.release()
 
         logging.debug('TileStache.Mapnik.GridProvider.renderArea() %dx%d at %d in %.3f from %s', width, height, self.scale, time() - start_time, self.mapfile)
 
-        return SaveableResponse(outgrid, self.scale)
+        return outgrid
 
     def getTypeByExtension(self, extension):
         """ Get mime-type and format by file extension.
@@ -331,11 +379,24 @@ class SaveableResponse:
     """ Wrapper class for JSON response that makes it behave like a PIL.Image object.
 
         TileStache.getTile() expects to be able to save one of these to a buffer.
+
+        The grid is kept as an array of key indexes until it's needed as
+        UTF Grid rows, so metatiles are cropped without decoding every row.
     """
     def __init__(self, content, scale):
-        self.content = content
+        self.keys, self.data = content['keys'], content.get('data', None)
+        self.ids = grid_ids(content['grid'])
         self.scale = scale
 
+    def __getattr__(self, name):
+        """ Build the JSON-ready content on first use of response.content.
+        """
+        if name != 'content':
+            raise AttributeError(name)
+
+        self.content = dict(keys=self.keys, data=self.data, grid=grid_rows(self.ids))
+        return self.content
+
     def save(self, out, format):
         if format != 'JSON':
             raise KnownUnknown('MapnikGrid only saves .json tiles, not "%s"' % format)
@@ -348,57 +409,140 @@ class SaveableResponse:
         """
         minchar, minrow, maxchar, maxrow = [v/self.scale for v in bbox]
 
-        keys, data = self.content['keys'], self.content.get('data', None)
-        grid = [row[minchar:maxchar] for row in self.content['grid'][minrow:maxrow]]
+        grid = self.ids[minrow:maxrow, minchar:maxchar]
 
-        cropped = dict(keys=keys, data=data, grid=grid)
+        cropped = dict(keys=self.keys, data=self.data, grid=grid)
         return SaveableResponse(cropped, self.scale)
 
+class ImageGridResponse:
+    """ Image and UTF Grid rendered together by ImageProvider with a grid option.
+
+        Layer.render() in TileStache.Core picks the tile for the requested
+        format from formats, and saves the other alongside it.
+    """
+    def __init__(self, image, grid):
+        self.formats = {'PNG': image, 'JSON': grid}
+
+    def save(self, out, format):
+        if format == 'JSON':
+            self.formats['JSON'].save(out, format)
+        else:
+            self.formats['PNG'].save(out, format)
+
+def _renderGrid(mmap, width, height, layers, scale, layer_id_key=None):
+    """ Render a UTF Grid response from a map that's already zoomed.
+
+        Layers is a list of (layer_index, fields). Call with global_mapnik_lock held.
+    """
+    if layer_id_key is not None:
+        grids = []
+
+        for (index, fields) in layers:
+            datasource = mmap.layers[index].datasource
+            fields = (type(fields) is list) and map(str, fields) or datasource.fields()
+
+            grid = mapnik.render_grid(mmap, index, resolution=scale, fields=fields)
+
+            for key in grid['data']:
+                grid['data'][key][layer_id_key] = mmap.layers[index].name
+
+            grids.append((grid['keys'], grid['data'], grid_ids(grid['grid'])))
+
+        keys, data, ids = reduce(merge_grid_arrays, grids)
+        outgrid = dict(keys=keys, data=data, grid=ids)
+
+    else:
+        grid = mapnik.Grid(width, height)
+
+        for (index, fields) in layers:
+            datasource = mmap.layers[index].datasource
+            fields = (type(fields) is list) and map(str, fields) or datasource.fields()
+
+            mapnik.render_layer(mmap, grid, layer=index, fields=fields)
+
+        outgrid = grid.encode('utf', resolution=scale, features=True)
+
+    return SaveableResponse(outgrid, scale)
+
 def merge_grids(grid1, grid2):
     """ Merge two UTF Grid objects.
     """
+    grid1 = grid1['keys'], grid1['data'], grid_ids(grid1['grid'])
+    grid2 = grid2['keys'], grid2['data'], grid_ids(grid2['grid'])
+
+    keys, data, ids = merge_grid_arrays(grid1, grid2)
+
+    return dict(keys=keys, data=data, grid=grid_rows(ids))
+
+def merge_grid_arrays(grid1, grid2):
+    """ Merge two (keys, data, ids) UTF Grids, with ids from grid_ids().
+
+        Used to merge many grids with reduce(), keeping the grids as
+        arrays until they're finally encoded.
+    """
+    (keys1, data1, ids1), (keys2, data2, ids2) = grid1, grid2
+
     #
     # Concatenate keys and data, assigning new indexes along the way.
     #
 
     keygen, outkeys, outdata = count(1), [], dict()
 
-    for ingrid in [grid1, grid2]:
-        for (index, key) in enumerate(ingrid['keys']):
-            if key not in ingrid['data']:
+    for (inkeys, indata) in [(keys1, data1), (keys2, data2)]:
+        for (index, key) in enumerate(inkeys):
+            if key not in indata:
                 outkeys.append('')
                 continue
 
             outkey = '%d' % keygen.next()
             outkeys.append(outkey)
 
-            datum = ingrid['data'][key]
+            datum = indata[key]
             outdata[outkey] = datum
 
     #
-    # Merge the two grids, one on top of the other.
+    # Merge the two grids, one on top of the other: transparent pixels
+    # use the bottom index, opaque pixels the top one.
     #
 
-    offset, outgrid = len(grid1['keys']), []
+    transparent = numpy.array([key == '' for key in keys2], dtype=bool)
+    outids = numpy.where(transparent[ids2], ids1, ids2 + len(keys1))
 
-    def newchar(char1, char2):
-        """ Return a new encoded character based on two inputs.
-        """
-        id1, id2 = decode_char(char1), decode_char(char2)
+    return outkeys, outdata, outids
 
-        if grid2['keys'][id2] == '':
-            # transparent pixel, use the bottom character
-            return encode_id(id1)
+def grid_ids(grid):
+    """ Decode a list of UTF Grid rows to a two-dimensional array of indexes.
 
-        else:
-            # opaque pixel, use the top character
-            return encode_id(id2 + offset)
+        See decode_char(); arrays are returned unchanged.
+    """
+    if isinstance(grid, numpy.ndarray):
+        return grid
+
+    if not grid:
+        return numpy.zeros((0, 0), dtype=numpy.int32)
+
+    text = u''.join([unicode(row) for row in grid])
+    ids = numpy.frombuffer(text.encode('utf-32-le'), dtype='<u4').astype(numpy.int32)
+    ids = ids.reshape(len(grid), -1)
+
+    ids -= (ids >= 93)
+    ids -= (ids >= 35)
+
+    return ids - 32
 
-    for (row1, row2) in zip(grid1['grid'], grid2['grid']):
-        outrow = [newchar(c1, c2) for (c1, c2) in zip(row1, row2)]
-        outgrid.append(''.join(outrow))
+def grid_rows(ids):
+    """ Encode a two-dimensional array of indexes to a list of UTF Grid rows.
 
-    return dict(keys=outkeys, data=outdata, grid=outgrid)
+        See encode_id().
+    """
+    chars = ids + 32
+    chars += (chars >= 34)
+    chars += (chars >= 92)
+
+    text = chars.astype('<u4').tostring().decode('utf-32-le')
+    height, width = ids.shape
+
+    return [text[row*width:(row+1)*width] for row in range(height)]
 
 def encode_id(id):
     id += 32
@@ -435,3 +579,103 @@ def get_mapnikMap(mapfile):
         os.unlink(filename)
 
     return mmap
+
+def _mapfileStamp(mapfile):
+    """ Return modification time and size of a local mapfile, or None for a URL.
+    """
+    if exists(mapfile):
+        info = os.stat(mapfile)
+        return info.st_mtime, info.st_size
+
+    return None
+
+def get_sharedMap(mapfile):
+    """ Get a mapnik.Map instance for a mapfile, shared within this process.
+
+        Maps are loaded once and kept until a local mapfile changes; maps
+        from URLs are downloaded once. Call with global_mapnik_lock held,
+        because every provider with the same mapfile uses the same map.
+        While a map is rebuilt by rebuild_sharedMap(), the lock is released
+        to wait for the new map rather than loading another one.
+    """
+    while mapfile in _pending_maps:
+        pending = _pending_maps[mapfile]
+        global_mapnik_lock.release()
+
+        try:
+            pending.wait()
+        finally:
+            global_mapnik_lock.acquire()
+
+    stamp = _mapfileStamp(mapfile)
+
+    if mapfile in _shared_maps:
+        mmap, mmap_stamp = _shared_maps[mapfile]
+
+        if mmap_stamp == stamp:
+            return mmap
+
+    start_time = time()
+    mmap = get_mapnikMap(mapfile)
+    _shared_maps[mapfile] = mmap, stamp
+
+    logging.debug('TileStache.Mapnik.get_sharedMap() %.3f to load %s', time() - start_time, mapfile)
+
+    return mmap
+
+def prewarm_sharedMap(mapfile):
+    """ Load the shared map for a mapfile ahead of its first request.
+
+        Errors are logged, and loading is tried again on the next request.
+    """
+    global_mapnik_lock.acquire()
+
+    try:
+        get_sharedMap(mapfile)
+
+    except Exception, e:
+        logging.error('TileStache.Mapnik.prewarm_sharedMap() failed to load %s: %s', mapfile, e)
+
+    finally:
+        global_mapnik_lock.release()
+
+def _rebuildMap(mapfile):
+    """ Load a shared map for rebuild_sharedMap() and wake everyone waiting.
+    """
+    global_mapnik_lock.acquire()
+    pending = _pending_maps.pop(mapfile)
+
+    try:
+        get_sharedMap(mapfile)
+
+    except Exception, e:
+        # waiting requests will try again themselves.
+        logging.error('TileStache.Mapnik.rebuild_sharedMap() failed to load %s: %s', mapfile, e)
+
+    finally:
+        global_mapnik_lock.release()
+        pending.set()
+
+def rebuild_sharedMap(mapfile, mmap):
+    """ Replace a shared map after an error, in a background thread.
+
+        The broken map is forgotten right away so no one else renders with it,
+        and the request that failed doesn't wait for its replacement. Requests
+        for the same mapfile wait for the new map in get_sharedMap(), and only
+        one rebuild runs at a time. Call with global_mapnik_lock held; loading
+        starts after the lock is released.
+    """
+    if mapfile in _pending_maps:
+        # already being rebuilt.
+        return
+
+    if mapfile not in _shared_maps or _shared_maps[mapfile][0] is not mmap:
+        # not a shared map, already replaced, or never loaded.
+        return
+
+    del _shared_maps[mapfile]
+    _pending_maps[mapfile] = Event()
+
+    thread = Thread(target=_rebuildMap, args=(mapfile, ))
+    thread.setDaemon(True)
+    thread.start()
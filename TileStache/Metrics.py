@@ -0,0 +1,156 @@
+""" In-process counters and histograms for tile requests.
+
+TileStache records a few measurements for every tile it serves, broken down
+by layer name, zoom level, and format:
+
+- tilestache_tiles_total: count of tiles by source, one of "cache",
+  "cache after all", "layer.render()", or "recent tiles".
+- tilestache_tile_seconds: total time to produce a tile response.
+- tilestache_lock_wait_seconds: time spent waiting for a cache lock.
+- tilestache_render_seconds: time spent in Layer.render().
+- tilestache_encode_seconds: time spent encoding a rendered tile.
+- tilestache_cache_save_seconds: time spent saving a tile to the cache.
+- tilestache_response_bytes: size of tile response bodies.
+
+Measurements are kept in one process, shared by all of its threads. They can
+be served in Prometheus text format by TileStache.WSGITileServer with its
+metrics_path argument, or by tilestache-server.py with --metrics-path:
+
+    app = TileStache.WSGITileServer('/path/to/tilestache.cfg', metrics_path='/metrics')
+
+Each process of a multi-process server keeps its own measurements, and
+Prometheus should be set up to scrape each one.
+"""
+from threading import Lock
+from bisect import bisect_left
+
+# Histogram bucket upper bounds for durations in seconds and for sizes in bytes.
+time_buckets = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30)
+size_buckets = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+_help = {
+    'tilestache_tiles_total': ('counter', 'Tiles served, by source.'),
+    'tilestache_tile_seconds': ('histogram', 'Time to produce a tile response.'),
+    'tilestache_lock_wait_seconds': ('histogram', 'Time spent waiting for a cache lock.'),
+    'tilestache_render_seconds': ('histogram', 'Time spent in Layer.render().'),
+    'tilestache_encode_seconds': ('histogram', 'Time spent encoding a rendered tile.'),
+    'tilestache_cache_save_seconds': ('histogram', 'Time spent saving a tile to the cache.'),
+    'tilestache_response_bytes': ('histogram', 'Size of tile response bodies.')
+    }
+
+class Histogram:
+    """ Cumulative histogram with fixed bucket upper bounds.
+    """
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+class Registry:
+    """ Collection of labeled counters and histograms, safe to share across threads.
+    """
+    def __init__(self):
+        self.lock = Lock()
+        self.counters = {}
+        self.histograms = {}
+
+    def increment(self, name, labels, amount=1):
+        """ Add to a counter, given a name and a tuple of (label, value) pairs.
+        """
+        with self.lock:
+            key = (name, labels)
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, labels, value, buckets=time_buckets):
+        """ Add a value to a histogram, given a name and a tuple of (label, value) pairs.
+        """
+        with self.lock:
+            key = (name, labels)
+
+            if key not in self.histograms:
+                self.histograms[key] = Histogram(buckets)
+
+            self.histograms[key].observe(value)
+
+    def clear(self):
+        with self.lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+    def text(self):
+        """ Return all measurements in Prometheus text exposition format.
+        """
+        lines, seen = [], set()
+
+        def describe(name):
+            if name not in seen and name in _help:
+                kind, help = _help[name]
+                lines.append('# HELP %s %s' % (name, help))
+                lines.append('# TYPE %s %s' % (name, kind))
+            seen.add(name)
+
+        with self.lock:
+            for ((name, labels), value) in sorted(self.counters.items()):
+                describe(name)
+                lines.append('%s%s %s' % (name, _labels(labels), _number(value)))
+
+            for ((name, labels), histogram) in sorted(self.histograms.items()):
+                describe(name)
+                count = 0
+
+                for (bound, bucket_count) in zip(histogram.buckets + ('+Inf', ), histogram.counts):
+                    count += bucket_count
+                    le = labels + (('le', _number(bound)), )
+                    lines.append('%s_bucket%s %d' % (name, _labels(le), count))
+
+                lines.append('%s_sum%s %s' % (name, _labels(labels), _number(histogram.sum)))
+                lines.append('%s_count%s %d' % (name, _labels(labels), count))
+
+        return '\n'.join(lines) + '\n'
+
+def _labels(labels):
+    """ Format a tuple of (label, value) pairs like {layer="osm",zoom="4"}.
+    """
+    if not labels:
+        return ''
+
+    escape = lambda v: unicode(v).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+    pairs = ['%s="%s"' % (label, escape(value)) for (label, value) in labels]
+
+    return (u'{%s}' % ','.join(pairs)).encode('utf8')
+
+def _number(value):
+    """ Format a number for Prometheus, using "+Inf" unchanged.
+    """
+    if type(value) in (int, long) or value == '+Inf':
+        return str(value)
+
+    return repr(float(value))
+
+# Shared registry for this process.
+registry = Registry()
+
+def recordTile(layer, coord, format, tile_from, timings, elapsed, body):
+    """ Record measurements for a single tile response from Layer.getTileResponse().
+
+        Timings is a dictionary of elapsed seconds that may include keys
+        "lock", "render", "encode", and "save".
+    """
+    labels = (('layer', layer.name()), ('zoom', coord.zoom), ('format', format))
+
+    registry.increment('tilestache_tiles_total', labels + (('source', tile_from), ))
+    registry.observe('tilestache_tile_seconds', labels, elapsed)
+
+    for (key, name) in (('lock', 'tilestache_lock_wait_seconds'),
+                        ('render', 'tilestache_render_seconds'),
+                        ('encode', 'tilestache_encode_seconds'),
+                        ('save', 'tilestache_cache_save_seconds')):
+        if key in timings:
+            registry.observe(name, labels, timings[key])
+
+    if body is not None:
+        registry.observe('tilestache_response_bytes', labels, len(body), size_buckets)
@@ -54,7 +54,7 @@ Options are:
     }
 """
 
-from PIL import Image, ImageFilter
+from PIL import Image
 
 
 def put_original_alpha(original_image, new_image):
@@ -159,6 +159,8 @@ class Blur(PixelEffect):
         self.radius = max(radius, 0)  # 0 <= radius
 
     def apply_effect(self, image):
+        # ImageFilter imports numpy, so wait until it's needed.
+        from PIL import ImageFilter
         return image.filter(ImageFilter.GaussianBlur(self.radius))
 
 
@@ -116,7 +116,14 @@ def apply_palette(image, palette, t_index):
 
     return output
 
-def apply_palette256(image):
+def apply_palette256(image, palette=None):
     """ Get PIL to generate and apply an optimum 256 color palette to the given image and return it
+
+        Optional palette argument is a paletted image whose colors are
+        used instead, which is much faster than generating new ones.
+        Undithered quantizing to a given palette needs Pillow 6.0 or newer.
     """
+    if palette is not None:
+        return image.convert('RGB').quantize(palette=palette, dither=Image.NONE)
+
     return image.convert('RGB').convert('P', palette=Image.ADAPTIVE, colors=256, dither=Image.NONE)
@@ -91,17 +91,22 @@ import Geography
 
 # This import should happen inside getProviderByName(), but when testing
 # on Mac OS X features are missing from output. Wierd-ass C libraries...
-try:
-    from . import Vector
-except ImportError:
-    pass
+class _Vector:
+    """ Stand-in for the TileStache.Vector module, imported on first use.
+    """
+    def __getattr__(self, name):
+        from . import Vector
+        return getattr(Vector, name)
+
+Vector = _Vector()
 
 # Already deprecated; provided for temporary backward-compatibility with
 # old location of Mapnik provider. TODO: remove in next major version.
-try:
-    from .Mapnik import ImageProvider as Mapnik
-except ImportError:
-    pass
+def Mapnik(layer, *args, **kwargs):
+    """ Build a TileStache.Mapnik.ImageProvider, imported when first called.
+    """
+    from .Mapnik import ImageProvider
+    return ImageProvider(layer, *args, **kwargs)
 
 def getProviderByName(name):
     """ Retrieve a provider object by name.
@@ -36,11 +36,21 @@ Redis cache parameters:
     collisions (though the prefered solution is to use a different
     db number). The key prefix will be prepended to the
     key name. Defaults to "".
-    
+
+Locks are taken with a single SET NX PX command holding a random per-owner
+token, and expire on their own after the layer's stale lock timeout. They are
+released by a small Lua script that only deletes a lock still holding the
+caller's token, so a slow renderer can't release somebody else's lock. The
+same script publishes to a channel named after the lock key, waking any
+processes waiting for the lock without polling. A caller still waiting after
+the stale lock timeout renders its tile without the lock, rather than taking
+it from its owner.
 
 """
 from __future__ import absolute_import
-from time import time as _time, sleep as _sleep
+from time import time as _time
+from uuid import uuid4 as _uuid4
+from threading import local as _local
 
 # We enabled absolute_import because case insensitive filesystems
 # cause this file to be loaded twice (the name of this file
@@ -63,6 +73,17 @@ def tile_key(layer, coord, format, key_prefix):
     return key
 
 
+# Delete a lock only if it still holds the owner's token, then announce it.
+_unlock_script = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    redis.call('del', KEYS[1])
+    redis.call('publish', ARGV[2], 'unlocked')
+    return 1
+end
+return 0
+"""
+
+
 class Cache:
     """
     """
@@ -71,31 +92,58 @@ class Cache:
         self.port = port
         self.db = db
         self.conn = redis.Redis(host=self.host, port=self.port, db=self.db)
+        self.unlock_script = self.conn.register_script(_unlock_script)
         self.key_prefix = key_prefix
+        self.local = _local()
+
+    def _tokens(self):
+        """ Return this thread's dictionary of lock tokens by lock key.
+        """
+        if not hasattr(self.local, 'tokens'):
+            self.local.tokens = {}
+
+        return self.local.tokens
 
 
     def lock(self, layer, coord, format):
         """ Acquire a cache lock for this tile.
-            Returns nothing, but blocks until the lock has been acquired.
+            Returns nothing, but blocks until the lock has been acquired
+            or the layer's stale lock timeout has passed.
         """
-        key = tile_key(layer, coord, format, self.key_prefix) + "-lock" 
-        due = _time() + layer.stale_lock_timeout
+        key = tile_key(layer, coord, format, self.key_prefix) + "-lock"
+        token = _uuid4().hex
+        timeout = layer.stale_lock_timeout
+        px = max(int(timeout * 1000), 1)
 
-        while _time() < due:
-            if self.conn.setnx(key, 'locked.'):
-                return
+        if not self.conn.set(key, token, nx=True, px=px):
+            # Someone else has the lock, wait to hear that it was released.
+            due = _time() + timeout
+            pubsub = self.conn.pubsub()
 
-            _sleep(.2)
+            try:
+                pubsub.subscribe(key)
+
+                while not self.conn.set(key, token, nx=True, px=px):
+                    if _time() > due:
+                        # someone left the door locked, go on without it.
+                        return
+
+                    pubsub.get_message(timeout=max(min(due - _time(), 1.), 0))
+
+            finally:
+                pubsub.close()
+
+        self._tokens()[key] = token
 
-        self.conn.set(key, 'locked.')
-        return
-        
     def unlock(self, layer, coord, format):
         """ Release a cache lock for this tile.
         """
-        key = tile_key(layer, coord, format, self.key_prefix)
-        self.conn.delete(key+'-lock')
-        
+        key = tile_key(layer, coord, format, self.key_prefix) + "-lock"
+        token = self._tokens().pop(key, None)
+
+        if token is not None:
+            self.unlock_script(keys=[key], args=[token, key])
+
     def remove(self, layer, coord, format):
         """ Remove a cached tile.
         """
@@ -30,6 +30,9 @@ S3 cache parameters:
     Optional boolean flag for whether to use the locking feature on S3.
     True by default. A good reason to set this to false would be the
     additional price and time required for each lock set in S3.
+    Use "local" for in-process locks that cost no S3 requests at all,
+    a good fit for a single server. In a Multi cache only the first tier
+    is locked, so S3 locks can be turned off when S3 is a later tier.
     
   path
     Optional path under bucket to use as the cache dir. ex. 'cache' will 
@@ -45,8 +48,12 @@ Access and secret keys are under "Security Credentials" at your AWS account page
 When access or secret are not provided, the environment variables
 AWS_ACCESS_KEY_ID and AWS_SECRET_ACCESS_KEY will be used
     http://docs.pythonboto.org/en/latest/s3_tut.html#creating-a-connection
+
+Caches with the same credentials share a single S3 connection, and with it
+boto's thread-safe pool of HTTP connections.
 """
 from time import time as _time, sleep as _sleep
+from threading import Lock, Condition
 from mimetypes import guess_type
 from time import strptime, time
 from calendar import timegm
@@ -54,10 +61,26 @@ from calendar import timegm
 try:
     from boto.s3.bucket import Bucket as S3Bucket
     from boto.s3.connection import S3Connection
+    from boto.exception import S3ResponseError
 except ImportError:
     # at least we can build the documentation
     pass
 
+# S3 connections keyed on credentials, shared by all threads and caches.
+_connections, _connections_lock = {}, Lock()
+
+# Tile keys locked in this process when use_locks is "local".
+_local_locks, _local_locks_cond = set(), Condition()
+
+def _connection(access, secret):
+    """ Return a shared S3 connection for a pair of credentials.
+    """
+    with _connections_lock:
+        if (access, secret) not in _connections:
+            _connections[(access, secret)] = S3Connection(access, secret)
+
+        return _connections[(access, secret)]
+
 def tile_key(layer, coord, format, path = ''):
     """ Return a tile key string.
     """
@@ -72,8 +95,8 @@ class Cache:
     """
     """
     def __init__(self, bucket, access=None, secret=None, use_locks=True, path='', reduced_redundancy=False, policy='public-read'):
-        self.bucket = S3Bucket(S3Connection(access, secret), bucket)
-        self.use_locks = bool(use_locks)
+        self.bucket = S3Bucket(_connection(access, secret), bucket)
+        self.use_locks = (use_locks == 'local') and 'local' or bool(use_locks)
         self.path = path
         self.reduced_redundancy = reduced_redundancy
         self.policy = policy
@@ -90,6 +113,15 @@ class Cache:
         key_name = tile_key(layer, coord, format, self.path)
         due = _time() + layer.stale_lock_timeout
         
+        if self.use_locks == 'local':
+            with _local_locks_cond:
+                while key_name in _local_locks and _time() < due:
+                    _local_locks_cond.wait(due - _time())
+                
+                _local_locks.add(key_name)
+            
+            return
+        
         while _time() < due:
             if not self.bucket.get_key(key_name+'-lock'):
                 break
@@ -106,6 +138,14 @@ class Cache:
             return
 
         key_name = tile_key(layer, coord, format, self.path)
+        
+        if self.use_locks == 'local':
+            with _local_locks_cond:
+                _local_locks.discard(key_name)
+                _local_locks_cond.notify_all()
+            
+            return
+        
         self.bucket.delete_key(key_name+'-lock')
         
     def remove(self, layer, coord, format):
@@ -116,20 +156,27 @@ class Cache:
         
     def read(self, layer, coord, format):
         """ Read a cached tile.
+        
+            Uses a single GET request, a missing tile is a 404 response.
         """
         key_name = tile_key(layer, coord, format, self.path)
-        key = self.bucket.get_key(key_name)
-
-        if key is None:
-            return None
+        key = self.bucket.new_key(key_name)
+        
+        try:
+            body = key.get_contents_as_string()
+        except S3ResponseError, e:
+            if e.status == 404:
+                return None
+            raise
         
         if layer.cache_lifespan:
+            # last_modified comes from the headers of the GET response.
             t = timegm(strptime(key.last_modified, '%a, %d %b %Y %H:%M:%S %Z'))
 
             if (time() - t) > layer.cache_lifespan:
                 return None
         
-        return key.get_contents_as_string()
+        return body
         
     def save(self, body, layer, coord, format):
         """ Save a cached tile.
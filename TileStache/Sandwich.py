@@ -4,11 +4,16 @@ The Sandwich Provider supplies a Photoshop-like rendering pipeline, making it
 possible to use the output of other configured tile layers as layers or masks
 to create a combined output. Sandwich is modeled on Lars Ahlzen's TopOSM.
 
-The external "Blit" library is required by Sandwich, and can be installed
-via Pip, easy_install, or directly from Github:
+NumPy is required by Sandwich. Blend modes and adjustments follow the
+external "Blit" library, which is no longer needed:
 
     https://github.com/migurski/Blit
 
+Each stack is prepared once when its layer is configured, and image files
+referenced by local filename or URL are read and decoded only once. The
+sixteen most recently used images are kept, and local files are read again
+when they change.
+
 The "stack" configuration parameter describes a layer or stack of layers that
 can be combined to create output. A simple stack that merely outputs a single
 color orange tile looks like this:
@@ -57,9 +62,9 @@ to 50% gray while leaving black and white alone:
     {"src": "hillshading", "adjustments": [ ["curves", [0, 181, 255]] ]}
 
 Available adjustments:
-  "threshold" - Blit.adjustments.threshold()
-  "curves" - Blit.adjustments.curves()
-  "curves2" - Blit.adjustments.curves2()
+  "threshold" - TileStache.Sandwich.threshold()
+  "curves" - TileStache.Sandwich.curves()
+  "curves2" - TileStache.Sandwich.curves2()
 
 See detailed information about adjustments in Blit documentation:
 
@@ -117,14 +122,22 @@ A complete example configuration might look like this:
       }
     }
 """
+from os import stat
 from re import search
 from StringIO import StringIO
-from itertools import product
-from urlparse import urljoin
+from threading import Lock
+from collections import OrderedDict
+from urlparse import urljoin, urlparse
 from urllib import urlopen
 
 from . import Core
 
+try:
+    import numpy
+except ImportError:
+    # At least we can build the docs
+    pass
+
 try:
     import Image
 except ImportError:
@@ -133,37 +146,21 @@ except ImportError:
     except ImportError:
         from PIL import Image
 
-try:
-    import Blit
-
-    blend_modes = {
-        'screen': Blit.blends.screen,
-        'add': Blit.blends.add,
-        'multiply': Blit.blends.multiply,
-        'subtract': Blit.blends.subtract,
-        'linear light': Blit.blends.linear_light,
-        'hard light': Blit.blends.hard_light
-        }
-
-    adjustment_names = {
-        'threshold': Blit.adjustments.threshold,
-        'curves': Blit.adjustments.curves,
-        'curves2': Blit.adjustments.curves2
-        }
-
-except ImportError:
-    # Well, this will not work.
-    pass
-
 class Provider:
     """ Sandwich Provider.
     
         Stack argument is a list of layer dictionaries described in module docs.
+        Each layer is checked and prepared once here, so drawing a tile does
+        no parsing of colors, adjustments, or blend modes.
     """
     def __init__(self, layer, stack):
         self.layer = layer
-        self.config = layer.config
         self.stack = stack
+        
+        if type(stack) is dict:
+            stack = [stack]
+        
+        self.operations = [Operation(sublayer) for sublayer in stack]
     
     @staticmethod
     def prepareKeywordArgs(config_dict):
@@ -175,129 +172,455 @@ class Provider:
         
         rendered = self.draw_stack(coord, dict())
         
-        if rendered.size() == (width, height):
-            return rendered.image()
+        if rendered.shape[1:] == (1, 1):
+            # a stack of only colors has no intrinsic size.
+            return Image.new('RGBA', (width, height), tuple([int(c * 255) for c in rendered.flat]))
+        
+        image = rgba2img(rendered)
+        
+        if image.size == (width, height):
+            return image
         else:
-            return rendered.image().resize((width, height))
+            return image.resize((width, height))
 
     def draw_stack(self, coord, tiles):
         """ Render this image stack.
 
-            Given a coordinate, return an output image with the results of all the
-            layers in this stack pasted on in turn.
+            Given a coordinate, return an output RGBA array with the results
+            of all the layers in this stack pasted on in turn. The array has
+            shape (4, height, width) with float values in 0-1 range, or shape
+            (4, 1, 1) for a single color if no layer had a size.
         
             Final argument is a dictionary used to temporarily cache results
             of layers retrieved from layer_bitmap(), to speed things up in case
             of repeatedly-used identical images.
         """
         # start with an empty base
-        rendered = Blit.Color(0, 0, 0, 0)
+        rendered = numpy.zeros((4, 1, 1), numpy.float32)
+        config = self.layer.config
     
-        for layer in self.stack:
-            if 'zoom' in layer and not in_zoom(coord, layer['zoom']):
+        for operation in self.operations:
+            if not operation.in_zoom(coord):
                 continue
 
             #
             # Prepare pixels from elsewhere.
             #
         
-            source_name, mask_name, color_name = [layer.get(k, None) for k in ('src', 'mask', 'color')]
-    
-            if source_name and color_name and mask_name:
-                raise Core.KnownUnknown("You can't specify src, color and mask together in a Sandwich Layer: %s, %s, %s" % (repr(source_name), repr(color_name), repr(mask_name)))
+            source_name, mask_name = operation.source_name, operation.mask_name
         
             if source_name and source_name not in tiles:
-                if source_name in self.config.layers:
-                    tiles[source_name] = layer_bitmap(self.config.layers[source_name], coord)
+                if source_name in config.layers:
+                    tiles[source_name] = layer_bitmap(config.layers[source_name], coord)
                 else:
-                    tiles[source_name] = local_bitmap(source_name, self.config, coord, self.layer.dim)
+                    tiles[source_name] = local_bitmap(source_name, config, coord, self.layer.dim)
         
             if mask_name and mask_name not in tiles:
-                tiles[mask_name] = layer_bitmap(self.config.layers[mask_name], coord)
+                tiles[mask_name] = layer_bitmap(config.layers[mask_name], coord)
+            
+            rendered = operation.draw(rendered, tiles)
+    
+        return rendered
+
+class Operation:
+    """ One layer of a Sandwich stack, prepared at configuration time.
+    
+        Colors are parsed, adjustments are compiled to functions, and blend
+        modes are looked up once, and drawing reuses them for every tile.
+    """
+    def __init__(self, layer):
+        source_name, mask_name, color_name = [layer.get(k, None) for k in ('src', 'mask', 'color')]
+
+        if source_name and color_name and mask_name:
+            raise Core.KnownUnknown("You can't specify src, color and mask together in a Sandwich Layer: %s, %s, %s" % (repr(source_name), repr(color_name), repr(mask_name)))
         
-            #
-            # Build up the foreground layer.
-            #
+        if mask_name and not (source_name or color_name):
+            raise Core.KnownUnknown("You have to provide more than just a mask to Sandwich Layer: %s" % repr(mask_name))
+
+        if not (source_name or color_name):
+            raise Core.KnownUnknown("You have to provide at least some combination of src, color and mask to Sandwich Layer")
         
-            if source_name and color_name:
-                # color first, then layer
-                foreground = make_color(color_name).blend(tiles[source_name])
+        self.source_name = source_name
+        self.mask_name = mask_name
+        self.color = color_name and make_color(color_name)
+        self.zooms = 'zoom' in layer and zoom_range(layer['zoom']) or None
         
-            elif source_name:
-                foreground = tiles[source_name]
+        self.adjustments = []
         
-            elif color_name:
-                foreground = make_color(color_name)
-
-            elif mask_name:
-                raise Core.KnownUnknown("You have to provide more than just a mask to Sandwich Layer: %s" % repr(mask_name))
+        for (name, args) in layer.get('adjustments', []):
+            if name not in adjustment_names:
+                raise Core.KnownUnknown("Unknown adjustment in a Sandwich Layer: %s" % repr(name))
+            
+            self.adjustments.append(adjustment_names[name](*args))
+        
+        self.opacity = float(layer.get('opacity', 1.0))
+        self.blendfunc = blend_modes.get(layer.get('mode', None), None)
+    
+    def in_zoom(self, coord):
+        """ Return True if this layer should be drawn at the coordinate's zoom.
+        """
+        if self.zooms is None:
+            return True
+        
+        min_zoom, max_zoom = self.zooms
+        return min_zoom <= coord.zoom and coord.zoom <= max_zoom
+    
+    def draw(self, rendered, tiles):
+        """ Return a new RGBA array with this layer blended onto rendered.
+        
+            Tiles is a dictionary of RGBA arrays for sources and masks.
+        """
+        if self.source_name and self.color is not None:
+            # color first, then layer
+            foreground = blend(self.color, tiles[self.source_name], None, 1, None)
+        
+        elif self.source_name:
+            foreground = tiles[self.source_name]
+        
+        else:
+            foreground = self.color
+        
+        for adjustfunc in self.adjustments:
+            foreground = adjustfunc(foreground)
+        
+        if self.mask_name:
+            return blend(rendered, foreground, tiles[self.mask_name], self.opacity, self.blendfunc)
+        else:
+            return blend(rendered, foreground, None, self.opacity, self.blendfunc)
 
-            else:
-                raise Core.KnownUnknown("You have to provide at least some combination of src, color and mask to Sandwich Layer")
+def blend(bottom, top, mask=None, opacity=1, blendfunc=None):
+    """ Return a new RGBA array, with data from another array blended on top.
+    
+        Arrays are either (4, height, width) images or (4, 1, 1) colors, and
+        inputs are never modified. Output size is the size of the first of
+        bottom, top, and mask that has one. Mask is used for its luminance.
+    """
+    for layer in (bottom, top, mask):
+        if layer is not None and layer.shape[1:] != (1, 1):
+            dim = layer.shape[1:]
+            break
+    else:
+        dim = (1, 1)
+    
+    bottom, top = fit(bottom, dim), fit(top, dim)
+    alpha_chan = top[3]
+    
+    if mask is not None:
+        #
+        # Use the RGB information from the supplied mask,
+        # but convert it to a single channel as in YUV:
+        # http://en.wikipedia.org/wiki/YUV#Conversion_to.2Ffrom_RGB
+        #
+        mask = fit(mask, dim)
+        alpha_chan = alpha_chan * (0.299 * mask[0] + 0.587 * mask[1] + 0.114 * mask[2])
+    
+    if opacity == 0 or not alpha_chan.any():
+        # no-op for zero opacity or empty mask
+        return bottom
+    
+    bottom_rgb, bottom_alpha = bottom[:3], bottom[3]
+    
+    if blendfunc:
+        output_rgb = blendfunc(bottom_rgb, top[:3])
+    else:
+        # plain old paste
+        output_rgb = top[:3]
+    
+    # combined effective mask channel
+    if opacity < 1:
+        alpha_chan = alpha_chan * numpy.float32(opacity)
+    
+    output = numpy.empty((4, ) + dim, numpy.float32)
+    
+    if (alpha_chan < 1).any():
+        #
+        # We have some shades of gray to take care of. Math borrowed from
+        # Wikipedia; C0 is the variable alpha_denom:
+        # http://en.wikipedia.org/wiki/Alpha_compositing#Analytical_derivation_of_the_over_operator
+        #
+        # Output alpha is the screen of the existing and overlaid alphas,
+        # which is the same as alpha_denom.
+        #
+        output[3] = 1 - (1 - alpha_chan) * (1 - bottom_alpha)
+        nz = output[3] > 0 # non-zero alpha denominator
         
-            #
-            # Do the final composition with adjustments and blend modes.
-            #
+        alpha_ratio = alpha_chan / numpy.where(nz, output[3], 1)
+        numpy.multiply(output_rgb, alpha_ratio, output[:3])
+        
+        # let the zeros perish, where alpha_ratio is also zero
+        bottom_ratio = 1 - alpha_ratio
+        bottom_ratio *= nz
+        
+        for c in (0, 1, 2):
+            output[c] += bottom_rgb[c] * bottom_ratio
+    
+    else:
+        output[:3] = output_rgb
+        output[3] = screen(bottom_alpha, alpha_chan)
+    
+    return output
+
+def fit(rgba, dim):
+    """ Return an RGBA array clipped or extended with zeros to the given size.
+    
+        Colors have no size and are returned unchanged.
+    """
+    if rgba.shape[1:] in ((1, 1), dim):
+        return rgba
+    
+    output = numpy.zeros((4, ) + dim, numpy.float32)
+    h, w = min(dim[0], rgba.shape[1]), min(dim[1], rgba.shape[2])
+    output[:, :h, :w] = rgba[:, :h, :w]
+    
+    return output
+
+#
+# Blend functions accept two floating point RGB arrays
+# with values in 0-1 range and return a third.
+#
+
+def screen(bottom, top):
+    """ Screen blend function.
+    
+        Math from http://illusions.hu/effectwiki/doku.php?id=screen_blending
+    """
+    return 1 - (1 - bottom) * (1 - top)
+
+def add(bottom, top):
+    """ Additive blend function.
+    
+        Math from http://illusions.hu/effectwiki/doku.php?id=additive_blending
+    """
+    return numpy.clip(bottom + top, 0, 1)
+
+def multiply(bottom, top):
+    """ Multiply blend function.
+    
+        Math from http://illusions.hu/effectwiki/doku.php?id=multiply_blending
+    """
+    return bottom * top
+
+def subtract(bottom, top):
+    """ Subtractive blend function.
+    
+        Math from http://illusions.hu/effectwiki/doku.php?id=subtractive_blending
+    """
+    return numpy.clip(bottom - top, 0, 1)
+
+def linear_light(bottom, top):
+    """ Linear light blend function.
+    
+        Math from http://illusions.hu/effectwiki/doku.php?id=linear_light_blending
+    """
+    return numpy.clip(bottom + 2 * top - 1, 0, 1)
+
+def hard_light(bottom, top):
+    """ Hard light blend function.
+    
+        Math from http://illusions.hu/effectwiki/doku.php?id=hard_light_blending
+    """
+    # different formulas for dark and light parts of overlay
+    return numpy.where(top < .5, 2 * bottom * top, 1 - 2 * (1 - bottom) * (1 - top))
+
+blend_modes = {
+    'screen': screen,
+    'add': add,
+    'multiply': multiply,
+    'subtract': subtract,
+    'linear light': linear_light,
+    'hard light': hard_light
+    }
+
+#
+# Adjustment factories check their arguments and return functions that accept
+# an RGBA array and return a new one, leaving alpha alone.
+#
+
+def threshold(red_value, green_value=None, blue_value=None):
+    """ Return a function that applies a threshold operation.
+    """
+    if green_value is None or blue_value is None:
+        # if there aren't three provided, use the one
+        green_value, blue_value = red_value, red_value
+
+    # knowns are given in 0-255 range, need to be converted to floats
+    values = numpy.array([red_value, green_value, blue_value], numpy.float32).reshape(3, 1, 1) / 255
+    
+    def adjustfunc(rgba):
+        output = numpy.empty_like(rgba)
+        output[:3] = rgba[:3] > values
+        output[3] = rgba[3]
+        return output
+    
+    return adjustfunc
+
+def curves(black, grey, white):
+    """ Return a function that applies a curves operation.
         
-            for (name, args) in layer.get('adjustments', []):
-                adjustfunc = adjustment_names.get(name)(*args)
-                foreground = foreground.adjust(adjustfunc)
+        Adjustment inspired by Photoshop "Curves" feature.
+    
+        Arguments are three integers that are intended to be mapped to black,
+        grey, and white outputs. Curves2 offers more flexibility, see
+        curves2().
         
-            opacity = float(layer.get('opacity', 1.0))
-            blendfunc = blend_modes.get(layer.get('mode', None), None)
+        Darken a light image by pushing light grey to 50% grey, 0xCC to 0x80
+        with black=0, grey=204, white=255.
+    """
+    return curves2([(black, 0), (grey, 127.5), (white, 255)])
+
+def curves2(map_red, map_green=None, map_blue=None):
+    """ Return a function that applies a curves operation.
         
-            if mask_name:
-                rendered = rendered.blend(foreground, tiles[mask_name], opacity, blendfunc)
-            else:
-                rendered = rendered.blend(foreground, None, opacity, blendfunc)
+        Adjustment inspired by Photoshop "Curves" feature.
     
-        return rendered
+        Arguments are given in the form of three value mappings, typically
+        mapping black, grey and white input and output values. One argument
+        indicates an effect applicable to all channels, three arguments apply
+        effects to each channel separately.
+    
+        Simple monochrome inversion:
+            map_red=[[0, 255], [128, 128], [255, 0]]
+    
+        Darken a light image by pushing light grey down by 50%, 0x99 to 0x66:
+            map_red=[[0, 255], [153, 102], [255, 0]]
+    
+        Shaded hills, with Imhof-style purple-blue shadows and warm highlights:
+            map_red=[[0, 22], [128, 128], [255, 255]],
+            map_green=[[0, 29], [128, 128], [255, 255]],
+            map_blue=[[0, 65], [128, 128], [255, 228]]
+    """
+    if map_green is None or map_blue is None:
+        # if there aren't three provided, use the one
+        map_green, map_blue = map_red, map_red
+    
+    # quadratic coefficients for each channel, in columns
+    coefficients = [quadratic(mapping) for mapping in (map_red, map_green, map_blue)]
+    a, b, c = numpy.array(coefficients, numpy.float32).T.reshape(3, 3, 1, 1)
+    
+    def adjustfunc(rgba):
+        rgb = rgba[:3]
+        output = numpy.empty_like(rgba)
+        output[:3] = numpy.clip(a * rgb**2 + b * rgb + c, 0, 1)
+        output[3] = rgba[3]
+        return output
+    
+    return adjustfunc
 
-def local_bitmap(source, config, coord, dim):
-    """ Return Blit.Bitmap representation of a raw image.
+def quadratic(mapping):
+    """ Return coefficients a, b, c of a quadratic passing through three points.
+    
+        Points are (input, output) pairs given in 0-255 range.
     """
-    address = urljoin(config.dirpath, source)
-    bytes = urlopen(address).read()
-    image = Image.open(StringIO(bytes)).convert('RGBA')
+    try:
+        (in_1, out_1), (in_2, out_2), (in_3, out_3) \
+            = [(in_ / 255.0, out_ / 255.0) for (in_, out_) in mapping]
     
-    coord = coord.zoomBy(8)
-    w, h, col, row = image.size[0], image.size[1], int(coord.column), int(coord.row)
+        return numpy.linalg.solve([[in_1**2, in_1, 1], [in_2**2, in_2, 1], [in_3**2, in_3, 1]], [out_1, out_2, out_3])
     
-    x = w * (col / w) - col
-    y = h * (row / h) - row
+    except (ValueError, TypeError, numpy.linalg.LinAlgError):
+        raise Core.KnownUnknown('Curves need three distinct input values in a Sandwich Layer: %s' % repr(mapping))
+
+adjustment_names = {
+    'threshold': threshold,
+    'curves': curves,
+    'curves2': curves2
+    }
+
+# Decoded images from local_bitmap() and their stamps, by address.
+_textures, _textures_lock = OrderedDict(), Lock()
+_textures_size = 16
+
+def _textureStamp(address):
+    """ Return modification time and size of a local image, or None for a URL.
+    """
+    scheme, host, path, p, q, f = urlparse(address)
     
-    output = Image.new('RGBA', (dim, dim))
+    if scheme in ('file', ''):
+        try:
+            info = stat(path)
+        except OSError:
+            return None
+        else:
+            return info.st_mtime, info.st_size
+    
+    return None
+
+def load_texture(address):
+    """ Return a read-only RGBA array of a raw image, decoded once.
+    
+        The most recently used textures are kept until a local image
+        changes; images from URLs are downloaded once.
+    """
+    stamp = _textureStamp(address)
     
-    for (x, y) in product(range(x, dim, w), range(y, dim, h)):
-        # crop the top-left if needed
-        xmin = 0 if x > 0 else -x
-        ymin = 0 if y > 0 else -y
+    with _textures_lock:
+        texture, texture_stamp = _textures.pop(address, (None, None))
         
-        # don't paste up and to the left
-        x = x if x >= 0 else 0
-        y = y if y >= 0 else 0
+        if texture is not None and texture_stamp == stamp:
+            _textures[address] = texture, texture_stamp
+            return texture
+    
+    bytes = urlopen(address).read()
+    texture = img2rgba(Image.open(StringIO(bytes)))
+    texture.flags.writeable = False
+    
+    with _textures_lock:
+        _textures[address] = texture, stamp
         
-        output.paste(image.crop((xmin, ymin, w, h)), (x, y))
+        while len(_textures) > _textures_size:
+            _textures.popitem(last=False)
     
-    return Blit.Bitmap(output)
+    return texture
+
+def local_bitmap(source, config, coord, dim):
+    """ Return RGBA array representation of a raw image.
+    
+        The image is tiled seamlessly, assuming 256x256 parent tiles.
+    """
+    texture = load_texture(urljoin(config.dirpath, source))
+    
+    coord = coord.zoomBy(8)
+    h, w, col, row = texture.shape[1], texture.shape[2], int(coord.column), int(coord.row)
+    
+    # output pixels wrap around to the start of the image.
+    rows = (numpy.arange(dim) + row) % h
+    cols = (numpy.arange(dim) + col) % w
+    
+    return texture.take(rows, 1).take(cols, 2)
 
 def layer_bitmap(layer, coord):
-    """ Return Blit.Bitmap representation of tile from a given layer.
+    """ Return RGBA array representation of tile from a given layer.
     
-        Uses TileStache.getTile(), so caches are read and written as normal.
+        Uses Layer.getTileObject(), so caches are read and written as normal
+        and recently-rendered tiles aren't encoded and decoded again.
     """
-    from . import getTile
+    return img2rgba(layer.getTileObject(coord, 'png'))
 
-    mime, body = getTile(layer, coord, 'png')
-    image = Image.open(StringIO(body)).convert('RGBA')
+def img2rgba(image):
+    """ Convert PIL Image to a (4, height, width) array with values in 0-1 range.
+    """
+    rgba = numpy.asarray(image.convert('RGBA')).transpose(2, 0, 1).astype(numpy.float32)
+    rgba /= 255
+    return rgba
 
-    return Blit.Bitmap(image)
+def rgba2img(rgba):
+    """ Convert a (4, height, width) array with values in 0-1 range to PIL Image.
+    """
+    return Image.fromarray(numpy.round(rgba * 255).astype(numpy.uint8).transpose(1, 2, 0), 'RGBA')
 
 def in_zoom(coord, range):
     """ Return True if the coordinate zoom is within the textual range.
     
         Range might look like "1-10" or just "5".
     """
+    min_zoom, max_zoom = zoom_range(range)
+    return min_zoom <= coord.zoom and coord.zoom <= max_zoom
+
+def zoom_range(range):
+    """ Return minimum and maximum zoom from a textual range.
+    
+        Range might look like "1-10" or just "5".
+    """
     zooms = search("^(\d+)-(\d+)$|^(\d+)$", range)
     
     if not zooms:
@@ -314,10 +637,12 @@ def in_zoom(coord, range):
     else:
         min_zoom, max_zoom = 0, float('inf')
     
-    return min_zoom <= coord.zoom and coord.zoom <= max_zoom
+    return min_zoom, max_zoom
 
 def make_color(color):
-    """ Convert colors expressed as HTML-style RGB(A) strings to Blit.Color.
+    """ Convert colors expressed as HTML-style RGB(A) strings to RGBA arrays.
+        
+        Returns a (4, 1, 1) array with values in 0-1 range.
         
         Examples:
           white: "#ffffff", "#fff", "#ffff", "#ffffffff"
@@ -350,4 +675,4 @@ def make_color(color):
     except ValueError:
         raise Core.KnownUnknown('Color must be made up of valid hex chars: "%s"' % color)
 
-    return Blit.Color(r, g, b, a)
+    return numpy.array([r, g, b, a], numpy.float32).reshape(4, 1, 1) / 255
@@ -25,7 +25,8 @@ from datetime import datetime, timedelta
 from urlparse import urljoin, urlparse
 from wsgiref.headers import Headers
 from urllib import urlopen
-from os import getcwd
+from os import getcwd, stat
+from threading import Thread, Lock
 from time import time
 
 import httplib
@@ -45,6 +46,7 @@ _previous_configs = {}
 
 import Core
 import Config
+import Metrics
 
 # regular expression for PATH_INFO
 _pathinfo_pat = re.compile(r'^/?(?P<l>\w.+)/(?P<z>\d+)/(?P<x>-?\d+)/(?P<y>-?\d+)\.(?P<e>\w+)$')
@@ -97,20 +99,53 @@ def parseConfig(configHandle):
         and the Core and Providers modules for more information on the
         "layers" section.
     """
+    config_dict, dirpath = _readConfig(configHandle)
+    return Config.buildConfiguration(config_dict, dirpath)
+
+def _readConfig(configHandle):
+    """ Return a configuration dictionary and directory path for parseConfig().
+    """
     if isinstance(configHandle, dict):
-        config_dict = configHandle
-        dirpath = '.'
-    else:
-        config_dict = json_load(urlopen(configHandle))
-        scheme, host, path, p, q, f = urlparse(configHandle)
+        return configHandle, '.'
 
-        if scheme == '':
-            scheme = 'file'
-            path = realpath(path)
+    config_dict = json_load(urlopen(configHandle))
+    scheme, host, path, p, q, f = urlparse(configHandle)
 
-        dirpath = '%s://%s%s' % (scheme, host, dirname(path).rstrip('/') + '/')
+    if scheme == '':
+        scheme = 'file'
+        path = realpath(path)
 
-    return Config.buildConfiguration(config_dict, dirpath)
+    dirpath = '%s://%s%s' % (scheme, host, dirname(path).rstrip('/') + '/')
+
+    return config_dict, dirpath
+
+def _configStamp(configHandle):
+    """ Return modification time and size of a local configuration file, or None.
+    """
+    scheme, host, path, p, q, f = urlparse(configHandle)
+
+    if scheme not in ('', 'file'):
+        return None
+
+    try:
+        info = stat(path)
+    except OSError:
+        return None
+
+    return info.st_mtime, info.st_size
+
+def _prewarmLayers(config, previous=None):
+    """ Prepare providers of layers in a configuration for their first request.
+
+        Layers carried over unchanged from an optional previous configuration
+        are already prepared, and skipped.
+    """
+    for (name, layer) in config.layers.items():
+        if previous is not None and previous.layers.get(name) is layer:
+            continue
+
+        if hasattr(layer.provider, 'prewarm'):
+            layer.provider.prewarm()
 
 def splitPathInfo(pathinfo):
     """ Converts a PATH_INFO string to layer name, coordinate, and extension parts.
@@ -183,11 +218,12 @@ def requestLayer(config, path_info):
 
     layername = splitPathInfo(path_info)[0]
 
-    if layername not in config.layers:
+    try:
+        # one lookup, for layer collections that fetch their layers.
+        return config.layers[layername]
+    except KeyError:
         raise Core.KnownUnknown('"%s" is not a layer I know about. Here are some that I do know about: %s.' % (layername, ', '.join(sorted(config.layers.keys()))))
 
-    return config.layers[layername]
-
 def requestHandler(config_hint, path_info, query_string=None):
     """ Generate a mime-type and response body for a given request.
 
@@ -203,7 +239,7 @@ def requestHandler(config_hint, path_info, query_string=None):
 
     return mimetype, content
 
-def requestHandler2(config_hint, path_info, query_string=None, script_name=''):
+def requestHandler2(config_hint, path_info, query_string=None, script_name='', accept=None):
     """ Generate a set of headers and response body for a given request.
 
         TODO: Replace requestHandler() with this function in TileStache 2.0.0.
@@ -215,6 +251,9 @@ def requestHandler2(config_hint, path_info, query_string=None, script_name=''):
 
         Query string is optional, currently used for JSON callbacks.
 
+        Accept is an optional HTTP Accept header, used to serve WebP tiles
+        to clients that support them from layers with a WebP encoder.
+
         Calls Layer.getTileResponse() to render actual tiles, and getPreview() to render preview.html.
     """
     headers = Headers([])
@@ -257,7 +296,15 @@ def requestHandler2(config_hint, path_info, query_string=None, script_name=''):
             return 302, headers, 'You are being redirected to %s\n' % redirect_uri
 
         else:
-            status_code, headers, content = layer.getTileResponse(coord, extension)
+            timings = {}
+            extension, varies = layer.negotiateExtension(extension, accept)
+            status_code, headers, content = layer.getTileResponse(coord, extension, timings=timings)
+
+            if varies:
+                headers.setdefault('Vary', 'Accept')
+
+            if layer.server_timing:
+                headers.setdefault('Server-Timing', Core.serverTiming(timings))
 
         if layer.allowed_origin:
             headers.setdefault('Access-Control-Allow-Origin', layer.allowed_origin)
@@ -302,8 +349,9 @@ def cgiHandler(environ, config='./tilestache.cfg', debug=False):
     path_info = environ.get('PATH_INFO', None)
     query_string = environ.get('QUERY_STRING', None)
     script_name = environ.get('SCRIPT_NAME', None)
+    accept = environ.get('HTTP_ACCEPT', None)
 
-    status_code, headers, content = requestHandler2(config, path_info, query_string, script_name)
+    status_code, headers, content = requestHandler2(config, path_info, query_string, script_name, accept)
 
     headers.setdefault('Content-Length', str(len(content)))
 
@@ -329,7 +377,7 @@ class WSGITileServer:
           werkzeug.serving.run_simple('localhost', 8080, app)
     """
 
-    def __init__(self, config, autoreload=False):
+    def __init__(self, config, autoreload=False, metrics_path=None, prewarm=False):
         """ Initialize a callable WSGI instance.
 
             Config parameter can be a file path string for a JSON configuration
@@ -337,19 +385,42 @@ class WSGITileServer:
             'dirpath' properties.
 
             Optional autoreload boolean parameter causes config to be re-read
-            on each request, applicable only when config is a JSON file.
+            when it changes, applicable only when config is a JSON file. Local
+            files are checked at most once a second, and reloaded when their
+            modification time or size changes; remote files are re-read once
+            a second. Only the cache and layers whose definitions changed are
+            rebuilt, in a background thread, while requests continue with the
+            old configuration until the new one is ready.
+
+            Optional metrics_path parameter is a path such as "/metrics" where
+            tile measurements are served in Prometheus text format, see
+            TileStache.Metrics for details.
+
+            Optional prewarm boolean parameter causes providers with a
+            prewarm() method, such as Mapnik, to load their maps now instead
+            of on the first request, and again for providers rebuilt by
+            autoreload before they're used. With a pre-forking server, create
+            the application in each worker so loaded maps aren't shared
+            across processes.
         """
+        self.metrics_path = metrics_path
+        self.prewarm = prewarm
 
         if type(config) in (str, unicode, dict):
-            self.autoreload = autoreload
+            self.autoreload = autoreload and type(config) is not dict
             self.config_path = config
 
             try:
-                self.config = parseConfig(config)
+                self.config_stamp = _configStamp(config) if self.autoreload else None
+                self.config_dict, dirpath = _readConfig(config)
+                self.config = Config.buildConfiguration(self.config_dict, dirpath)
             except:
                 print "Error loading Tilestache config:"
                 raise
 
+            self.config_checked = time()
+            self.reload_lock = Lock()
+
         else:
             assert hasattr(config, 'cache'), 'Configuration object must have a cache.'
             assert hasattr(config, 'layers'), 'Configuration object must have layers.'
@@ -359,14 +430,21 @@ class WSGITileServer:
             self.config_path = None
             self.config = config
 
+        if self.prewarm:
+            _prewarmLayers(self.config)
+
     def __call__(self, environ, start_response):
         """
         """
-        if self.autoreload: # re-parse the config file on every request
-            try:
-                self.config = parseConfig(self.config_path)
-            except Exception, e:
-                raise Core.KnownUnknown("Error loading Tilestache config file:\n%s" % str(e))
+        if self.autoreload:
+            self._checkConfig()
+
+        # one configuration for the whole request, even if it's reloaded.
+        config = self.config
+
+        if self.metrics_path and environ['PATH_INFO'] == self.metrics_path:
+            headers = Headers([('Content-Type', 'text/plain; version=0.0.4')])
+            return self._response(start_response, 200, Metrics.registry.text(), headers)
 
         try:
             layer, coord, ext = splitPathInfo(environ['PATH_INFO'])
@@ -377,17 +455,64 @@ class WSGITileServer:
         # WSGI behavior is different from CGI behavior, because we may not want
         # to return a chatty rummy for likely-deployed WSGI vs. testing CGI.
         #
-        if layer and layer not in self.config.layers:
+        if layer and layer not in config.layers:
             return self._response(start_response, 404)
 
         path_info = environ.get('PATH_INFO', None)
         query_string = environ.get('QUERY_STRING', None)
         script_name = environ.get('SCRIPT_NAME', None)
+        accept = environ.get('HTTP_ACCEPT', None)
 
-        status_code, headers, content = requestHandler2(self.config, path_info, query_string, script_name)
+        status_code, headers, content = requestHandler2(config, path_info, query_string, script_name, accept)
 
         return self._response(start_response, status_code, str(content), headers)
 
+    def _checkConfig(self):
+        """ Start reloading the configuration in a new thread if it has changed.
+        """
+        if time() - self.config_checked < 1:
+            return
+
+        self.config_checked = time()
+        stamp = _configStamp(self.config_path)
+
+        if stamp is not None and stamp == self.config_stamp:
+            return
+
+        if not self.reload_lock.acquire(False):
+            # already reloading.
+            return
+
+        thread = Thread(target=self._reloadConfig, args=(stamp, ))
+        thread.setDaemon(True)
+        thread.start()
+
+    def _reloadConfig(self, stamp):
+        """ Reload a changed configuration and switch to it, keeping unchanged parts.
+        """
+        try:
+            config_dict, dirpath = _readConfig(self.config_path)
+
+            if config_dict != self.config_dict:
+                previous = self.config, self.config_dict
+                config = Config.buildConfiguration(config_dict, dirpath, previous)
+
+                if self.prewarm:
+                    _prewarmLayers(config, previous[0])
+
+                self.config = config
+                self.config_dict = config_dict
+
+                logging.info('TileStache.WSGITileServer reloaded %s', self.config_path)
+
+        except Exception, e:
+            # keep the old configuration until the file changes again.
+            logging.error('TileStache.WSGITileServer failed to reload %s: %s', self.config_path, e)
+
+        finally:
+            self.config_stamp = stamp
+            self.reload_lock.release()
+
     def _response(self, start_response, code, content='', headers=None):
         """
         """
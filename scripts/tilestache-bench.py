@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+"""tilestache-bench.py will measure how quickly TileStache makes tiles.
+
+This script is intended to be run directly. This example runs every available
+benchmark scenario and saves the results for later comparison:
+
+    tilestache-bench.py --requests 500 --output before.json
+
+See `tilestache-bench.py --help` for more information.
+"""
+
+from sys import stderr, path
+from optparse import OptionParser
+
+parser = OptionParser(usage="""%prog [options] [scenario...]
+
+Runs benchmark scenarios against synthetic TileStache configurations, requesting
+tiles end to end and reporting throughput and 50th, 95th, and 99th percentile
+latency for each. No configuration file is needed. With no scenario names given,
+all scenarios are run; ones that need missing libraries or servers are skipped.
+
+Example:
+
+    tilestache-bench.py --via wsgi --threads 4 raster disk lmdb
+
+Protip: compare two commits by saving results from each:
+
+    tilestache-bench.py --output before.json
+    tilestache-bench.py --output after.json --compare before.json
+
+See `%prog --help` for info.""")
+
+defaults = dict(requests=200, threads=1, via='gettile', startup_layers=500)
+
+parser.set_defaults(**defaults)
+
+parser.add_option('-n', '--requests', dest='requests',
+                  help='Number of tiles to request in each scenario. Default value is %d.' % defaults['requests'],
+                  type='int')
+
+parser.add_option('-t', '--threads', dest='threads',
+                  help='Number of threads making requests at the same time. Default value is %d.' % defaults['threads'],
+                  type='int')
+
+parser.add_option('--via', dest='via',
+                  help='Request tiles through TileStache.getTile() ("gettile") or a TileStache.WSGITileServer ("wsgi"). Default value is "%s".' % defaults['via'],
+                  type='choice', choices=('gettile', 'wsgi'))
+
+parser.add_option('-o', '--output', dest='output',
+                  help='Optional file to save results to, in JSON format.')
+
+parser.add_option('--compare', dest='compare',
+                  help='Optional JSON file of earlier results to compare against.')
+
+parser.add_option('--memcache', dest='memcache',
+                  help='Optional memcache server, e.g. "127.0.0.1:11211", for the memcache scenario.')
+
+parser.add_option('--redis', dest='redis',
+                  help='Optional Redis server, e.g. "localhost:6379", for the redis scenario.')
+
+parser.add_option('--startup', dest='startup', action='store_true',
+                  help='Also measure import, configuration parsing, and first tile times in a new Python process.')
+
+parser.add_option('--startup-layers', dest='startup_layers',
+                  help='Number of layers in the configuration for --startup. Default value is %d.' % defaults['startup_layers'],
+                  type='int')
+
+parser.add_option('--encoders', dest='encoders', action='store_true',
+                  help='Also measure encoding time and tile size for each encoder profile.')
+
+parser.add_option('--encoders-image', dest='encoders_image',
+                  help='Optional image file to cut into tiles for --encoders, instead of a synthetic map.')
+
+parser.add_option('-l', '--list', dest='list', action='store_true',
+                  help='List scenario names and exit.')
+
+parser.add_option('-i', '--include-path', dest='include',
+                  help="Add the following colon-separated list of paths to Python's include path.")
+
+if __name__ == '__main__':
+    options, names = parser.parse_args()
+
+    if options.include:
+        for p in options.include.split(':'):
+            path.insert(0, p)
+
+    from TileStache import Benchmark
+    from TileStache.Benchmark import scenarios, startup, encoders
+
+    available = scenarios.all_scenarios()
+
+    if options.list:
+        for scenario in available:
+            print scenario.name
+        exit(0)
+
+    unknown = set(names) - set([scenario.name for scenario in available])
+
+    if unknown:
+        print >> stderr, 'Unknown scenario(s): %s' % ', '.join(sorted(unknown))
+        exit(1)
+
+    chosen = [scenario for scenario in available if scenario.name in names or not names]
+
+    run_options = dict(requests=options.requests, threads=options.threads, via=options.via,
+                       memcache=options.memcache, redis=options.redis)
+
+    results = Benchmark.runScenarios(chosen, run_options)
+
+    if options.startup:
+        results['startup'] = startup.measureStartup(options.startup_layers)
+        Benchmark.printStartup(results['startup'])
+
+    if options.encoders:
+        profiles, skipped = encoders.measureEncoders(options.encoders_image)
+        results['encoders'] = dict(profiles=profiles, skipped=skipped)
+        Benchmark.printEncoders(results['encoders'])
+
+    if options.output:
+        Benchmark.saveResults(results, options.output)
+
+    if options.compare:
+        Benchmark.compareResults(Benchmark.loadResults(options.compare), results)
@@ -34,7 +34,7 @@ class Provider (ModestMaps.Providers.IMapProvider):
         #
         # It's possible that Mapnik is not thread-safe, best to be cautious.
         #
-        self.threadsafe = self.layer.provider is not TileStache.Providers.Mapnik
+        self.threadsafe = self.layer.provider.__class__.__module__ != 'TileStache.Mapnik'
 
     def tileWidth(self):
         return 256
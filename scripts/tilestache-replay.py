@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+"""tilestache-replay.py will replay a tile access log against your configuration.
+
+This script is intended to be run directly. This example replays a log of "osm"
+tile requests at twice the recorded speed with eight threads:
+
+    tilestache-replay.py -c ./config.json --speed 2 --threads 8 access.log
+
+See `tilestache-replay.py --help` for more information.
+"""
+
+from sys import stderr, stdin, path
+from optparse import OptionParser
+
+parser = OptionParser(usage="""%prog [options] [logfile...]
+
+Replays tile requests from access logs against a TileStache configuration, in
+this process, and reports latency, cache hit ratio, lock contention, and peak
+memory. Log lines have a Unix timestamp and a tile path such as
+"/osm/12/656/1582.png". Logs are read from stdin if no files are given.
+
+Example:
+
+    tilestache-replay.py -c ./config.json --threads 8 access.log
+
+Protip: replay the same log against two configurations to compare them:
+
+    tilestache-replay.py -c metatile-2x2.cfg -o 2x2.json access.log
+    tilestache-replay.py -c metatile-4x4.cfg -o 4x4.json access.log
+
+See `%prog --help` for info.""")
+
+defaults = dict(config=None, threads=1, speed=None)
+
+parser.set_defaults(**defaults)
+
+parser.add_option('-c', '--config', dest='config',
+                  help='Path to configuration file, typically required.')
+
+parser.add_option('-t', '--threads', dest='threads',
+                  help='Number of threads making requests at the same time. Default value is %d.' % defaults['threads'],
+                  type='int')
+
+parser.add_option('-s', '--speed', dest='speed',
+                  help='Optional multiple of the recorded request rate, e.g. 1 for recorded speed or 10 for ten times faster. Default is to replay requests as fast as possible.',
+                  type='float')
+
+parser.add_option('-o', '--output', dest='output',
+                  help='Optional file to save results to, in JSON format.')
+
+parser.add_option('-i', '--include-path', dest='include',
+                  help="Add the following colon-separated list of paths to Python's include path.")
+
+if __name__ == '__main__':
+    options, files = parser.parse_args()
+
+    if options.include:
+        for p in options.include.split(':'):
+            path.insert(0, p)
+
+    from TileStache import Benchmark
+    from TileStache.Benchmark import replay
+
+    if options.config is None:
+        print >> stderr, 'Missing required configuration (--config) parameter.'
+        exit(1)
+
+    entries = []
+
+    for file in (files and map(open, files) or [stdin]):
+        entries.extend(replay.readLog(file))
+
+    if not entries:
+        print >> stderr, 'No tile requests found to replay.'
+        exit(1)
+
+    results = replay.replay(options.config, entries, options.threads, options.speed)
+    replay.printResults(results)
+
+    if options.output:
+        Benchmark.saveResults(results, options.output)
@@ -39,6 +39,8 @@ if __name__ == '__main__':
         help="the port number to listen on")
     parser.add_option('--include-path', dest='include',
         help="Add the following colon-separated list of paths to Python's include path (aka sys.path)")
+    parser.add_option('--metrics-path', dest='metrics_path',
+        help="Serve tile measurements in Prometheus text format at this path, e.g. /metrics")
     (options, args) = parser.parse_args()
 
     if options.include:
@@ -52,6 +54,6 @@ if __name__ == '__main__':
         print >> sys.stderr, "Config file not found. Use -c to pick a tilestache config file."
         sys.exit(1)
 
-    app = TileStache.WSGITileServer(config=options.file, autoreload=True)
+    app = TileStache.WSGITileServer(config=options.file, autoreload=True, metrics_path=options.metrics_path)
     run_simple(options.ip, options.port, app)
 
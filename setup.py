@@ -20,7 +20,7 @@ def is_installed(name):
         return False
 
 
-requires = ['ModestMaps >=1.3.0','simplejson', 'Werkzeug', 'Pillow']
+requires = ['ModestMaps >=1.3.0','simplejson', 'Werkzeug', 'Pillow >=6.0']
 
 
 setup(name='TileStache',
@@ -35,8 +35,9 @@ setup(name='TileStache',
                 'TileStache.Goodies',
                 'TileStache.Goodies.Caches',
                 'TileStache.Goodies.Providers',
-                'TileStache.Goodies.VecTiles'],
-      scripts=['scripts/tilestache-compose.py', 'scripts/tilestache-seed.py', 'scripts/tilestache-clean.py', 'scripts/tilestache-server.py', 'scripts/tilestache-render.py', 'scripts/tilestache-list.py'],
+                'TileStache.Goodies.VecTiles',
+                'TileStache.Benchmark'],
+      scripts=['scripts/tilestache-compose.py', 'scripts/tilestache-seed.py', 'scripts/tilestache-clean.py', 'scripts/tilestache-server.py', 'scripts/tilestache-render.py', 'scripts/tilestache-list.py', 'scripts/tilestache-bench.py', 'scripts/tilestache-replay.py'],
       data_files=[('share/tilestache', ['TileStache/Goodies/Providers/DejaVuSansMono-alphanumeric.ttf'])],
       package_data={'TileStache': ['VERSION', '../doc/*.html']},
       license='BSD')
@@ -0,0 +1,108 @@
+from unittest import TestCase
+from StringIO import StringIO
+
+from TileStache import Benchmark
+from TileStache.Benchmark import scenarios, replay, startup, encoders
+from TileStache import parseConfig, Encoders
+
+class BenchmarkTests(TestCase):
+
+    def test_percentile(self):
+        '''Percentiles use the nearest rank'''
+
+        values = range(1, 101)
+
+        self.assertEqual(Benchmark.percentile(values, .50), 50)
+        self.assertEqual(Benchmark.percentile(values, .95), 95)
+        self.assertEqual(Benchmark.percentile(values, .99), 99)
+        self.assertEqual(Benchmark.percentile([7], .99), 7)
+        self.assertEqual(Benchmark.percentile([], .5), None)
+
+    def test_coords(self):
+        '''Scenario coordinates are repeatable and distinct'''
+
+        scenario = scenarios.Scenario('raster', 'raster', 'png', scenarios.build_raster)
+        coords = scenario.coords(50)
+
+        self.assertEqual(len(coords), 50)
+        self.assertEqual(len(set(map(str, coords))), 50)
+        self.assertEqual(map(str, coords), map(str, scenario.coords(50)))
+
+    def test_run_scenarios(self):
+        '''Raster and disk scenarios run through getTile() and WSGI'''
+
+        chosen = [s for s in scenarios.all_scenarios() if s.name in ('raster', 'disk', 'redis')]
+
+        for via in ('gettile', 'wsgi'):
+            out = StringIO()
+            results = Benchmark.runScenarios(chosen, dict(requests=10, threads=2, via=via), out)
+
+            self.assertEqual(sorted(results['scenarios']), ['disk', 'raster'])
+            self.assertEqual(results['skipped'], {'redis': 'no redis server given'})
+
+            for result in results['scenarios'].values():
+                self.assertEqual(result['requests'], 10)
+                self.assertTrue(result['p50_ms'] <= result['p95_ms'] <= result['p99_ms'] <= result['max_ms'])
+
+        compared = StringIO()
+        Benchmark.compareResults(results, results, compared)
+
+        self.assertTrue('raster           throughput +0.0%' in compared.getvalue())
+
+class ReplayTests(TestCase):
+
+    def test_parse_line(self):
+        '''Log lines have a timestamp and path in either order'''
+
+        self.assertEqual(replay.parseLine('1356998400.25 /osm/12/656/1582.png\n'), (1356998400.25, '/osm/12/656/1582.png'))
+        self.assertEqual(replay.parseLine('osm/12/656/1582.png 1356998400'), (1356998400., '/osm/12/656/1582.png'))
+        self.assertEqual(replay.parseLine('/osm/12/656/1582.png'), (None, '/osm/12/656/1582.png'))
+        self.assertEqual(replay.parseLine('  \n'), None)
+        self.assertRaises(ValueError, replay.parseLine, '1356998400')
+
+    def test_replay(self):
+        '''Replay reports tile sources, locks, and statuses'''
+
+        config = parseConfig({
+            'cache': {'name': 'Test'},
+            'layers': {
+                'raster': {
+                    'provider': {'class': 'TileStache.Benchmark.scenarios:SyntheticProvider'},
+                    'metatile': {'rows': 2, 'columns': 2}
+                    }
+                }
+            })
+
+        log = StringIO('\n'.join(['%d /raster/12/%d/2048.png' % (1356998400 + i, 2048 + i) for i in range(4)]
+                                 + ['1356998404 /nothing/12/2048/2048.png']))
+
+        results = replay.replay(config, replay.readLog(log), threads=2)
+
+        self.assertEqual(results['requests'], 5)
+        self.assertEqual(results['statuses'], {'200': 4, '404': 1})
+        self.assertEqual(results['sources']['layer.render()']['count'], 4)
+        self.assertEqual(results['cache_hit_ratio'], 0)
+        self.assertEqual(results['locks'], 4)
+
+class StartupTests(TestCase):
+
+    def test_startup(self):
+        '''Startup does not import heavy modules for simple layers'''
+
+        result = startup.measureStartup(layers=20, runs=1)
+
+        self.assertEqual(result['layers'], 20)
+        self.assertEqual(result['heavy_modules'], [])
+
+class EncodersTests(TestCase):
+
+    def test_measure_encoders(self):
+        '''Encoder profiles report time and size'''
+
+        results, skipped = encoders.measureEncoders(encoders.mapImage(512), runs=1)
+
+        self.assertEqual(sorted(results.keys() + skipped.keys()), sorted(Encoders.all.keys()))
+        self.assertTrue(results['png-quantized']['bytes'] < results['png-fast']['bytes'])
+
+        for result in results.values():
+            self.assertTrue(result['encode_ms'] >= 0)
@@ -1,6 +1,14 @@
 import os
+from time import time, sleep
+from threading import Thread, currentThread
+from shutil import rmtree
+from tempfile import mkdtemp
 from unittest import TestCase, skipIf
 import memcache
+from moto import mock_s3_deprecated
+from boto.s3.connection import S3Connection
+from ModestMaps.Core import Coordinate
+from TileStache import Core, Caches, Redis, parseConfig
 from . import utils
 
 
@@ -69,3 +77,427 @@ class CacheTests(TestCase):
 
         self.assertEqual(self.mc.get('/1/memcache_osm/0/0/0.PNG'), None,
             'Memcache returned a value even though it should have been empty')
+
+
+class SlowCache:
+    '''In-memory cache tier that takes its time to read'''
+
+    def __init__(self, delay, tiles=None):
+        self.delay = delay
+        self.tiles = tiles or {}
+
+    def read(self, layer, coord, format):
+        sleep(self.delay)
+        return self.tiles.get((coord.zoom, coord.column, coord.row, format))
+
+    def save(self, body, layer, coord, format):
+        self.tiles[(coord.zoom, coord.column, coord.row, format)] = body
+
+
+class NoteCache:
+    '''Cache tier that raises an error for every read'''
+
+    def __init__(self, error):
+        self.error = error
+
+    def read(self, layer, coord, format):
+        raise self.error
+
+    def save(self, body, layer, coord, format):
+        pass
+
+
+class MultiCacheTests(TestCase):
+    '''Tests hedged reads in the Multi cache'''
+
+    def test_hedged_read_skips_slow_tier(self):
+        '''Read a tile from the third tier while the second is still busy'''
+
+        empty, slow, fast = SlowCache(0), SlowCache(1.0), SlowCache(0, {(0, 0, 0, 'png'): 'tile'})
+        cache = Caches.Multi([empty, slow, fast], hedge_delay=0.05)
+
+        start = time()
+        body = cache.read(None, Coordinate(0, 0, 0), 'png')
+
+        self.assertEqual(body, 'tile')
+        self.assertTrue(time() - start < 0.5, 'Hedged read waited on the slow tier')
+        self.assertEqual(slow.tiles, {}, 'Busy tier should not be written back')
+
+    def test_hedged_read_first_tier(self):
+        '''Read the first tier in the calling thread, and no others if it has the tile'''
+
+        first = SlowCache(0, {(0, 0, 0, 'png'): 'first'})
+        second = SlowCache(0, {(0, 0, 0, 'png'): 'second'})
+        threads = []
+
+        def read(layer, coord, format, read=first.read):
+            threads.append(currentThread())
+            return read(layer, coord, format)
+
+        def unread(layer, coord, format):
+            raise AssertionError('Second tier should not be read')
+
+        first.read, second.read = read, unread
+        cache = Caches.Multi([first, second], hedge_delay=0.05)
+
+        self.assertEqual(cache.read(None, Coordinate(0, 0, 0), 'png'), 'first')
+        self.assertEqual(threads, [currentThread()])
+
+    def test_hedged_read_keeps_tier_order(self):
+        '''Prefer the first tier when it responds within the delay'''
+
+        first = SlowCache(0.1, {(0, 0, 0, 'png'): 'first'})
+        second = SlowCache(0, {(0, 0, 0, 'png'): 'second'})
+        cache = Caches.Multi([first, second], hedge_delay=0.5)
+
+        self.assertEqual(cache.read(None, Coordinate(0, 0, 0), 'png'), 'first')
+
+    def test_hedged_read_backfills_empty_tiers(self):
+        '''Save a tile found in a later tier to earlier empty tiers'''
+
+        first, second = SlowCache(0), SlowCache(0, {(0, 0, 0, 'png'): 'tile'})
+        cache = Caches.Multi([first, second], hedge_delay=0)
+
+        self.assertEqual(cache.read(None, Coordinate(0, 0, 0), 'png'), 'tile')
+        self.assertEqual(first.tiles, {(0, 0, 0, 'png'): 'tile'})
+        self.assertEqual(cache.read(None, Coordinate(1, 0, 1), 'png'), None)
+
+    def test_hedged_read_errors(self):
+        '''Skip broken tiers, but raise a tile that left a note like read() does'''
+
+        tile = SlowCache(0, {(0, 0, 0, 'png'): 'tile'})
+        broken = Caches.Multi([NoteCache(IOError('Broken')), tile], hedge_delay=0.05)
+        self.assertEqual(broken.read(None, Coordinate(0, 0, 0), 'png'), 'tile')
+
+        note = Core.TheTileLeftANote(status_code=302)
+
+        for delay in (None, 0.05):
+            cache = Caches.Multi([NoteCache(note), tile], hedge_delay=delay)
+            self.assertRaises(Core.TheTileLeftANote, cache.read, None, Coordinate(0, 0, 0), 'png')
+
+
+class S3CacheTests(TestCase):
+    '''Tests the S3 cache against a local stand-in for S3'''
+
+    def setUp(self):
+        self.mock = mock_s3_deprecated()
+        self.mock.start()
+
+        S3Connection('access', 'secret').create_bucket('tiles')
+        self.config = parseConfig({
+            "layers": {"s3_layer": {"provider": {"name": "proxy", "url": "http://example.com/{Z}/{X}/{Y}.png"}}},
+            "cache": {"name": "S3", "bucket": "tiles", "access": "access", "secret": "secret", "use_locks": "local"}
+        })
+
+    def tearDown(self):
+        self.mock.stop()
+
+    def test_s3_read_and_save(self):
+        '''Save a tile to S3 and read it back, with a 404 for missing tiles'''
+
+        cache, layer = self.config.cache, self.config.layers['s3_layer']
+        coord = Coordinate(1, 2, 3)
+
+        self.assertEqual(cache.read(layer, coord, 'PNG'), None)
+
+        cache.save('tile', layer, coord, 'PNG')
+        self.assertEqual(cache.read(layer, coord, 'PNG'), 'tile')
+
+        layer.cache_lifespan = 60
+        self.assertEqual(cache.read(layer, coord, 'PNG'), 'tile')
+
+    def test_s3_local_locks(self):
+        '''Lock a tile in-process without writing lock objects to S3'''
+
+        cache, layer = self.config.cache, self.config.layers['s3_layer']
+        coord = Coordinate(1, 2, 3)
+        layer.stale_lock_timeout = 0.1
+
+        start = time()
+        cache.lock(layer, coord, 'PNG')
+        cache.unlock(layer, coord, 'PNG')
+        cache.lock(layer, coord, 'PNG')
+        self.assertTrue(time() - start < 0.1, 'Released lock should be free')
+
+        cache.lock(layer, coord, 'PNG')
+        self.assertTrue(time() - start >= 0.1, 'Held lock should wait for stale lock timeout')
+        cache.unlock(layer, coord, 'PNG')
+
+        self.assertEqual(list(cache.bucket.list()), [])
+
+
+class BundleCacheTests(TestCase):
+    '''Tests the Bundle cache in a temporary directory'''
+
+    def setUp(self):
+        self.path = mkdtemp(prefix='tilestache-bundle-')
+        self.config = parseConfig({
+            "layers": {"bundle_layer": {"provider": {"name": "proxy", "url": "http://example.com/{Z}/{X}/{Y}.png"}}},
+            "cache": {"name": "Bundle", "path": self.path, "size": 2}
+        })
+
+    def tearDown(self):
+        rmtree(self.path)
+
+    def test_bundle_read_save_remove(self):
+        '''Save neighboring tiles to one bundle file, read and remove them'''
+
+        cache, layer = self.config.cache, self.config.layers['bundle_layer']
+        coord1, coord2 = Coordinate(2, 2, 3), Coordinate(3, 3, 3)
+
+        self.assertEqual(cache.read(layer, coord1, 'PNG'), None)
+
+        cache.save('tile one', layer, coord1, 'PNG')
+        cache.save('tile two', layer, coord2, 'PNG')
+
+        self.assertEqual(cache.read(layer, coord1, 'PNG'), 'tile one')
+        self.assertEqual(cache.read(layer, coord2, 'PNG'), 'tile two')
+        self.assertEqual(cache.read(layer, Coordinate(2, 3, 3), 'PNG'), None)
+        self.assertEqual(os.listdir(os.path.join(self.path, 'bundle_layer', '3', '1')), ['1.png.bundle'])
+
+        cache.remove(layer, coord1, 'PNG')
+        self.assertEqual(cache.read(layer, coord1, 'PNG'), None)
+        self.assertEqual(cache.read(layer, coord2, 'PNG'), 'tile two')
+
+    def test_bundle_appended_saves(self):
+        '''Append saved tiles to a bundle, compacting it as it fills with old tiles'''
+
+        cache, layer = self.config.cache, self.config.layers['bundle_layer']
+        coord1, coord2 = Coordinate(2, 2, 3), Coordinate(3, 3, 3)
+        bundlepath, index = cache._bundlepath(layer, coord1, 'PNG')
+
+        cache.save('x' * 100, layer, coord2, 'PNG')
+        cache.save('y' * 1000, layer, coord1, 'PNG')
+        self.assertEqual(os.path.getsize(bundlepath), cache.index_length + 1100)
+
+        for i in range(10):
+            cache.save(str(i) * 1000, layer, coord1, 'PNG')
+            self.assertTrue(os.path.getsize(bundlepath) <= 2 * (cache.index_length + 1100))
+
+        self.assertEqual(cache.read(layer, coord1, 'PNG'), '9' * 1000)
+        self.assertEqual(cache.read(layer, coord2, 'PNG'), 'x' * 100)
+
+        # compacted bundles keep the umask permissions of new bundles.
+        self.assertEqual(os.stat(bundlepath).st_mode & 0777, 0666 & ~cache.umask)
+
+    def test_bundle_tile_lifespan(self):
+        '''Expire each tile in a bundle by its own save time'''
+
+        cache, layer = self.config.cache, self.config.layers['bundle_layer']
+        coord1, coord2 = Coordinate(2, 2, 3), Coordinate(3, 3, 3)
+        layer.cache_lifespan = 1
+
+        cache.save('tile one', layer, coord1, 'PNG')
+        sleep(1.1)
+        cache.save('tile two', layer, coord2, 'PNG')
+
+        self.assertEqual(cache.read(layer, coord1, 'PNG'), None)
+        self.assertEqual(cache.read(layer, coord2, 'PNG'), 'tile two')
+
+    def test_bundle_locks(self):
+        '''Lock and unlock a tile in a bundle'''
+
+        cache, layer = self.config.cache, self.config.layers['bundle_layer']
+        coord = Coordinate(2, 2, 3)
+
+        cache.lock(layer, coord, 'PNG')
+        self.assertTrue(os.path.isdir(cache._lockpath(layer, coord, 'PNG')))
+
+        cache.unlock(layer, coord, 'PNG')
+        self.assertFalse(os.path.exists(cache._lockpath(layer, coord, 'PNG')))
+
+
+class LMDBCacheTests(TestCase):
+    '''Tests the LMDB cache in a temporary directory'''
+
+    def setUp(self):
+        self.path = mkdtemp(prefix='tilestache-lmdb-')
+        self.config = parseConfig({
+            "layers": {"lmdb_layer": {"provider": {"name": "proxy", "url": "http://example.com/{Z}/{X}/{Y}.png"}}},
+            "cache": {"name": "LMDB", "path": self.path, "map size": 1 << 24}
+        })
+
+    def tearDown(self):
+        rmtree(self.path)
+
+    def test_lmdb_read_save_remove(self):
+        '''Save a tile to LMDB, read it back and remove it'''
+
+        cache, layer = self.config.cache, self.config.layers['lmdb_layer']
+        coord = Coordinate(2, 2, 3)
+
+        self.assertEqual(cache.read(layer, coord, 'PNG'), None)
+
+        cache.save('tile', layer, coord, 'PNG')
+        self.assertEqual(cache.read(layer, coord, 'PNG'), 'tile')
+        self.assertEqual(cache.read(layer, coord, 'JPEG'), None)
+
+        cache.remove(layer, coord, 'PNG')
+        self.assertEqual(cache.read(layer, coord, 'PNG'), None)
+
+    def test_lmdb_negative_coordinates(self):
+        '''Save and read tiles with negative columns and rows'''
+
+        cache, layer = self.config.cache, self.config.layers['lmdb_layer']
+        coord1, coord2 = Coordinate(-2, -3, 3), Coordinate(2, 3, 3)
+
+        cache.save('tile one', layer, coord1, 'PNG')
+        cache.save('tile two', layer, coord2, 'PNG')
+
+        self.assertEqual(cache.read(layer, coord1, 'PNG'), 'tile one')
+        self.assertEqual(cache.read(layer, coord2, 'PNG'), 'tile two')
+
+    def test_lmdb_batched_saves(self):
+        '''Write tiles saved under a lock when the lock is released'''
+
+        cache, layer = self.config.cache, self.config.layers['lmdb_layer']
+        coord1, coord2 = Coordinate(2, 2, 3), Coordinate(3, 3, 3)
+
+        cache.lock(layer, coord1, 'PNG')
+        cache.save('tile one', layer, coord1, 'PNG')
+        cache.save('tile two', layer, coord2, 'PNG')
+
+        with cache.env.begin() as txn:
+            self.assertEqual(txn.stat(cache.tiles)['entries'], 0)
+
+        cache.unlock(layer, coord1, 'PNG')
+
+        with cache.env.begin() as txn:
+            self.assertEqual(txn.stat(cache.tiles)['entries'], 2)
+
+        self.assertEqual(cache.read(layer, coord2, 'PNG'), 'tile two')
+
+    def test_lmdb_stale_lock(self):
+        '''Force a lock that was left behind after the stale lock timeout'''
+
+        cache, layer = self.config.cache, self.config.layers['lmdb_layer']
+        coord = Coordinate(2, 2, 3)
+        layer.stale_lock_timeout = 0.1
+
+        start = time()
+        cache.lock(layer, coord, 'PNG')
+        cache.lock(layer, coord, 'PNG')
+        self.assertTrue(time() - start >= 0.1, 'Held lock should wait for stale lock timeout')
+
+    def test_lmdb_forced_lock(self):
+        '''Leave a lock alone when its stale owner unlocks it'''
+
+        cache, layer = self.config.cache, self.config.layers['lmdb_layer']
+        coord = Coordinate(2, 2, 3)
+        layer.stale_lock_timeout = 0.1
+
+        cache.lock(layer, coord, 'PNG')
+
+        # another thread forces the stale lock, then the first owner finishes.
+        thread = Thread(target=cache.lock, args=(layer, coord, 'PNG'))
+        thread.start()
+        thread.join()
+
+        cache.unlock(layer, coord, 'PNG')
+
+        with cache.env.begin() as txn:
+            self.assertEqual(txn.stat(cache.locks)['entries'], 1)
+
+
+class FakeRedis:
+    '''In-memory stand-in for the few Redis commands used by the Redis cache'''
+
+    def __init__(self):
+        self.values = {}
+
+    def set(self, key, value, nx=False, px=None, ex=None):
+        if nx and key in self.values:
+            return None
+        self.values[key] = value
+        return True
+
+    def get(self, key):
+        return self.values.get(key)
+
+    def delete(self, key):
+        self.values.pop(key, None)
+
+    def unlock(self, keys, args):
+        if self.values.get(keys[0]) == args[0]:
+            del self.values[keys[0]]
+
+    def pubsub(self):
+        return FakePubSub()
+
+
+class FakePubSub:
+    '''Subscription that never hears anything'''
+
+    def subscribe(self, channel):
+        pass
+
+    def get_message(self, timeout):
+        sleep(min(timeout, .01))
+
+    def close(self):
+        pass
+
+
+class RedisCacheTests(TestCase):
+    '''Tests Redis cache locks against a fake Redis connection'''
+
+    def setUp(self):
+        self.config = parseConfig({
+            "layers": {"redis_layer": {"provider": {"name": "proxy", "url": "http://example.com/{Z}/{X}/{Y}.png"}}},
+            "cache": {"name": "Test"}
+        })
+        self.layer = self.config.layers['redis_layer']
+        self.layer.stale_lock_timeout = 0.1
+
+        self.cache = Redis.Cache()
+        self.cache.conn = FakeRedis()
+        self.cache.unlock_script = self.cache.conn.unlock
+
+    def test_redis_lock_unlock(self):
+        '''Lock and unlock a tile'''
+
+        cache, coord = self.cache, Coordinate(2, 2, 3)
+        key = Redis.tile_key(self.layer, coord, 'PNG', '') + '-lock'
+
+        cache.lock(self.layer, coord, 'PNG')
+        self.assertTrue(key in cache.conn.values)
+
+        cache.unlock(self.layer, coord, 'PNG')
+        self.assertFalse(key in cache.conn.values)
+
+    def test_redis_held_lock(self):
+        '''Go on without a lock held past the stale lock timeout, leaving it be'''
+
+        cache, coord = self.cache, Coordinate(2, 2, 3)
+        key = Redis.tile_key(self.layer, coord, 'PNG', '') + '-lock'
+        cache.conn.set(key, 'somebody else')
+
+        start = time()
+        cache.lock(self.layer, coord, 'PNG')
+        self.assertTrue(time() - start >= 0.1, 'Held lock should wait for stale lock timeout')
+        self.assertEqual(cache.conn.get(key), 'somebody else')
+
+        cache.unlock(self.layer, coord, 'PNG')
+        self.assertEqual(cache.conn.get(key), 'somebody else')
+
+    def test_redis_thread_tokens(self):
+        '''Keep lock tokens apart for threads sharing one cache'''
+
+        cache, coord = self.cache, Coordinate(2, 2, 3)
+        key = Redis.tile_key(self.layer, coord, 'PNG', '') + '-lock'
+
+        cache.lock(self.layer, coord, 'PNG')
+        token = cache.conn.get(key)
+
+        def waiting():
+            cache.lock(self.layer, coord, 'PNG')
+            cache.unlock(self.layer, coord, 'PNG')
+
+        thread = Thread(target=waiting)
+        thread.start()
+        thread.join()
+
+        self.assertEqual(cache.conn.get(key), token, 'Other thread should not release this lock')
+
+        cache.unlock(self.layer, coord, 'PNG')
+        self.assertEqual(cache.conn.get(key), None)
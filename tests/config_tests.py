@@ -1,5 +1,13 @@
 from unittest import TestCase
-from TileStache import Core, parseConfig
+from tempfile import mkstemp
+from time import time, sleep
+from json import dump
+from os import close, unlink, utime
+from wsgiref import util
+
+from TileStache import Core, parseConfig, WSGITileServer
+from TileStache.Config import loadClassPath
+from ModestMaps.Core import Coordinate
 
 class ConfigTests(TestCase):
 
@@ -26,4 +34,233 @@ class ConfigTests(TestCase):
         self.assertEqual(config.cache.servers, ["127.0.0.1:11211"])
         self.assertEqual(config.cache.revision, 4)
         self.assertTrue(config.layers['memcache_osm'])
-        self.assertTrue(isinstance(config.layers['memcache_osm'], Core.Layer))
\ No newline at end of file
+        self.assertTrue(isinstance(config.layers['memcache_osm'], Core.Layer))
+
+    def test_layer_names(self):
+        '''Layers know their configured names without searching config.layers'''
+
+        config = parseConfig({
+            "cache": {"name": "Test"},
+            "layers": {"osm": {"provider": {"name": "proxy", "url": "http://tile.openstreetmap.org/{Z}/{X}/{Y}.png"}}}
+        })
+
+        layer = config.layers['osm']
+        config.layers = {}
+
+        self.assertEqual(layer.name(), 'osm')
+        self.assertEqual(Core.Layer(config, None, None).name(), None)
+
+class CountingProvider:
+    ''' Provider that counts how many times it has been built.
+    '''
+    built = 0
+
+    def __init__(self, layer):
+        CountingProvider.built += 1
+
+class PrewarmProvider:
+    ''' Provider that counts how many times it has been prewarmed.
+    '''
+    prewarmed = 0
+
+    def __init__(self, layer):
+        pass
+
+    def prewarm(self):
+        PrewarmProvider.prewarmed += 1
+
+class LazyProviderTests(TestCase):
+
+    def test_lazy_provider(self):
+        '''Providers are built on first use, once'''
+
+        config = parseConfig({
+            "cache": {"name": "Test"},
+            "layers": {
+                "counted": {"provider": {"class": "tests.config_tests:CountingProvider"}},
+                "nowhere": {"provider": {"class": "tests.nonexistent:Provider"}}
+            }
+        })
+
+        CountingProvider.built = 0
+        layer = config.layers['counted']
+
+        self.assertEqual(CountingProvider.built, 0)
+        self.assertTrue(isinstance(layer.provider, CountingProvider))
+        self.assertTrue(layer.provider is layer.provider)
+        self.assertEqual(CountingProvider.built, 1)
+
+        # bad classes are only noticed when used.
+        self.assertRaises(Core.KnownUnknown, getattr, config.layers['nowhere'], 'provider')
+
+    def test_failed_provider(self):
+        '''Providers that fail to build are built again only after a while'''
+
+        calls = []
+
+        def factory(layer):
+            calls.append(layer)
+            raise IOError('No stylesheet')
+
+        layer = parseConfig({"cache": {"name": "Test"}, "layers": {"counted": {"provider": {"class": "tests.config_tests:CountingProvider"}}}}).layers['counted']
+        layer.setProviderFactory(factory)
+
+        for i in range(3):
+            self.assertRaises(IOError, getattr, layer, 'provider')
+
+        self.assertEqual(len(calls), 1)
+
+        # the factory is tried again once the retry time has passed.
+        layer._provider_failed -= Core._provider_retry
+        layer.setProviderFactory(CountingProvider)
+        self.assertTrue(isinstance(layer.provider, CountingProvider))
+        self.assertEqual(len(calls), 1)
+
+        # other layers build their providers with their own locks.
+        self.assertFalse(layer._provider_lock is Core.Layer(None, None, None)._provider_lock)
+
+    def test_deprecated_names(self):
+        '''Old provider names are still found in TileStache.Providers'''
+
+        from TileStache import Providers, Mapnik
+
+        try:
+            from TileStache import Vector
+        except ImportError:
+            # Vector is only imported when first used, e.g. without osgeo.
+            self.assertRaises(ImportError, getattr, Providers.Vector, 'Provider')
+        else:
+            self.assertTrue(Providers.Vector.Provider is Vector.Provider)
+
+        ImageProvider = Mapnik.ImageProvider
+        Mapnik.ImageProvider = lambda layer, **kwargs: (layer, kwargs)
+
+        try:
+            _class = loadClassPath('TileStache.Providers:Mapnik')
+            self.assertEqual(_class('layer', mapfile='style.xml'), ('layer', {'mapfile': 'style.xml'}))
+        finally:
+            Mapnik.ImageProvider = ImageProvider
+
+class ReloadTests(TestCase):
+
+    def setUp(self):
+        handle, self.filename = mkstemp(prefix='tilestache-config-', suffix='.cfg')
+        close(handle)
+
+        self.layers = {
+            "counted": {"provider": {"class": "tests.config_tests:CountingProvider"}},
+            "proxied": {"provider": {"name": "proxy", "url": "http://example.com/{Z}/{X}/{Y}.png"}}
+        }
+
+        self.cache = {"name": "Test"}
+        self.write()
+
+    def tearDown(self):
+        unlink(self.filename)
+
+    def write(self):
+        with open(self.filename, 'w') as file:
+            dump({"cache": self.cache, "layers": self.layers}, file)
+
+        # make sure the modification time moves forward.
+        utime(self.filename, (time() + 10, time() + 10))
+
+    def request(self, app, path_info):
+        environ = {'PATH_INFO': path_info}
+        util.setup_testing_defaults(environ)
+        return app(environ, lambda status, headers: None)
+
+    def reload(self, app):
+        """ Make a request that notices the changed file, and wait for the reload.
+        """
+        config, app.config_checked = app.config, 0
+        self.request(app, '/nothing/0/0/0.png')
+
+        due = time() + 5
+
+        while app.config is config and time() < due:
+            sleep(.01)
+
+        self.assertFalse(app.config is config)
+
+    def test_reload_changed_layers(self):
+        '''Reloading rebuilds only changed layers and keeps unchanged providers'''
+
+        app = WSGITileServer(self.filename, autoreload=True)
+        old_config = app.config
+        counted, proxied = old_config.layers['counted'], old_config.layers['proxied']
+        counted_provider = counted.provider
+
+        self.layers['proxied']['provider']['url'] = 'http://example.org/{Z}/{X}/{Y}.png'
+        self.layers['added'] = {"provider": {"name": "proxy", "url": "http://example.net/{Z}/{X}/{Y}.png"}}
+        self.write()
+        self.reload(app)
+
+        # unchanged layer is moved over with its provider and the same cache.
+        self.assertTrue(app.config.layers['counted'] is counted)
+        self.assertTrue(app.config.layers['counted'].provider is counted_provider)
+        self.assertTrue(app.config.layers['counted'].config is app.config)
+        self.assertTrue(app.config.cache is old_config.cache)
+
+        # changed layer is new, but the old one is left for requests in flight.
+        self.assertFalse(app.config.layers['proxied'] is proxied)
+        self.assertTrue(old_config.layers['proxied'] is proxied)
+        self.assertEqual(app.config.layers['added'].provider.provider.getTileUrls(Coordinate(0, 0, 0)), ['http://example.net/0/0/0.png'])
+
+    def test_reload_changed_cache(self):
+        '''Reloading with a changed cache rebuilds every layer, leaving old ones alone'''
+
+        app = WSGITileServer(self.filename, autoreload=True)
+        old_config = app.config
+        counted = old_config.layers['counted']
+
+        self.cache = {"name": "Test", "verbose": False}
+        self.write()
+        self.reload(app)
+
+        self.assertFalse(app.config.cache is old_config.cache)
+        self.assertFalse(app.config.layers['counted'] is counted)
+        self.assertTrue(app.config.layers['counted'].config is app.config)
+
+        # requests in flight keep the layer's old cache.
+        self.assertTrue(counted.config is old_config)
+        self.assertTrue(counted.config.cache is old_config.cache)
+
+    def test_reload_prewarm(self):
+        '''Providers are prewarmed at startup and after reloading, before use'''
+
+        PrewarmProvider.prewarmed = 0
+        self.layers['warm'] = {"provider": {"class": "tests.config_tests:PrewarmProvider"}}
+        self.write()
+
+        app = WSGITileServer(self.filename, autoreload=True, prewarm=True)
+        self.assertEqual(PrewarmProvider.prewarmed, 1)
+
+        # unchanged providers aren't prewarmed again.
+        self.layers['warmer'] = {"provider": {"class": "tests.config_tests:PrewarmProvider"}}
+        self.write()
+        self.reload(app)
+
+        self.assertEqual(PrewarmProvider.prewarmed, 2)
+
+        # without the option, providers wait for their first request.
+        WSGITileServer(self.filename)
+        self.assertEqual(PrewarmProvider.prewarmed, 2)
+
+    def test_reload_bad_config(self):
+        '''A broken configuration file leaves the old configuration in place'''
+
+        app = WSGITileServer(self.filename, autoreload=True)
+        config = app.config
+
+        with open(self.filename, 'w') as file:
+            file.write('{"cache": {"name": "Test"}, "lay')
+
+        app.config_checked = 0
+        self.request(app, '/nothing/0/0/0.png')
+
+        # wait for the reload to finish.
+        app.reload_lock.acquire()
+        app.reload_lock.release()
+
+        self.assertTrue(app.config is config)
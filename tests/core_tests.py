@@ -0,0 +1,503 @@
+from unittest import TestCase
+from json import dumps
+import json
+from StringIO import StringIO
+from time import time, sleep
+
+try:
+    from PIL import Image
+except ImportError:
+    import Image
+
+from TileStache import Core, Caches, Encoders, Mapnik, parseConfig
+from TileStache.Core import KnownUnknown
+from ModestMaps.Core import Coordinate
+
+class RenderCountingProvider:
+    ''' Provider of gray areas, counting how many times it renders.
+    '''
+    rendered = 0
+
+    def __init__(self, layer):
+        pass
+
+    def renderArea(self, width, height, *args):
+        RenderCountingProvider.rendered += 1
+        return Image.new('RGB', (width, height), (0x80, 0x80, 0x80))
+
+class GridResponse:
+    ''' JSON response like TileStache.Mapnik.SaveableResponse.
+    '''
+    def __init__(self, content):
+        self.content = content
+
+    def save(self, out, format):
+        out.write(dumps(self.content))
+
+class GridProvider:
+    ''' Provider of tiny UTFGrid responses.
+    '''
+    def __init__(self, layer):
+        pass
+
+    def getTypeByExtension(self, extension):
+        return 'application/json', 'JSON'
+
+    def renderTile(self, width, height, srs, coord):
+        return GridResponse({'keys': ['', '1'], 'data': {'1': {'id': 1}}, 'grid': [' !', '! ']})
+
+class TileObjectTests(TestCase):
+
+    def setUp(self):
+        Core._recent_objects.clear()
+        RenderCountingProvider.rendered = 0
+
+        self.config = parseConfig({
+            'cache': {'name': 'Test'},
+            'layers': {
+                'gray': {'provider': {'class': 'tests.core_tests:RenderCountingProvider'}},
+                'metagray': {'provider': {'class': 'tests.core_tests:RenderCountingProvider'}, 'metatile': {'rows': 2, 'columns': 2}},
+                'grid': {'provider': {'class': 'tests.core_tests:GridProvider'}}
+            }
+        })
+
+    def test_rendered_image(self):
+        '''Rendered images are used without encoding and decoding'''
+
+        layer = self.config.layers['gray']
+        image = layer.getTileObject(Coordinate(0, 0, 1), 'png')
+
+        self.assertTrue(isinstance(image, Image.Image))
+        self.assertEqual(image.getpixel((0, 0)), (0x80, 0x80, 0x80))
+        self.assertTrue(layer.getTileObject(Coordinate(0, 0, 1), 'png') is image)
+        self.assertEqual(RenderCountingProvider.rendered, 1)
+
+        # other formats are always decoded, because they may be lossy.
+        jpeg = layer.getTileObject(Coordinate(0, 0, 1), 'jpg')
+        self.assertFalse(layer.getTileObject(Coordinate(0, 0, 1), 'jpg') is jpeg)
+        self.assertEqual(RenderCountingProvider.rendered, 3)
+
+    def test_metatile(self):
+        '''Metatile neighbors are kept too'''
+
+        layer = self.config.layers['metagray']
+
+        for (row, column) in ((0, 0), (0, 1), (1, 0), (1, 1)):
+            image = layer.getTileObject(Coordinate(row, column, 1), 'png')
+            self.assertEqual(image.size, (256, 256))
+
+        self.assertEqual(RenderCountingProvider.rendered, 1)
+
+    def test_oldest_forgotten(self):
+        '''Only the most recently used objects are kept'''
+
+        layer = self.config.layers['gray']
+        first = layer.getTileObject(Coordinate(0, 0, 10), 'png')
+
+        for column in range(1, Core._recent_objects_size + 1):
+            layer.getTileObject(Coordinate(0, column, 10), 'png')
+
+        self.assertEqual(len(Core._recent_objects), Core._recent_objects_size)
+        self.assertFalse(layer.getTileObject(Coordinate(0, 0, 10), 'png') is first)
+
+    def test_lifespan(self):
+        '''Objects are kept no longer than the recent objects or cache lifespan'''
+
+        layer = self.config.layers['gray']
+        layer.cache_lifespan = 1
+
+        layer.getTileObject(Coordinate(0, 0, 1), 'png')
+        tile, use_by = Core._recent_objects.values()[0]
+        self.assertTrue(use_by <= time() + 1)
+
+        # nothing is kept once it's turned off.
+        layer.recent_objects_lifespan = 0
+        layer.getTileObject(Coordinate(0, 0, 2), 'png')
+        layer.getTileObject(Coordinate(0, 0, 2), 'png')
+
+        self.assertEqual(len(Core._recent_objects), 1)
+        self.assertEqual(RenderCountingProvider.rendered, 3)
+
+    def test_grid(self):
+        '''JSON tiles are parsed grids'''
+
+        grid = self.config.layers['grid'].getTileObject(Coordinate(0, 0, 1), 'json')
+
+        self.assertEqual(grid['keys'], ['', '1'])
+        self.assertEqual(grid['grid'], [' !', '! '])
+
+class BrokenImage:
+    ''' Image-like object that can't be cropped after the first few times.
+    '''
+    def __init__(self, image):
+        self.image, self.crops = image, 0
+
+    def save(self, out, format):
+        self.image.save(out, format)
+
+    def crop(self, bbox):
+        self.crops += 1
+
+        if self.crops > 3:
+            raise IOError('Broken crop')
+
+        return self.image.crop(bbox)
+
+class BrokenProvider:
+    ''' Provider of images that break when sliced.
+    '''
+    def renderArea(self, width, height, *args):
+        return BrokenImage(Image.new('RGB', (width, height)))
+
+class MetatileThreadsTests(TestCase):
+
+    def setUp(self):
+        Core._recent_objects.clear()
+
+    def config(self, threads):
+        return parseConfig({
+            'cache': {'name': 'Test'},
+            'layers': {'noise': {'provider': {'class': 'TileStache.Benchmark.scenarios:SyntheticProvider'}, 'metatile': {'rows': 4, 'columns': 4, 'buffer': 16, 'threads': threads}}}
+        })
+
+    def test_threads(self):
+        '''Metatiles sliced in several threads have the same tiles'''
+
+        bodies = []
+
+        for threads in (1, 4):
+            layer = self.config(threads).layers['noise']
+            tile = layer.render(Coordinate(1, 2, 12), 'PNG')
+
+            coords = layer.metatile.allCoords(Coordinate(1, 2, 12))
+            bodies.append([Core._getRecentTile(layer, coord, 'PNG') for coord in coords])
+
+            self.assertEqual(layer.metatile.threads, threads)
+            self.assertTrue(Core._getRecentObject(layer, Coordinate(1, 2, 12), 'PNG') is tile)
+
+        self.assertEqual(len(bodies[0]), 16)
+        self.assertEqual(bodies[0], bodies[1])
+
+    def test_errors(self):
+        '''Errors slicing metatiles in threads are raised'''
+
+        layer = self.config(4).layers['noise']
+        layer.provider = BrokenProvider()
+
+        self.assertRaises(IOError, layer.render, Coordinate(1, 2, 12), 'PNG')
+
+    def test_default(self):
+        '''Metatiles are sliced in one thread unless configured otherwise'''
+
+        self.assertEqual(self.config(1).layers['noise'].metatile.threads, 1)
+        self.assertEqual(Core.Metatile().threads, 1)
+
+    def test_stopped_early(self):
+        '''Threads stop encoding when the caller stops asking for tiles'''
+
+        layer = self.config(2).layers['noise']
+        surtile = Image.new('RGB', (1024, 1024))
+        subtiles = [(Coordinate(row, col, 12), col * 256, row * 256) for row in range(4) for col in range(4)]
+        encoded, encodeTile = [], Core._encodeTile
+
+        def slowly(*args):
+            encoded.append(None)
+            sleep(.05)
+            return encodeTile(*args)
+
+        Core._encodeTile = slowly
+
+        try:
+            sliced = Core._sliceSubtiles(layer, surtile, subtiles, 'PNG', False, 2)
+            sliced.next()
+            sliced.close()
+            sleep(.3)
+        finally:
+            Core._encodeTile = encodeTile
+
+        self.assertTrue(len(encoded) <= 4, 'Only tiles already started should be encoded')
+
+class Palette256Tests(TestCase):
+
+    def setUp(self):
+        Core._recent_objects.clear()
+
+    def layer(self, palette256):
+        config = parseConfig({
+            'cache': {'name': 'Test'},
+            'layers': {'noise': {'provider': {'class': 'TileStache.Benchmark.scenarios:SyntheticProvider'},
+                                 'metatile': {'rows': 2, 'columns': 2, 'threads': 1},
+                                 'png options': {'palette256': palette256}}}
+        })
+
+        return config.layers['noise']
+
+    def palettes(self, layer, coord):
+        ''' Return list of palettes from a rendered metatile's tiles.
+        '''
+        layer.render(coord, 'PNG')
+
+        tiles = [Image.open(StringIO(Core._getRecentTile(layer, other, 'PNG')))
+                 for other in layer.metatile.allCoords(coord)]
+
+        self.assertEqual([tile.mode for tile in tiles], ['P'] * 4)
+
+        return [tile.getpalette() for tile in tiles]
+
+    def test_tile(self):
+        '''Each tile can have its own palette'''
+
+        palettes = self.palettes(self.layer(True), Coordinate(0, 0, 12))
+        self.assertNotEqual(palettes[0], palettes[1])
+
+    def test_metatile(self):
+        '''Tiles of a metatile can share one palette'''
+
+        layer = self.layer('metatile')
+        palettes = self.palettes(layer, Coordinate(0, 0, 12)) + self.palettes(layer, Coordinate(0, 2, 12))
+
+        self.assertEqual(palettes[:4], [palettes[0]] * 4)
+        self.assertEqual(palettes[4:], [palettes[4]] * 4)
+        self.assertEqual(layer._palettes256, {})
+
+    def test_zoom(self):
+        '''Metatiles can share one palette at each zoom'''
+
+        layer = self.layer('zoom')
+        palettes = self.palettes(layer, Coordinate(0, 0, 12))
+
+        self.assertEqual(palettes, [palettes[0]] * 4)
+        self.assertEqual(layer._palettes256[12].getpalette(), palettes[0])
+
+        # a palette of grays is reused at zoom 13.
+        grays = Image.new('P', (1, 1))
+        grays.putpalette([i for i in range(256) for j in range(3)])
+        layer._palettes256[13] = grays
+
+        palettes = self.palettes(layer, Coordinate(0, 0, 13)) + self.palettes(layer, Coordinate(0, 2, 13))
+        self.assertEqual(palettes, [grays.getpalette()] * 8)
+
+    def test_bad_value(self):
+        '''Unknown palette256 values are errors'''
+
+        self.assertRaises(KnownUnknown, self.layer, 'sometimes')
+
+class SolidProvider:
+    ''' Provider of one solid color, like water or an empty overlay.
+    '''
+    def __init__(self, layer, mode='RGBA', color=(0, 0, 0, 0)):
+        self.mode, self.color = mode, tuple(color) if type(color) is list else color
+
+    def renderArea(self, width, height, *args):
+        return Image.new(self.mode, (width, height), self.color)
+
+class SolidTileTests(TestCase):
+
+    def config(self, layer_dict):
+        config = parseConfig({'cache': {'name': 'Test'}, 'layers': {'solid': layer_dict}})
+        config.cache = Caches.Test(logfunc=self.cached.append)
+
+        return config
+
+    def setUp(self):
+        self.cached = []
+
+    def test_solid_tiles(self):
+        '''Tiles of one color are encoded once'''
+
+        for metatile in ({}, {'rows': 2, 'columns': 2}):
+            layer = self.config({'provider': {'class': 'tests.core_tests:SolidProvider', 'kwargs': {'color': [0xAA, 0xD3, 0xDF, 0xFF]}},
+                                 'metatile': metatile}).layers['solid']
+
+            status, headers, body1 = layer.getTileResponse(Coordinate(0, 0, 12), 'png')
+            status, headers, body2 = layer.getTileResponse(Coordinate(4, 4, 12), 'png')
+
+            self.assertTrue(body1 is body2)
+            self.assertEqual(layer._solid_tiles.keys(), [('PNG', 'RGBA', (256, 256), (0xAA, 0xD3, 0xDF, 0xFF), None, ())])
+            self.assertEqual(Image.open(StringIO(body1)).getpixel((128, 128)), (0xAA, 0xD3, 0xDF, 0xFF))
+
+        # black is a color too.
+        layer = self.config({'provider': {'class': 'tests.core_tests:SolidProvider', 'kwargs': {'mode': 'L', 'color': 0}}}).layers['solid']
+        layer.getTileResponse(Coordinate(0, 0, 12), 'png')
+        self.assertEqual(layer._solid_tiles.keys(), [('PNG', 'L', (256, 256), 0, None, ())])
+
+        # other tiles aren't kept.
+        layer = self.config({'provider': {'class': 'TileStache.Benchmark.scenarios:SyntheticProvider'}}).layers['solid']
+        layer.getTileResponse(Coordinate(0, 0, 12), 'png')
+        self.assertEqual(layer._solid_tiles, {})
+
+    def test_solid_tile_options(self):
+        '''Tiles of one color are kept apart for each set of encoding options'''
+
+        layer = self.config({'provider': {'class': 'tests.core_tests:SolidProvider'}}).layers['solid']
+        tile = Image.new('RGBA', (256, 256), (0xAA, 0xD3, 0xDF, 0xFF))
+        fast, small = Encoders.PNGFast(), Encoders.PNGSmall()
+
+        bodies = [Core._encodeTile(layer, tile, 'PNG', {}),
+                  Core._encodeTile(layer, tile, 'PNG', {'optimize': True}),
+                  Core._encodeTile(layer, tile, 'PNG', {}, fast),
+                  Core._encodeTile(layer, tile, 'PNG', {}, small)]
+
+        self.assertEqual(len(layer._solid_tiles), 4)
+        self.assertTrue(Core._encodeTile(layer, tile, 'PNG', {'optimize': True}) is bodies[1])
+        self.assertTrue(Core._encodeTile(layer, tile, 'PNG', {}, Encoders.PNGSmall()) is bodies[3])
+
+    def test_out_of_bounds(self):
+        '''Tiles outside the bounds skip the cache'''
+
+        bounds = {'low': 10, 'high': 12, 'north': 37.9, 'west': -122.4, 'south': 37.7, 'east': -122.1}
+        layer = self.config({'provider': {'class': 'TileStache.Benchmark.scenarios:SyntheticProvider'}, 'bounds': bounds}).layers['solid']
+
+        bodies = []
+
+        for i in range(2):
+            status, headers, body = layer.getTileResponse(Coordinate(0, 0, 12), 'png')
+            bodies.append(body)
+
+            self.assertEqual(status, 404)
+            self.assertEqual(Image.open(StringIO(body)).getpixel((0, 0)), (0, 0, 0, 0))
+
+        self.assertEqual(self.cached, [])
+        self.assertEqual(len(layer._solid_tiles), 1)
+
+        # the empty tile is encoded just once.
+        self.assertTrue(bodies[0] is bodies[1])
+        self.assertEqual(layer._empty_tiles.keys(), [('PNG', 256)])
+
+        status, headers, body = layer.getTileResponse(Coordinate(1582, 655, 12), 'png')
+
+        self.assertEqual(status, 200)
+        self.assertNotEqual(self.cached, [])
+
+class CombinedProvider:
+    ''' Provider of gray images with a matching UTF Grid, like Mapnik with a grid option.
+    '''
+    rendered = 0
+
+    def __init__(self, layer):
+        pass
+
+    def renderArea(self, width, height, *args):
+        CombinedProvider.rendered += 1
+
+        image = Image.new('RGB', (width, height), (0x80, 0x80, 0x80))
+        rows = [u'!' * (width / 4)] * (height / 4)
+        grid = Mapnik.SaveableResponse({'keys': ['', '1'], 'data': {'1': {'id': 1}}, 'grid': rows}, 4)
+
+        return Mapnik.ImageGridResponse(image, grid)
+
+    def getTypeByExtension(self, extension):
+        return {'png': ('image/png', 'PNG'), 'jpg': ('image/jpeg', 'JPEG'), 'json': ('application/json', 'JSON')}[extension]
+
+class CombinedRenderTests(TestCase):
+
+    def setUp(self):
+        Core._recent_objects.clear()
+        CombinedProvider.rendered = 0
+        self.saved = []
+
+    def layer(self, metatile):
+        config = parseConfig({'cache': {'name': 'Test'}, 'layers': {'both': {'provider': {'class': 'tests.core_tests:CombinedProvider'}, 'metatile': metatile}}})
+        config.cache = Caches.Test(logfunc=self.log)
+
+        return config.layers['both']
+
+    def log(self, message):
+        if message.startswith('Test cache save:'):
+            self.saved.append(message.split(' to ')[1])
+
+    def test_tile(self):
+        '''Rendering one format saves the other'''
+
+        layer = self.layer({})
+        status, headers, body = layer.getTileResponse(Coordinate(0, 0, 1), 'png')
+
+        self.assertEqual(Image.open(StringIO(body)).size, (256, 256))
+        self.assertEqual(sorted(self.saved), ['both 1/0/0 JSON', 'both 1/0/0 PNG'])
+        self.assertEqual(Core._getRecentObject(layer, Coordinate(0, 0, 1), 'JSON')['keys'], ['', '1'])
+
+        # other image formats are made from the image.
+        status, headers, body = layer.getTileResponse(Coordinate(0, 0, 1), 'jpg')
+        self.assertEqual(Image.open(StringIO(body)).format, 'JPEG')
+        self.assertEqual(CombinedProvider.rendered, 2)
+
+    def test_metatile(self):
+        '''Every tile of a metatile is saved in both formats'''
+
+        layer = self.layer({'rows': 2, 'columns': 2, 'buffer': 16, 'threads': 1})
+        status, headers, body = layer.getTileResponse(Coordinate(0, 0, 1), 'json')
+
+        grid = json.loads(body)
+        self.assertEqual(len(grid['grid']), 64)
+        self.assertEqual(set(grid['grid']), set([u'!' * 64]))
+
+        expected = ['both 1/%d/%d %s' % (column, row, format) for format in ('JSON', 'PNG') for column in (0, 1) for row in (0, 1)]
+        self.assertEqual(set(self.saved), set(expected))
+        self.assertEqual(CombinedProvider.rendered, 1)
+
+        tile = Core._getRecentObject(layer, Coordinate(1, 1, 1), 'PNG')
+        self.assertEqual(tile.size, (256, 256))
+
+class HalfResolutionTests(TestCase):
+
+    def setUp(self):
+        Core._recent_objects.clear()
+        RenderCountingProvider.rendered = 0
+        self.saved = []
+
+    def config(self, metatile):
+        config = parseConfig({'cache': {'name': 'Test'}, 'layers': {'gray@2x': {'provider': {'class': 'tests.core_tests:RenderCountingProvider'},
+                                                                               'metatile': metatile, 'tile height': 512, 'half resolution layer': 'gray'}}})
+        config.cache = Caches.Test(logfunc=self.log)
+
+        return config
+
+    def log(self, message):
+        if message.startswith('Test cache save:'):
+            self.saved.append(message.split(' to ')[1])
+
+    def test_tile(self):
+        '''One render makes tiles at both resolutions'''
+
+        config = self.config({})
+        gray, gray2x = config.layers['gray'], config.layers['gray@2x']
+
+        self.assertTrue(gray.double_layer is gray2x)
+        self.assertTrue(gray.provider is gray2x.provider)
+        self.assertEqual((gray.dim, gray2x.dim), (256, 512))
+
+        status, headers, body = gray.getTileResponse(Coordinate(0, 0, 1), 'png')
+
+        self.assertEqual(Image.open(StringIO(body)).size, (256, 256))
+        self.assertEqual(set(self.saved), set(['gray 1/0/0 PNG', 'gray@2x 1/0/0 PNG']))
+
+        status, headers, body = gray2x.getTileResponse(Coordinate(0, 1, 1), 'png')
+
+        self.assertEqual(Image.open(StringIO(body)).size, (512, 512))
+        self.assertTrue('gray 1/1/0 PNG' in self.saved)
+        self.assertEqual(RenderCountingProvider.rendered, 2)
+
+    def test_metatile(self):
+        '''Metatiles are rendered once for both resolutions'''
+
+        config = self.config({'rows': 2, 'columns': 2, 'buffer': 32, 'threads': 1})
+        gray = config.layers['gray']
+
+        self.assertEqual(gray.metatile.buffer, 16)
+        self.assertEqual(gray.metaSize(Coordinate(0, 0, 1)), (544, 544))
+
+        gray.getTileResponse(Coordinate(0, 0, 1), 'png')
+
+        expected = ['%s 1/%d/%d PNG' % (name, column, row) for name in ('gray', 'gray@2x') for column in (0, 1) for row in (0, 1)]
+        self.assertEqual(set(self.saved), set(expected))
+        self.assertEqual(RenderCountingProvider.rendered, 1)
+
+        self.assertEqual(Core._getRecentObject(gray, Coordinate(1, 1, 1), 'PNG').size, (256, 256))
+        self.assertEqual(Core._getRecentObject(config.layers['gray@2x'], Coordinate(1, 1, 1), 'PNG').size, (512, 512))
+
+    def test_bad_config(self):
+        '''Half resolution layers need even sizes and their own names'''
+
+        self.assertRaises(KnownUnknown, self.config, {'buffer': 15})
+        self.assertRaises(KnownUnknown, parseConfig, {'cache': {'name': 'Test'}, 'layers': {'a': {'provider': {'name': 'proxy', 'url': 'http://example.com/{Z}/{X}/{Y}.png'}, 'half resolution layer': 'b'},
+                                                                                          'b': {'provider': {'name': 'proxy', 'url': 'http://example.com/{Z}/{X}/{Y}.png'}}}})
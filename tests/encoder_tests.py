@@ -0,0 +1,83 @@
+from unittest import TestCase
+from StringIO import StringIO
+
+try:
+    from PIL import Image
+except ImportError:
+    import Image
+
+from ModestMaps.Core import Coordinate
+
+from TileStache import Encoders, parseConfig, requestHandler2
+from TileStache.Core import KnownUnknown
+
+class EncoderTests(TestCase):
+
+    def config(self, encoders, metatile={}):
+        return parseConfig({
+            'cache': {'name': 'Test'},
+            'layers': {'noise': {'provider': {'class': 'TileStache.Benchmark.scenarios:SyntheticProvider'},
+                                 'metatile': metatile, 'encoders': encoders}}
+        })
+
+    def test_profiles(self):
+        '''Profiles are chosen by format, with options'''
+
+        layer = self.config(['png-fast', {'name': 'webp-lossy', 'quality': 50}]).layers['noise']
+
+        self.assertEqual(sorted(layer.encoders.keys()), ['PNG', 'WEBP'])
+        self.assertEqual(layer.encoders['PNG'].save_kwargs, {'compress_level': 1})
+        self.assertEqual(layer.encoders['WEBP'].save_kwargs, {'quality': 50, 'method': 4})
+
+        self.assertEqual(layer.getTypeByExtension('webp'), ('image/webp', 'WEBP'))
+        self.assertEqual(layer.getTypeByExtension('jpg'), ('image/jpeg', 'JPEG'))
+
+        self.assertRaises(KnownUnknown, self.config, ['png-fastest'])
+        self.assertRaises(KnownUnknown, self.config, ['png-fast', 'png-small'])
+
+    def test_encoding(self):
+        '''Tiles and metatiles are encoded with profiles'''
+
+        for metatile in ({}, {'rows': 2, 'columns': 2}):
+            layer = self.config(['png-quantized', 'webp-lossless'], metatile).layers['noise']
+
+            status, headers, body = layer.getTileResponse(Coordinate(0, 0, 12), 'png')
+            self.assertEqual(Image.open(StringIO(body)).mode, 'P')
+
+            status, headers, body = layer.getTileResponse(Coordinate(0, 1, 12), 'webp')
+            self.assertEqual(headers['Content-Type'], 'image/webp')
+            self.assertEqual(Image.open(StringIO(body)).format, 'WEBP')
+
+    def test_small_profiles(self):
+        '''Smaller profiles make smaller tiles'''
+
+        image = Image.new('RGB', (256, 256), (0xF2, 0xEF, 0xE9))
+        image.paste((0xAA, 0xD3, 0xDF), (40, 40, 140, 200))
+
+        sizes = {}
+
+        for name in ('png-fast', 'png-small'):
+            out = StringIO()
+            Encoders.all[name]().encode(image, out)
+            sizes[name] = len(out.getvalue())
+
+        self.assertTrue(sizes['png-small'] < sizes['png-fast'])
+
+    def test_accept(self):
+        '''WebP is served to clients that accept it'''
+
+        config = self.config(['webp-lossy'])
+
+        status, headers, body = requestHandler2(config, '/noise/12/0/0.png', accept='image/webp,image/*;q=0.8')
+        self.assertEqual(headers['Content-Type'], 'image/webp')
+        self.assertEqual(headers['Vary'], 'Accept')
+
+        for accept in (None, 'image/png,image/*;q=0.8', 'image/webp;q=0'):
+            status, headers, body = requestHandler2(config, '/noise/12/0/0.png', accept=accept)
+            self.assertEqual(headers['Content-Type'], 'image/png')
+            self.assertEqual(headers['Vary'], 'Accept')
+
+        # nothing to negotiate without a WebP profile.
+        status, headers, body = requestHandler2(self.config([]), '/noise/12/0/0.png', accept='image/webp')
+        self.assertEqual(headers['Content-Type'], 'image/png')
+        self.assertEqual(headers['Vary'], None)
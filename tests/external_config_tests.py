@@ -0,0 +1,168 @@
+from unittest import TestCase
+from threading import Thread
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from time import sleep, time
+from json import dumps
+from wsgiref import util
+
+from TileStache.Core import KnownUnknown
+from TileStache.Goodies import ExternalConfigServer
+
+class StubConfigServer(HTTPServer):
+    ''' Local configuration server with a dictionary of layers, counting requests.
+    '''
+    def __init__(self):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), StubConfigHandler)
+        self.layers, self.requests, self.delay = {}, [], 0
+        self.root = 'http://127.0.0.1:%d' % self.server_port
+
+        thread = Thread(target=self.serve_forever)
+        thread.setDaemon(True)
+        thread.start()
+
+class StubConfigHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        self.server.requests.append(self.path)
+        sleep(self.server.delay)
+
+        if self.path == '/cache':
+            self.respond(200, {'name': 'Test'})
+        elif self.path == '/layers':
+            self.respond(200, self.server.layers)
+        elif self.path.startswith('/layer/') and self.path[7:] in self.server.layers:
+            self.respond(200, self.server.layers[self.path[7:]])
+        else:
+            self.respond(404, {})
+
+    def respond(self, status, body):
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.end_headers()
+        self.wfile.write(dumps(body))
+
+    def log_message(self, *args):
+        pass
+
+def proxy_layer(url):
+    return {'provider': {'name': 'proxy', 'url': url}}
+
+class ExternalConfigTests(TestCase):
+
+    def setUp(self):
+        self.server = StubConfigServer()
+        self.server.layers['osm'] = proxy_layer('http://tile.openstreetmap.org/{Z}/{X}/{Y}.png')
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def layer_requests(self):
+        return [path for path in self.server.requests if path.startswith('/layer')]
+
+    def test_cached_layers(self):
+        '''Layers and missing layers are fetched once while fresh'''
+
+        layers = ExternalConfigServer.WSGIServer(self.server.root).config.layers
+
+        for i in range(3):
+            self.assertTrue('osm' in layers)
+            self.assertTrue(layers['osm'] is layers['osm'])
+            self.assertFalse('nothing' in layers)
+            self.assertRaises(KnownUnknown, layers.__getitem__, 'nothing')
+
+        self.assertEqual(self.layer_requests(), ['/layer/osm', '/layer/nothing'])
+        self.assertEqual(layers.keys(), ['osm'])
+
+    def test_stale_while_revalidate(self):
+        '''Stale layers are used while they are fetched again in the background'''
+
+        layers = ExternalConfigServer.WSGIServer(self.server.root, ttl=0.1, negative_ttl=0.1).config.layers
+        old_layer = layers['osm']
+        self.assertFalse('new' in layers)
+
+        self.server.layers['osm'] = proxy_layer('http://example.com/{Z}/{X}/{Y}.png')
+        self.server.layers['new'] = proxy_layer('http://example.com/{Z}/{X}/{Y}.png')
+
+        sleep(.2)
+
+        # stale layer comes back right away, missing layer is looked up again.
+        self.assertTrue(layers['osm'] is old_layer)
+        self.assertTrue('new' in layers)
+
+        due = time() + 5
+
+        while layers['osm'] is old_layer and time() < due:
+            sleep(.01)
+
+        self.assertFalse(layers['osm'] is old_layer)
+
+        # unchanged layers are kept after a refresh.
+        sleep(.2)
+        new_layer = layers['osm']
+
+        while len(self.layer_requests()) < 5 and time() < due:
+            sleep(.01)
+
+        self.assertEqual(len(self.layer_requests()), 5)
+        self.assertTrue(layers['osm'] is new_layer)
+
+    def test_concurrent_fetch(self):
+        '''Threads asking for the same new layer wait on a single fetch'''
+
+        layers = ExternalConfigServer.WSGIServer(self.server.root).config.layers
+        self.server.delay, found = .2, []
+
+        threads = [Thread(target=lambda: found.append(layers['osm'])) for i in range(3)]
+
+        for thread in threads:
+            thread.start()
+
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(self.layer_requests(), ['/layer/osm'])
+        self.assertEqual(len(found), 3)
+        self.assertTrue(found[0] is found[1] is found[2])
+        self.assertEqual(found[0].name(), 'osm')
+
+    def test_prefetch(self):
+        '''Prefetched layers need no more requests'''
+
+        self.server.layers['other'] = proxy_layer('http://example.com/{Z}/{X}/{Y}.png')
+        layers = ExternalConfigServer.WSGIServer(self.server.root, prefetch=True).config.layers
+
+        self.assertEqual(sorted(layers.keys()), ['osm', 'other'])
+        self.assertTrue('osm' in layers and 'other' in layers)
+        self.assertEqual(self.layer_requests(), ['/layers'])
+
+    def test_uncached_layers(self):
+        '''Without caching, each tile request fetches its layer once'''
+
+        layers = ExternalConfigServer.WSGIServer(self.server.root, cache_responses=False).config.layers
+
+        for i in range(3):
+            if 'osm' in layers:
+                self.assertEqual(layers['osm'].name(), 'osm')
+
+        self.assertEqual(self.layer_requests(), ['/layer/osm'] * 3)
+        self.assertEqual(layers.keys(), [])
+
+        # a lookup is only remembered for the __getitem__ right after it.
+        layers['osm']
+        self.assertEqual(self.layer_requests(), ['/layer/osm'] * 4)
+
+    def test_uncached_requests(self):
+        '''Without caching, each WSGI tile request fetches its layer once'''
+
+        self.server.layers['gray'] = {'provider': {'class': 'tests.core_tests:RenderCountingProvider'}}
+        app = ExternalConfigServer.WSGIServer(self.server.root, cache_responses=False)
+        statuses = []
+
+        for path_info in ('/gray/0/0/0.png', '/gray/0/0/0.png', '/nothing/0/0/0.png', '/nothing/0/0/0.png'):
+            environ = {'PATH_INFO': path_info}
+            util.setup_testing_defaults(environ)
+            app(environ, lambda status, headers: statuses.append(status))
+
+        self.assertEqual(statuses, ['200 OK', '200 OK', '404 Not Found', '404 Not Found'])
+        self.assertEqual(self.layer_requests(), ['/layer/gray'] * 2 + ['/layer/nothing'] * 2)
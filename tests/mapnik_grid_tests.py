@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+from unittest import TestCase
+from StringIO import StringIO
+from random import Random
+import json
+
+from TileStache import Mapnik
+
+def reference_merge(grid1, grid2):
+    ''' Merge two grids one character at a time, like merge_grids() used to.
+    '''
+    keys, data = [], {}
+
+    for grid in (grid1, grid2):
+        for key in grid['keys']:
+            if key in grid['data']:
+                keys.append(str(len(data) + 1))
+                data[keys[-1]] = grid['data'][key]
+            else:
+                keys.append('')
+
+    def newchar(char1, char2):
+        id1, id2 = Mapnik.decode_char(char1), Mapnik.decode_char(char2)
+
+        if grid2['keys'][id2] == '':
+            return Mapnik.encode_id(id1)
+
+        return Mapnik.encode_id(id2 + len(grid1['keys']))
+
+    rows = [''.join([newchar(c1, c2) for (c1, c2) in zip(r1, r2)]) for (r1, r2) in zip(grid1['grid'], grid2['grid'])]
+
+    return dict(keys=keys, data=data, grid=rows)
+
+def random_grid(random, count, size=16):
+    ''' Return a grid of count features, with some transparent pixels.
+    '''
+    keys = [''] + ['f%d' % i for i in range(count)]
+    data = dict([(key, {'id': key}) for key in keys[1:]])
+    rows = [''.join([Mapnik.encode_id(random.randint(0, count)) for x in range(size)]) for y in range(size)]
+
+    return dict(keys=keys, data=data, grid=rows)
+
+def encoded(response):
+    out = StringIO()
+    response.save(out, 'JSON')
+
+    return out.getvalue()
+
+class GridTests(TestCase):
+
+    def test_ids(self):
+        '''Grid rows and index arrays convert both ways'''
+
+        rows = [u' !#', u'$]\u0080', u'一  ']
+        ids = Mapnik.grid_ids(rows)
+
+        self.assertEqual(ids.tolist(), [[Mapnik.decode_char(char) for char in row] for row in rows])
+        self.assertEqual(Mapnik.grid_rows(ids), rows)
+
+    def test_merge(self):
+        '''Merged grids are the same as merging them one character at a time'''
+
+        random = Random(0)
+
+        for (count1, count2) in ((3, 4), (120, 2), (5, 200)):
+            grid1, grid2 = random_grid(random, count1), random_grid(random, count2)
+            expected = reference_merge(grid1, grid2)
+
+            self.assertEqual(Mapnik.merge_grids(grid1, grid2), expected)
+
+            # many layers, as in GridProvider.renderArea()
+            grids = [random_grid(random, count) for count in (count1, count2, 7)]
+            arrays = [(grid['keys'], grid['data'], Mapnik.grid_ids(grid['grid'])) for grid in grids]
+            keys, data, ids = reduce(Mapnik.merge_grid_arrays, arrays)
+
+            self.assertEqual(dict(keys=keys, data=data, grid=Mapnik.grid_rows(ids)), reduce(reference_merge, grids))
+
+    def test_crop(self):
+        '''Cropped grids are encoded like before'''
+
+        grid = random_grid(Random(1), 150, 32)
+        response = Mapnik.SaveableResponse(grid, 4)
+
+        self.assertEqual(encoded(response), json.dumps(grid, ensure_ascii=False).encode('utf-8'))
+
+        cropped = response.crop((32, 64, 96, 128))
+        expected = dict(keys=grid['keys'], data=grid['data'], grid=[row[8:24] for row in grid['grid'][16:32]])
+
+        self.assertEqual(cropped.content, expected)
+        self.assertEqual(encoded(cropped), json.dumps(expected, ensure_ascii=False).encode('utf-8'))
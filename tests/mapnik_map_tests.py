@@ -0,0 +1,162 @@
+from unittest import TestCase
+from tempfile import mkstemp
+from time import time, sleep
+from os import close, unlink, utime
+
+from TileStache import Mapnik
+from TileStache.Goodies.Providers import Cascadenik
+
+class LoadedMap:
+    ''' Stand-in for a mapnik.Map, remembering which load it came from.
+    '''
+    def __init__(self, mapfile, number):
+        self.mapfile, self.number = mapfile, number
+
+class FakeMap:
+    ''' Stand-in for a mapnik.Map, which fails to render when broken.
+    '''
+    def __init__(self, width, height):
+        self.broken = False
+
+    def zoom_to_box(self, box):
+        pass
+
+class FakeImage:
+    def __init__(self, width, height):
+        self.width, self.height = width, height
+
+    def tostring(self):
+        return '\0' * (self.width * self.height * 4)
+
+class FakeMapnik:
+    ''' Stand-in for the few parts of the mapnik module used by ImageProvider.
+    '''
+    Map, Image = FakeMap, FakeImage
+
+    class FontEngine:
+        @staticmethod
+        def instance():
+            return None
+
+    @staticmethod
+    def render(mmap, img, *args):
+        if mmap.broken:
+            raise RuntimeError('Broken map')
+
+class FakeConfig:
+    dirpath = '/tmp/'
+
+class FakeLayer:
+    config = FakeConfig()
+
+class SharedMapTests(TestCase):
+
+    def setUp(self):
+        handle, self.mapfile = mkstemp(prefix='tilestache-mapfile-', suffix='.xml')
+        close(handle)
+
+        self.loaded, self.broken = [], False
+        self.get_mapnikMap = Mapnik.get_mapnikMap
+        Mapnik.get_mapnikMap = self.load
+        Mapnik._shared_maps.clear()
+        Mapnik._pending_maps.clear()
+
+    def tearDown(self):
+        Mapnik.get_mapnikMap = self.get_mapnikMap
+        Mapnik._shared_maps.clear()
+        Mapnik._pending_maps.clear()
+        unlink(self.mapfile)
+
+    def load(self, mapfile):
+        self.loaded.append(mapfile)
+
+        if self.broken:
+            self.broken = False
+            raise IOError('Broken mapfile')
+
+        return LoadedMap(mapfile, len(self.loaded))
+
+    def test_shared(self):
+        '''Maps are loaded once per mapfile, and again when it changes'''
+
+        Mapnik.prewarm_sharedMap(self.mapfile)
+        mmap = Mapnik.get_sharedMap(self.mapfile)
+
+        self.assertEqual(self.loaded, [self.mapfile])
+        self.assertTrue(Mapnik.get_sharedMap(self.mapfile) is mmap)
+
+        utime(self.mapfile, (time() + 10, time() + 10))
+
+        self.assertEqual(Mapnik.get_sharedMap(self.mapfile).number, 2)
+        self.assertEqual(len(Mapnik._shared_maps), 1)
+
+    def test_rebuild(self):
+        '''Broken maps are replaced in the background, and waited for'''
+
+        mmap = Mapnik.get_sharedMap(self.mapfile)
+
+        Mapnik.global_mapnik_lock.acquire()
+        Mapnik.rebuild_sharedMap(self.mapfile, mmap)
+        pending = Mapnik._pending_maps[self.mapfile]
+
+        # the broken map is forgotten before the lock is released.
+        self.assertFalse(self.mapfile in Mapnik._shared_maps)
+
+        # a second error doesn't start a second rebuild.
+        Mapnik.rebuild_sharedMap(self.mapfile, mmap)
+        self.assertTrue(Mapnik._pending_maps[self.mapfile] is pending)
+
+        # a waiting request gets the rebuilt map instead of loading its own.
+        try:
+            self.assertEqual(Mapnik.get_sharedMap(self.mapfile).number, 2)
+        finally:
+            Mapnik.global_mapnik_lock.release()
+
+        self.assertEqual(len(self.loaded), 2)
+        self.assertEqual(Mapnik._pending_maps, {})
+
+        # failed loads are left for the next request.
+        Mapnik.rebuild_sharedMap(self.mapfile, None)
+        self.assertEqual(len(self.loaded), 2)
+
+    def test_failed_rebuild(self):
+        '''Requests waiting for a failed rebuild load the map themselves'''
+
+        mmap = Mapnik.get_sharedMap(self.mapfile)
+        self.broken = True
+
+        Mapnik.global_mapnik_lock.acquire()
+        Mapnik.rebuild_sharedMap(self.mapfile, mmap)
+
+        try:
+            self.assertEqual(Mapnik.get_sharedMap(self.mapfile).number, 3)
+        finally:
+            Mapnik.global_mapnik_lock.release()
+
+class CascadenikTests(TestCase):
+
+    def setUp(self):
+        self.loaded = []
+        Mapnik.mapnik = Cascadenik.mapnik = FakeMapnik
+        Mapnik.Box2d = lambda *args: args
+        Cascadenik.load_map = self.load
+
+    def tearDown(self):
+        del Mapnik.mapnik, Mapnik.Box2d, Cascadenik.mapnik, Cascadenik.load_map
+
+    def load(self, mmap, mapfile, workdir, cache_dir=None):
+        # the first compiled map is broken.
+        mmap.broken = not self.loaded
+        self.loaded.append(mapfile)
+
+    def test_render_error(self):
+        '''A compiled map that fails to render is compiled again'''
+
+        provider = Cascadenik.Provider(FakeLayer(), 'style.mml')
+
+        self.assertRaises(RuntimeError, provider.renderArea, 16, 16, None, 0, 0, 1, 1, 0)
+        self.assertEqual(provider.mapnik, None)
+
+        image = provider.renderArea(16, 16, None, 0, 0, 1, 1, 0)
+        self.assertEqual(image.size, (16, 16))
+        self.assertEqual(self.loaded, ['/tmp/style.mml'] * 2)
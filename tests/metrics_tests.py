@@ -0,0 +1,79 @@
+from unittest import TestCase
+from time import sleep
+from wsgiref import util
+from ModestMaps.Core import Coordinate
+from TileStache import WSGITileServer, parseConfig, Metrics
+
+
+class MetricsTests(TestCase):
+    '''Tests tile measurements and the WSGI metrics endpoint'''
+
+    def setUp(self):
+        Metrics.registry.clear()
+
+        config = parseConfig({
+            "layers": {
+                "solid": {
+                    "provider": {"class": "tests.utils:SolidColorProvider"},
+                    "metatile": {"rows": 2, "columns": 2},
+                    "server timing": True
+                }
+            },
+            "cache": {"name": "Test"}
+        })
+
+        self.app = WSGITileServer(config, metrics_path='/metrics')
+
+    def request(self, path_info):
+        environ, response = {'PATH_INFO': path_info}, {}
+        util.setup_testing_defaults(environ)
+
+        def start_response(status, headers):
+            response['status'], response['headers'] = status, dict(headers)
+
+        body = ''.join(self.app(environ, start_response))
+        return response['status'], response['headers'], body
+
+    def test_metrics_endpoint(self):
+        '''Render a tile and read its measurements in Prometheus text format'''
+
+        status, headers, tile = self.request('/solid/1/0/0.png')
+        self.assertEqual(status, '200 OK')
+
+        status, headers, body = self.request('/metrics')
+        self.assertEqual(status, '200 OK')
+        self.assertTrue(headers['Content-Type'].startswith('text/plain'))
+
+        labels = 'layer="solid",zoom="1",format="PNG"'
+        lines = body.splitlines()
+
+        self.assertTrue('# TYPE tilestache_tiles_total counter' in lines)
+        self.assertTrue('tilestache_tiles_total{%s,source="layer.render()"} 1' % labels in lines)
+        self.assertTrue('tilestache_render_seconds_count{%s} 1' % labels in lines)
+        self.assertTrue('tilestache_lock_wait_seconds_count{%s} 1' % labels in lines)
+        self.assertTrue('tilestache_response_bytes_sum{%s} %d' % (labels, len(tile)) in lines)
+        self.assertTrue('tilestache_response_bytes_bucket{%s,le="+Inf"} 1' % labels in lines)
+
+    def test_server_timing(self):
+        '''Render a tile and check its Server-Timing header'''
+
+        status, headers, tile = self.request('/solid/1/0/0.png')
+        stages = [part.split(';')[0] for part in headers['Server-Timing'].split(', ')]
+        self.assertEqual(stages, ['read', 'lock', 'provider', 'effects', 'slice', 'render', 'encode', 'save'])
+
+    def test_slice_timing(self):
+        '''Metatile tiles saved while slicing are timed apart from slicing'''
+
+        cache, save = self.app.config.cache, self.app.config.cache.save
+
+        def slowly(*args):
+            sleep(.05)
+            return save(*args)
+
+        cache.save = slowly
+
+        timings = {}
+        self.app.config.layers['solid'].getTileResponse(Coordinate(0, 0, 1), 'png', timings=timings)
+
+        self.assertTrue(timings['save'] >= .2, 'Four metatile saves should be counted')
+        self.assertTrue(timings['slice'] < .1, 'Saves should not be counted as slicing')
@@ -0,0 +1,120 @@
+from unittest import TestCase
+from tempfile import mkdtemp
+from shutil import rmtree
+from os.path import join as pathjoin
+from os import utime
+from time import time
+
+try:
+    from PIL import Image
+except ImportError:
+    import Image
+
+from ModestMaps.Core import Coordinate
+
+from TileStache import Sandwich
+from TileStache.Core import KnownUnknown
+from TileStache.Config import buildConfiguration
+
+class SolidProvider:
+    ''' Provider of one solid RGBA color, for Sandwich sublayers.
+    '''
+    def __init__(self, layer, color):
+        self.color = tuple(color)
+
+    def renderArea(self, width, height, *args):
+        return Image.new('RGBA', (width, height), self.color)
+
+class SandwichTests(TestCase):
+
+    def setUp(self):
+        self.dirpath = mkdtemp(prefix='sandwich-tests-')
+
+    def tearDown(self):
+        rmtree(self.dirpath)
+
+    def render(self, stack, coord=Coordinate(0, 0, 1)):
+        ''' Return a rendered tile image for a stack over solid layers.
+        '''
+        layers = {
+            'orange': {'provider': {'class': 'tests.sandwich_tests:SolidProvider', 'kwargs': {'color': [0xFF, 0x99, 0x00, 0xFF]}}},
+            'faded': {'provider': {'class': 'tests.sandwich_tests:SolidProvider', 'kwargs': {'color': [0x00, 0x00, 0xFF, 0x80]}}},
+            'white': {'provider': {'class': 'tests.sandwich_tests:SolidProvider', 'kwargs': {'color': [0xFF, 0xFF, 0xFF, 0xFF]}}},
+            'sandwich': {'provider': {'name': 'sandwich', 'stack': stack}}
+            }
+
+        config = buildConfiguration({'cache': {'name': 'Test'}, 'layers': layers}, self.dirpath + '/')
+        return config.layers['sandwich'].provider.renderTile(256, 256, None, coord)
+
+    def test_colors(self):
+        '''Stacks of colors are blended without a size'''
+
+        image = self.render([{'color': '#f90'}, {'color': '#00f8', 'mode': 'screen'}])
+
+        self.assertEqual(image.size, (256, 256))
+        self.assertEqual(image.getcolors(), [(256 * 256, (0xFF, 0x99, 0x88, 0xFF))])
+
+    def test_layers(self):
+        '''Layers are pasted, masked, and blended in turn'''
+
+        self.assertEqual(self.render([{'src': 'orange'}]).getpixel((0, 0)), (0xFF, 0x99, 0x00, 0xFF))
+        self.assertEqual(self.render([{'src': 'orange'}, {'src': 'faded'}]).getpixel((0, 0)), (0x7F, 0x4C, 0x80, 0xFF))
+        self.assertEqual(self.render([{'src': 'orange'}, {'src': 'faded', 'mode': 'multiply'}]).getpixel((0, 0)), (0x7F, 0x4C, 0x00, 0xFF))
+        self.assertEqual(self.render([{'src': 'orange'}, {'color': '#000', 'mask': 'white', 'opacity': 0.5}]).getpixel((0, 0)), (0x80, 0x4C, 0x00, 0xFF))
+        self.assertEqual(self.render([{'color': '#000', 'src': 'faded'}]).getpixel((0, 0)), (0x00, 0x00, 0x80, 0xFF))
+
+    def test_zooms_and_adjustments(self):
+        '''Layers outside their zoom range are skipped, adjustments apply'''
+
+        stack = [{'src': 'orange'}, {'color': '#fff', 'zoom': '2-4'}, {'src': 'orange', 'adjustments': [['threshold', [128]]], 'zoom': '5'}]
+
+        self.assertEqual(self.render(stack, Coordinate(0, 0, 1)).getpixel((0, 0)), (0xFF, 0x99, 0x00, 0xFF))
+        self.assertEqual(self.render(stack, Coordinate(0, 0, 3)).getpixel((0, 0)), (0xFF, 0xFF, 0xFF, 0xFF))
+        self.assertEqual(self.render(stack, Coordinate(0, 0, 5)).getpixel((0, 0)), (0xFF, 0xFF, 0x00, 0xFF))
+
+        stack = [{'src': 'orange', 'adjustments': [['curves', [0, 204, 255]]]}]
+        self.assertEqual(self.render(stack).getpixel((0, 0)), (0xFF, 0x26, 0x00, 0xFF))
+
+    def test_local_bitmap(self):
+        '''Local images are tiled seamlessly and decoded once'''
+
+        image = Image.new('RGBA', (3, 2))
+        image.putdata([(i * 40, 0, 0, 0xFF) for i in range(6)])
+        image.save(pathjoin(self.dirpath, 'stripes.png'))
+
+        tile = self.render([{'src': 'stripes.png'}], Coordinate(0, 1, 8))
+
+        self.assertEqual([tile.getpixel((x, 0))[0] for x in range(4)], [40, 80, 0, 40])
+        self.assertEqual([tile.getpixel((0, y))[0] for y in range(3)], [40, 160, 40])
+
+        self.assertTrue(Sandwich.load_texture(pathjoin(self.dirpath, 'stripes.png')) is Sandwich.load_texture(pathjoin(self.dirpath, 'stripes.png')))
+
+    def test_changed_bitmap(self):
+        '''Local images are decoded again when they change, and few are kept'''
+
+        filename = pathjoin(self.dirpath, 'solid.png')
+        Image.new('RGBA', (2, 2), (0xFF, 0, 0, 0xFF)).save(filename)
+        texture = Sandwich.load_texture(filename)
+
+        Image.new('RGBA', (2, 2), (0, 0xFF, 0, 0xFF)).save(filename)
+        utime(filename, (time() + 10, time() + 10))
+
+        self.assertFalse(Sandwich.load_texture(filename) is texture)
+        self.assertEqual(Sandwich.load_texture(filename)[1, 0, 0], 1.)
+
+        for i in range(Sandwich._textures_size):
+            other = pathjoin(self.dirpath, 'other-%d.png' % i)
+            Image.new('RGBA', (2, 2)).save(other)
+            Sandwich.load_texture(other)
+
+        self.assertEqual(len(Sandwich._textures), Sandwich._textures_size)
+        self.assertFalse(filename in Sandwich._textures)
+
+    def test_errors(self):
+        '''Bad stacks are reported when the layer is configured'''
+
+        for stack in ([{'src': 'orange', 'color': '#fff', 'mask': 'white'}], [{'mask': 'white'}], [{}],
+                      [{'color': 'fff'}], [{'color': '#fff', 'zoom': 'twelve'}],
+                      [{'src': 'orange', 'adjustments': [['sharpen', []]]}],
+                      [{'src': 'orange', 'adjustments': [['curves', [0, 0, 255]]]}]):
+            self.assertRaises(KnownUnknown, self.render, stack)
@@ -0,0 +1,105 @@
+import logging
+from time import sleep
+from unittest import TestCase
+from TileStache.Goodies import StatusServer
+
+
+class FakeStrictRedis:
+    '''In-memory stand-in for the Redis list commands used by Reporter'''
+
+    lists = {}
+
+    def __init__(self, **kwargs):
+        pass
+
+    def pipeline(self, transaction=True):
+        return self
+
+    def execute(self):
+        pass
+
+    def lpush(self, key, value):
+        FakeStrictRedis.lists.setdefault(key, []).insert(0, value)
+
+    def expire(self, key, seconds):
+        pass
+
+    def ltrim(self, key, start, end):
+        del FakeStrictRedis.lists[key][end + 1:]
+
+
+class Warnings(logging.Handler):
+    '''Logging handler that keeps warning messages'''
+
+    def __init__(self):
+        logging.Handler.__init__(self, logging.WARNING)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+class ReporterTests(TestCase):
+    '''Tests buffered StatusServer messages against a fake Redis'''
+
+    def setUp(self):
+        self.StrictRedis = StatusServer.StrictRedis
+        StatusServer.StrictRedis = FakeStrictRedis
+        FakeStrictRedis.lists.clear()
+
+        self.warnings = Warnings()
+        logging.getLogger().addHandler(self.warnings)
+
+    def tearDown(self):
+        StatusServer.StrictRedis = self.StrictRedis
+        logging.getLogger().removeHandler(self.warnings)
+
+    def messages(self, reporter):
+        key = 'pid-%d-statuses' % reporter.pid
+        return [msg.split(' ', 1)[1] for msg in FakeStrictRedis.lists.get(key, [])]
+
+    def test_flush(self):
+        '''Send buffered messages youngest-first in one flush'''
+
+        reporter = StatusServer.Reporter(interval=60)
+        reporter.update('one')
+        reporter.update('two')
+
+        self.assertEqual(self.messages(reporter), [])
+
+        reporter.flush()
+        self.assertEqual(self.messages(reporter), ['two', 'one'])
+        self.assertEqual(self.warnings.messages, [])
+
+    def test_dropped_messages(self):
+        '''Count and log messages dropped from a full buffer'''
+
+        reporter = StatusServer.Reporter(interval=60, size=2)
+
+        for msg in ('one', 'two', 'three', 'four', 'five'):
+            reporter.update(msg)
+
+        reporter.flush()
+        self.assertEqual(self.messages(reporter), ['five', 'four'])
+        self.assertEqual(len(self.warnings.messages), 1)
+        self.assertTrue('dropped 3 messages' in self.warnings.messages[0])
+
+        reporter.flush()
+        self.assertEqual(len(self.warnings.messages), 1, 'Dropped count should be reset')
+
+    def test_flush_thread(self):
+        '''Send messages from the background thread without an explicit flush'''
+
+        reporter = StatusServer.Reporter(interval=.05)
+        reporter.update('one')
+
+        for i in range(40):
+            if self.messages(reporter):
+                break
+            sleep(.05)
+
+        # let the daemon thread sleep through interpreter shutdown.
+        reporter.interval = 60
+        sleep(.1)
+
+        self.assertEqual(self.messages(reporter), ['one'])
@@ -0,0 +1,89 @@
+from unittest import TestCase
+from json import dumps, loads
+
+from ModestMaps.Core import Coordinate
+
+from TileStache import Core, parseConfig
+from TileStache.Mapnik import encode_id
+
+class FixedGridResponse:
+    ''' JSON response like TileStache.Mapnik.SaveableResponse.
+    '''
+    def __init__(self, content):
+        self.content = content
+
+    def save(self, out, format):
+        out.write(dumps(self.content))
+
+class FixedGridProvider:
+    ''' Provider of one UTF Grid, with rows of key indexes.
+    '''
+    def __init__(self, layer, keys, rows):
+        self.keys, self.rows = keys, rows
+
+    def getTypeByExtension(self, extension):
+        return 'application/json', 'JSON'
+
+    def renderTile(self, width, height, srs, coord):
+        grid = [''.join(map(encode_id, row)) for row in self.rows]
+        data = dict([(key, {'name': key}) for key in self.keys if key])
+
+        return FixedGridResponse(dict(keys=self.keys, data=data, grid=grid))
+
+def grid_layer(keys, rows):
+    return {'provider': {'class': 'tests.utfgrid_composite_tests:FixedGridProvider', 'kwargs': {'keys': keys, 'rows': rows}}}
+
+class UtfGridCompositeTests(TestCase):
+
+    def setUp(self):
+        Core._recent_objects.clear()
+
+    def render(self, provider_class, stack, **kwargs):
+        ''' Return parsed JSON for a composite of two small grid layers.
+        '''
+        layers = {
+            # left half, and a feature that's covered up.
+            'left': grid_layer(['', '1', '2'], [[1, 1, 0, 0], [1, 1, 0, 0], [1, 1, 0, 0], [2, 2, 0, 0]]),
+            # top half, with a key that's also in the left layer.
+            'top': grid_layer(['', '1', '9'], [[1, 1, 1, 2], [0, 0, 0, 0], [0, 0, 0, 0], [0, 0, 0, 0]]),
+            'composite': {'provider': {'class': provider_class, 'kwargs': dict(stack=stack, **kwargs)}}
+            }
+
+        config = parseConfig({'cache': {'name': 'Test'}, 'layers': layers})
+        status, headers, content = config.layers['composite'].getTileResponse(Coordinate(0, 0, 1), 'json')
+
+        return content
+
+    def test_composite(self):
+        '''Later layers cover earlier ones, with keys renamed'''
+
+        stack = [{'src': 'left', 'layer_id': 'L', 'wrapper': None}, {'src': 'top', 'layer_id': 'T', 'wrapper': None}]
+        grid = loads(self.render('TileStache.Goodies.Providers.UtfGridComposite:Provider', stack, layer_id='layer'))
+
+        self.assertEqual(grid['keys'], ['1a', '9', '1', '', '2'])
+        self.assertEqual(grid['grid'], ['   !', '##$$', '##$$', '%%$$'])
+        self.assertEqual(grid['data'], {'1': {'name': '1', 'layer': 'L'}, '2': {'name': '2', 'layer': 'L'},
+                                        '1a': {'name': '1', 'layer': 'T'}, '9': {'name': '9', 'layer': 'T'}})
+
+    def test_composite_wrapper(self):
+        '''Results can be wrapped in a callback'''
+
+        stack = [{'src': 'left', 'layer_id': None, 'wrapper': None}]
+        content = self.render('TileStache.Goodies.Providers.UtfGridComposite:Provider', stack, wrapper='grid')
+
+        self.assertTrue(content.startswith('grid({') and content.endswith('})'))
+        self.assertEqual(loads(content[5:-1])['keys'], ['1', '', '2'])
+
+    def test_overlap(self):
+        '''Overlapping features are all listed for each pixel'''
+
+        stack = [{'src': 'left', 'layer_id': 'L', 'wrapper': None}, {'src': 'top', 'layer_id': 'T', 'wrapper': None}]
+        grid = loads(self.render('TileStache.Goodies.Providers.UtfGridCompositeOverlap:Provider', stack, layer_id='layer'))
+
+        self.assertEqual(grid['keys'], ['', '1', '2', '3', '4', '5'])
+        self.assertEqual(grid['grid'], ['!!#$', '%%  ', '%%  ', '&&  '])
+        self.assertEqual(grid['data']['1'], [{'name': '1', 'layer': 'L'}, {'name': '1', 'layer': 'T'}])
+        self.assertEqual(grid['data']['2'], [{'name': '1', 'layer': 'T'}])
+        self.assertEqual(grid['data']['3'], [{'name': '9', 'layer': 'T'}])
+        self.assertEqual(grid['data']['4'], [{'name': '1', 'layer': 'L'}])
+        self.assertEqual(grid['data']['5'], [{'name': '2', 'layer': 'L'}])
@@ -13,6 +13,11 @@ except ImportError:
     from queue import Queue, Empty  # python 3.x
 
 
+try:
+    from PIL import Image
+except ImportError:
+    import Image
+
 from ModestMaps.Core import Coordinate
 from TileStache import getTile, parseConfig
 from TileStache.Core import KnownUnknown
@@ -118,4 +123,17 @@ def find_open_port():
     s.bind(("",0))
     port = s.getsockname()[1]
     s.close()
-    return port
\ No newline at end of file
+    return port
+
+
+class SolidColorProvider:
+    '''
+    Provider that draws a single color, for tests that
+    should not depend on anything outside this process
+    '''
+    def __init__(self, layer, color=(0x99, 0x99, 0x99, 0xff)):
+        self.layer = layer
+        self.color = tuple(color)
+
+    def renderArea(self, width, height, srs, xmin, ymin, xmax, ymax, zoom):
+        return Image.new('RGBA', (width, height), self.color)